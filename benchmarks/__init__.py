@@ -0,0 +1,55 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Shared helpers for the Hydrus benchmark suite.
+
+The benchmarks run on synthetic data from `hydrus.synthetic`, so they need
+neither CMS's SAS file nor network access.  Run them with e.g.
+
+    pytest benchmarks/bench_pipeline.py --benchmark-only -k 1x
+"""
+import logging
+from functools import lru_cache
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+
+
+logging.disable(logging.CRITICAL)
+
+# Multiples of today's hospital count (`SYNTH_NHOSP`) to benchmark at.
+SCALES = [1, 10, 100]
+
+
+@lru_cache(maxsize=None)
+def config():
+    cfg = set_config()
+    cfg.MULTIPROCESSING = False
+    cfg.WRITE_NOTHING = True
+    return cfg
+
+
+@lru_cache(maxsize=1)
+def raw_data(scale):
+    cfg = config()
+    return synthetic_data(cfg.SYNTH_NHOSP * scale, cfg=cfg, seed=scale)
+
+
+@lru_cache(maxsize=1)
+def std_data(scale):
+    return preprocess(cfg=config(), data=raw_data(scale))
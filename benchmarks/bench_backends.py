@@ -0,0 +1,65 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+# pytest benchmarks/bench_backends.py --benchmark-only
+"""
+Compare the process-pool (`oparallel`) and thread-pool (`othreaded`) ways of
+fitting every group, by wall time and memory.  `process_nogil` runs the
+process pool with the same LVM kernels as the thread pool, to separate the
+effect of the backend from that of the kernels.
+
+Each result's `extra_info` has the peak resident memory of the main process
+and, for the process pool, the sum of the workers' peaks and the bytes
+pickled for them.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from hydrus.model import oparallel
+from hydrus.threaded import othreaded
+from hydrus.instrument import RunReport, peak_rss
+from benchmarks import SCALES, config, std_data
+
+
+# Backend name: (executor, THREADS setting)
+BACKENDS = {
+    'process': (oparallel, False),
+    'process_nogil': (oparallel, True),
+    'thread': (othreaded, True),
+    }
+
+scales = pytest.mark.parametrize(
+    'scale', SCALES, ids=[f'{x}x' for x in SCALES])
+backends = pytest.mark.parametrize('backend', list(BACKENDS))
+
+
+@scales
+@backends
+def test_fit_groups(benchmark, backend, scale):
+    cfg = SimpleNamespace(**vars(config()))
+    executor, cfg.THREADS = BACKENDS[backend]
+    df, final_meas = std_data(scale)
+    report = RunReport()
+    benchmark.pedantic(
+        lambda: executor(df, final_meas, cfg=cfg, report=report), rounds=1)
+
+    workers = [x for x in report.workers if 'args_bytes' in x]
+    benchmark.extra_info.update({
+        'main_peak_rss_bytes': peak_rss(),
+        'worker_peak_rss_bytes': sum(x['peak_rss_bytes'] for x in workers),
+        'args_bytes': sum(x['args_bytes'] for x in workers),
+        })
@@ -0,0 +1,64 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+# pytest benchmarks/bench_distributed.py --benchmark-only
+"""
+How fitting every group (exact integral) scales with the number of worker
+nodes in `hydrus.distributed`, run here as local processes.  `0` nodes is
+`oserial` with the analytic gradient (`ChunkedLvm` with a single chunk), to
+compare against.
+
+Each result's `extra_info` has the total time the nodes spent answering
+requests (the rest of the wall time is the driver's optimizer and the round
+trips), the largest node's peak memory, and the driver's.
+"""
+from types import SimpleNamespace
+
+import pytest
+
+from hydrus.model import oserial
+from hydrus.distributed import odistributed
+from hydrus.instrument import RunReport, peak_rss
+from benchmarks import SCALES, config, std_data
+
+
+NODES = [0, 1, 2, 4]
+
+scales = pytest.mark.parametrize(
+    'scale', SCALES, ids=[f'{x}x' for x in SCALES])
+nodes = pytest.mark.parametrize(
+    'nnodes', NODES, ids=[f'{x}nodes' for x in NODES])
+
+
+@scales
+@nodes
+def test_fit_groups(benchmark, nnodes, scale):
+    cfg = SimpleNamespace(**vars(config()))
+    cfg.QUADRATURE, cfg.NODES = False, nnodes
+    cfg.CHUNKED, cfg.CHUNK_ROWS = not nnodes, 10**9
+    df, final_meas = std_data(scale)
+    report = RunReport()
+    executor = odistributed if nnodes else oserial
+    benchmark.pedantic(
+        lambda: executor(df, final_meas, cfg=cfg, report=report), rounds=1)
+
+    nodes = [x for x in report.workers if 'node' in x]
+    benchmark.extra_info.update({
+        'node_seconds': sum(x['call_seconds'] for x in nodes),
+        'node_peak_rss_bytes': max(
+            [x['peak_rss_bytes'] for x in nodes], default=None),
+        'driver_peak_rss_bytes': peak_rss(),
+        })
@@ -0,0 +1,46 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+# pytest benchmarks/bench_modes.py
+"""
+Equivalence and performance regression checks for every execution mode but
+the JIT ones (see `benchmarks.modes`).
+"""
+import pytest
+
+from benchmarks.modes import (
+    BASELINES, NHOSP, compare, load_baselines, machine, mode_name, modes,
+    reference, regressions, run_mode)
+
+
+all_modes = pytest.mark.parametrize('mode', modes(), ids=mode_name)
+
+
+@all_modes
+def test_equivalent(mode):
+    problems = compare(run_mode(mode), run_mode(reference(mode)))
+    assert not problems, problems
+
+
+@all_modes
+def test_no_regression(mode):
+    baseline = load_baselines().get(mode_name(mode))
+    if not baseline or baseline['nhosp'] != NHOSP:
+        pytest.skip(f'no baseline in {BASELINES}')
+    if mode == reference(mode) and baseline['machine'] != machine():
+        pytest.skip(f"no baseline for this machine in {BASELINES}")
+    problems = regressions(run_mode(mode), run_mode(reference(mode)), baseline)
+    assert not problems, problems
@@ -0,0 +1,111 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+# pytest benchmarks/bench_pipeline.py --benchmark-only
+import pytest
+from pandas import DataFrame
+
+from hydrus.corrections import Baseline, correct
+from hydrus.model import Lvm, group_inputs
+from hydrus.preprocess import preprocess
+from hydrus.__main__ import rate, summarize, cluster_kmeans, cluster_scs
+from benchmarks import SCALES, config, raw_data, std_data
+
+
+GROUP = 'mortality'
+scales = pytest.mark.parametrize(
+    'scale', SCALES, ids=[f'{x}x' for x in SCALES])
+
+
+def make_lvm(scale):
+    df, final_meas = std_data(scale)
+    z, w = group_inputs(df, final_meas[GROUP])
+    return Lvm(z, w, GROUP, cfg=config())
+
+
+def group_scores(scale):
+    """Fake group scores with the same shape and missingness as the real
+    ones."""
+    df, final_meas = std_data(scale)
+    scores = df[[]].copy()
+    for g in config().GROUPS:
+        nums = df[final_meas[g][0]]
+        scores[g] = nums.mean(axis=1)
+    return scores
+
+
+@scales
+def test_preprocess(benchmark, scale):
+    data = raw_data(scale)
+    benchmark.pedantic(
+        preprocess, kwargs={'cfg': config(), 'data': data}, rounds=1)
+
+
+@scales
+def test_estimate(benchmark, scale):
+    benchmark.pedantic(lambda: make_lvm(scale).estimate(), rounds=1)
+
+
+@scales
+def test_predict(benchmark, scale):
+    lvm = make_lvm(scale)
+    lvm.estimate()
+    benchmark.pedantic(lvm.predict, rounds=1)
+
+
+@scales
+def test_summarize(benchmark, scale):
+    scores = group_scores(scale)
+    benchmark.pedantic(
+        summarize, setup=lambda: ((scores.copy(), config().GROUP_WEIGHTS), {}),
+        rounds=3)
+
+
+@scales
+def test_rate(benchmark, scale):
+    df, final_meas = std_data(scale)
+    scores = group_scores(scale)
+    pdfs = [scores[[g]] for g in config().GROUPS]
+    benchmark.pedantic(rate, args=(df, final_meas, pdfs, config()), rounds=1)
+
+
+@scales
+def test_cluster_kmeans(benchmark, scale):
+    summ = summarize(group_scores(scale), config().GROUP_WEIGHTS)
+    benchmark.pedantic(
+        cluster_kmeans, args=(summ['summary_win'], config()), rounds=1)
+
+
+@scales
+def test_cluster_scs(benchmark, scale):
+    summ = summarize(group_scores(scale), config().GROUP_WEIGHTS)
+    benchmark.pedantic(
+        cluster_scs, args=(summ['summary_win'], config()), rounds=1)
+
+
+@scales
+def test_correct(benchmark, scale):
+    """Apply five corrections to one measure; compare with a whole run."""
+    cfg = config()
+    raw = raw_data(scale)
+    base = Baseline.run(raw, cfg)
+    col = 'MORT_30_AMI'
+    pids = raw.index[raw[col].notnull()][:5]
+    delta = DataFrame({
+        'PROVIDER_ID': pids, 'measure': col,
+        'value': raw.loc[pids, col] * 1.1,
+        'denominator': raw.loc[pids, f'{col}_DEN']})
+    benchmark.pedantic(correct, args=(base, delta, cfg), rounds=1)
@@ -0,0 +1,291 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Check that every execution mode gives the same answers, and no slower.
+
+A mode is a combination of the `JIT`, `MULTIPROCESSING` (`oparallel` or
+`oserial`), `QUADRATURE`, and `RAPIDCLUS` switches.  Each mode runs the
+pipeline on the same synthetic data in its own Python process, since `JIT`
+is read when Hydrus is imported.
+
+`JIT` and `MULTIPROCESSING` shouldn't change the results, so each mode's
+estimates, predictions, and star ratings are compared with those of the
+mode with both off and the same `QUADRATURE` and `RAPIDCLUS`.  Its wall time
+and peak memory are compared with the baselines in `BASELINES`, which
+`--update` records: as multiples of the reference mode's in the same run,
+which carry over from one machine to another, and (only on a machine like
+the one they were recorded on, see `machine`) as they are.  Run
+
+    python -m benchmarks.modes [--nhosp N] [--jit] [--update] [MODE ...]
+
+or `pytest benchmarks/bench_modes.py`.
+
+The JIT modes are left out unless `--jit` is given, since they need a Numba
+that can compile `hydrus.norm`, and `BASELINES` has none for them.  Record
+theirs with `--jit --update` where they run.
+"""
+import os
+import sys
+import json
+import pickle
+import argparse
+import platform
+import subprocess
+from itertools import product
+from functools import lru_cache
+from tempfile import TemporaryDirectory
+
+import numpy as np
+
+
+SWITCHES = 'JIT', 'MULTIPROCESSING', 'QUADRATURE', 'RAPIDCLUS'
+
+# Names for each switch's (off, on) settings.
+LABELS = {
+    'JIT': ('nojit', 'jit'),
+    'MULTIPROCESSING': ('serial', 'parallel'),
+    'QUADRATURE': ('exact', 'quad'),
+    'RAPIDCLUS': ('kmeans', 'scs'),
+    }
+
+NHOSP = 500
+SEED = 0
+BASELINES = os.path.join(os.path.dirname(__file__), 'mode_baselines.json')
+
+# Tolerances for equivalence with the reference mode.
+ESTIMATE_TOL = 1e-6
+PREDICTION_TOL = 1e-6
+STAR_TOL = 0  # fraction of hospitals whose stars may differ
+
+# A mode regresses if its wall time or peak memory (main process plus
+# workers) exceeds its baseline by more than these fractions.
+TIME_TOL = .5
+MEMORY_TOL = .25
+METRICS = {'seconds': TIME_TOL, 'peak_rss_bytes': MEMORY_TOL}
+
+# Run in a fresh interpreter, to set `JIT` before Hydrus is imported.
+CHILD = """\
+import sys, json
+from hydrus import constants
+mode = json.loads(sys.argv[1])
+constants.JIT = mode['JIT']
+from benchmarks.modes import child
+child(mode, *sys.argv[2:])
+"""
+
+
+def modes(jit=False):
+    """Return every mode (with `jit`, including the JIT ones) as a dict of
+    switch settings."""
+    return [dict(zip(SWITCHES, x))
+            for x in product([False, True], repeat=len(SWITCHES))
+            if jit or not x[0]]
+
+
+def mode_name(mode):
+    return '-'.join(LABELS[k][mode[k]] for k in SWITCHES)
+
+
+def reference(mode):
+    """Return the mode whose results `mode` should reproduce."""
+    return {**mode, 'JIT': False, 'MULTIPROCESSING': False}
+
+
+def child(mode, nhosp, seed, outfile):
+    """Run the pipeline in `mode` and pickle its results to `outfile`."""
+    from time import perf_counter
+    from pandas import concat
+    from hydrus.instrument import RunReport, peak_rss
+    from hydrus.synthetic import synthetic_data
+    from hydrus.preprocess import preprocess
+    from hydrus.__main__ import executor, rate
+    from benchmarks import config
+
+    cfg = config()
+    for k, v in mode.items():
+        setattr(cfg, k, v)
+
+    def pipeline(data, report):
+        std_data, final_meas = preprocess(cfg=cfg, data=data, report=report)
+        edfs, pdfs = executor(cfg)(
+            std_data, final_meas, cfg=cfg, report=report)
+        edfs, pdfs = list(edfs), list(pdfs)
+        summ = rate(std_data, final_meas, [x.copy() for x in pdfs], cfg, report)
+        return edfs, pdfs, summ
+
+    data = synthetic_data(int(nhosp), cfg=cfg, seed=int(seed))
+    if cfg.JIT:  # (so the timed run doesn't include compilation)
+        pipeline(data, RunReport())
+    report = RunReport()
+    t0 = perf_counter()
+    edfs, pdfs, summ = pipeline(data, report)
+    seconds = perf_counter() - t0
+
+    result = {
+        'estimates': concat(edfs, keys=cfg.GROUPS),
+        'predictions': concat(pdfs, axis=1),
+        'stars': summ['cluster_name'],
+        'seconds': seconds,
+        'peak_rss_bytes': peak_rss() + sum(
+            x.get('peak_rss_bytes') or 0 for x in report.workers),
+        }
+    with open(outfile, 'wb') as out:
+        pickle.dump(result, out)
+
+
+@lru_cache(maxsize=None)
+def _run(mode_items, nhosp, seed):
+    mode = dict(mode_items)
+    with TemporaryDirectory() as tmp:
+        outfile = os.path.join(tmp, 'result.pkl')
+        proc = subprocess.run(
+            [sys.executable, '-c', CHILD, json.dumps(mode), str(nhosp),
+             str(seed), outfile],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+        if proc.returncode:
+            return {'error': proc.stderr.strip().splitlines()[-1:]}
+        with open(outfile, 'rb') as infile:
+            return pickle.load(infile)
+
+
+def run_mode(mode, nhosp=NHOSP, seed=SEED):
+    """
+    Run the pipeline in `mode` in a new process.  Return its results, or
+    {'error': [message]} if it failed.  Results are cached.
+    """
+    return _run(tuple(sorted(mode.items())), nhosp, seed)
+
+
+def compare(result, ref):
+    """Return a list of the ways `result` differs from reference `ref`."""
+    if 'error' in result or 'error' in ref:
+        return [f"failed: {result.get('error') or ref.get('error')}"]
+    problems = []
+    for key, tol in [('estimates', ESTIMATE_TOL),
+                     ('predictions', PREDICTION_TOL)]:
+        a, b = result[key], ref[key]
+        if a.shape != b.shape or not (a.index.equals(b.index)
+                                      and a.columns.equals(b.columns)):
+            problems.append(f'{key} have a different shape or labels')
+            continue
+        diff = np.nanmax(abs(a.values - b.values))
+        if diff > tol or not (a.isnull().values == b.isnull().values).all():
+            problems.append(f'{key} differ by up to {diff:.3g}')
+    changed = (result['stars'] != ref['stars']).mean()
+    if changed > STAR_TOL:
+        problems.append(f'{changed:.1%} of star ratings differ')
+    return problems
+
+
+def load_baselines(path=BASELINES):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as infile:
+        return json.load(infile)
+
+
+def machine():
+    """Return a description of this machine, to tell whether a baseline's
+    absolute timings apply here."""
+    parts = [platform.system(), platform.machine(), platform.processor(),
+             f'{os.cpu_count()} CPUs']
+    return ' '.join(x for x in parts if x)
+
+
+def baseline(result, ref, nhosp):
+    """Return a baseline for a mode's `result`, with the reference mode's
+    `ref` from the same run."""
+    out = {'nhosp': nhosp, 'machine': machine()}
+    for key in METRICS:
+        out[key] = result[key]
+        out[f'{key}_ratio'] = result[key] / ref[key]
+    return out
+
+
+def regressions(result, ref, baseline):
+    """
+    Return a list of the ways `result` is slower or bigger than `baseline`:
+    relative to the reference mode's `ref` from the same run, and if the
+    baseline was recorded on a machine like this one, absolutely.
+    """
+    if 'error' in result or 'error' in ref or not baseline:
+        return []
+    problems = []
+    for key, tol in METRICS.items():
+        ratio, base = result[key] / ref[key], baseline[f'{key}_ratio']
+        if ratio > base * (1 + tol):
+            problems.append(f'{key} is {ratio:.3g}x the reference mode\'s, '
+                            f'over {1 + tol:.2g}x the baseline {base:.3g}x')
+        if (baseline['machine'] == machine()
+                and result[key] > baseline[key] * (1 + tol)):
+            problems.append(f'{key} {result[key]:.4g} is over {1 + tol:.2g}x '
+                            f'the baseline {baseline[key]:.4g}')
+    return problems
+
+
+def check(selected=None, nhosp=NHOSP, seed=SEED, update=False,
+          path=BASELINES, jit=False):
+    """
+    Run and check every mode (or those named in `selected`; see `modes` for
+    `jit`).  Return a dict of each mode's problems.  With `update`, record the
+    modes' timings and memory as the new baselines instead of checking them.
+    """
+    baselines = load_baselines(path)
+    problems = {}
+    for mode in modes(jit or bool(selected)):
+        name = mode_name(mode)
+        if selected and name not in selected:
+            continue
+        result = run_mode(mode, nhosp, seed)
+        ref = run_mode(reference(mode), nhosp, seed)
+        problems[name] = compare(result, ref)
+        base = baselines.get(name)
+        if update and 'error' not in result and 'error' not in ref:
+            baselines[name] = baseline(result, ref, nhosp)
+        elif base and base['nhosp'] == nhosp:
+            problems[name] += regressions(result, ref, base)
+    if update:
+        with open(path, 'w') as out:
+            json.dump(baselines, out, indent=2, sort_keys=True)
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('modes', nargs='*', help='e.g. nojit-serial-exact-scs')
+    parser.add_argument('--nhosp', type=int, default=NHOSP)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--jit', action='store_true',
+                        help='include the JIT modes')
+    parser.add_argument('--update', action='store_true',
+                        help='record new baselines')
+    args = parser.parse_args()
+
+    problems = check(args.modes, args.nhosp, args.seed, args.update,
+                     jit=args.jit)
+    for mode in modes(jit=True):
+        name = mode_name(mode)
+        if name not in problems:
+            continue
+        found, result = problems[name], run_mode(mode, args.nhosp, args.seed)
+        timing = ('' if 'error' in result else
+                  f"{result['seconds']:8.2f}s "
+                  f"{result['peak_rss_bytes'] / 2**20:7.0f}MB")
+        print(f"{name:28} {timing:18} {'; '.join(found) or 'ok'}")
+    sys.exit(any(problems.values()))
@@ -1,8 +1,11 @@
-from io import BytesIO
+import os
 from hashlib import sha1
-from os.path import isdir, join, abspath, dirname
+from os.path import isdir, isfile, join, abspath
 from zipfile import ZipFile, ZIP_DEFLATED
-from urllib.request import urlopen
+from urllib.request import urlopen, Request
+from urllib.error import HTTPError
+from http.client import HTTPException
+from concurrent.futures import ThreadPoolExecutor
 
 import hydrus.constants as c
 
@@ -27,36 +30,113 @@ URL = (
 
 DEST = c.IN if isdir(c.IN) else '.'
 
+# (blob, filename, SHA1) for each quarter's SAS input file.
+FILES = [
+    (
+        1228890641889,
+        'SAS_All_Data_Dec2016_suppressd.zip',
+        '8b9a23afd3e9b88427aa9932557d17cd0b4be640',
+    ),
+    (
+        1228890620679,
+        'SAS_Data-Input_Oct2016.zip',
+        '62ab0e94811842f3212196e203cd95374fbb10d4',
+    ),
+    ]
+
+CHUNK_SIZE = 1 << 20
+RETRIES = 3
+
+
+def file_sha1(path, hash=None):
+    """Hash the file at `path` (continuing `hash` if given) in chunks."""
+    hash = hash or sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK_SIZE), b''):
+            hash.update(chunk)
+    return hash
+
+
+def fetch(url, path, exp_hash, retries=RETRIES):
+    """
+    Download `url` to `path`, hashing it as it arrives.  Data is written to
+    `path + '.part'` first; an interrupted download resumes from there with
+    an HTTP range request (on this call's next retry, or on a later call).
+    Skip the download if `path` already exists with the expected hash.
+    """
+    if isfile(path) and file_sha1(path).hexdigest() == exp_hash:
+        return False
+    part = path + '.part'
+    for attempt in range(retries + 1):
+        try:
+            hash = _fetch_part(url, part)
+            break
+        except (OSError, HTTPException) as e:
+            if attempt == retries:
+                raise
+            print(f'Retrying {os.path.basename(path)} after error: {e}')
+
+    if hash.hexdigest() != exp_hash:
+        os.remove(part)
+        raise WrongSha1Error("Incorrect SHA1 hash.")
+    os.replace(part, path)
+    return True
 
-def download_cms_data(blob, filename, exp_hash):
-    url = URL.format(blob=blob, filename=filename)
+
+def _fetch_part(url, part):
+    """
+    Download `url` to the partial file `part`, resuming if possible.  Return
+    the SHA1 hash object for the whole file.
+    """
+    have = os.path.getsize(part) if isfile(part) else 0
+    req = Request(url)
+    if have:
+        req.add_header('Range', f'bytes={have}-')
+    try:
+        remote = urlopen(req)
+    except HTTPError as e:
+        if e.code == 416:  # nothing left to fetch
+            return file_sha1(part)
+        raise
+    with remote:
+        if remote.getcode() == 206:
+            hash, mode = file_sha1(part), 'ab'
+        else:  # the server ignored the range, so start over
+            hash, mode = sha1(), 'wb'
+        with open(part, mode) as out:
+            for chunk in iter(lambda: remote.read(CHUNK_SIZE), b''):
+                hash.update(chunk)
+                out.write(chunk)
+        if remote.length:  # bytes promised by Content-Length but not sent
+            raise ConnectionError(f'connection closed {remote.length} bytes '
+                                  'short')
+    return hash
+
+
+def download_cms_data(blob, filename, exp_hash, url=URL, dest=DEST):
+    url = url.format(blob=blob, filename=filename)
+    path = join(dest, filename)
     print('Downloading', filename)
     try:
-        with urlopen(url) as remote:
-            with BytesIO() as bio:
-                bio.write(remote.read())
-                bio.seek(0)
-                hash = sha1(bio.read()).hexdigest()
-                if hash == exp_hash:
-                    print('Extracting to', abspath(DEST))
-                    with ZipFile(bio, compression=ZIP_DEFLATED) as z:
-                        z.extractall(path=DEST)
-                else:
-                    raise WrongSha1Error("Incorrect SHA1 hash.")
+        if not fetch(url, path, exp_hash):
+            print(filename, 'already downloaded.')
+        print('Extracting to', abspath(dest))
+        with ZipFile(path, compression=ZIP_DEFLATED) as z:
+            z.extractall(path=dest)
     except Exception as e:
         print('Download failed:', e)
+        return False
     else:
         print('Download complete.', end='\n\n')
+        return True
+
+
+def download_all(files=FILES, max_workers=4, **kwargs):
+    """Download and extract several files concurrently."""
+    with ThreadPoolExecutor(max_workers) as pool:
+        futures = [pool.submit(download_cms_data, *x, **kwargs) for x in files]
+        return [f.result() for f in futures]
 
 
 if __name__ == '__main__':
-    download_cms_data(
-        1228890641889,
-        'SAS_All_Data_Dec2016_suppressd.zip',
-        '8b9a23afd3e9b88427aa9932557d17cd0b4be640',
-        )
-    download_cms_data(
-        1228890620679,
-        'SAS_Data-Input_Oct2016.zip',
-        '62ab0e94811842f3212196e203cd95374fbb10d4',
-        )
+    download_all()
@@ -18,120 +18,227 @@ import os
 import logging
 import pickle
 from time import time
-from functools import reduce
+from types import SimpleNamespace
 
-from numpy import vstack, where, nan
-from pandas import DataFrame, merge
+import numpy as np
+from numpy import vstack
+from pandas import DataFrame
 from sklearn.cluster import KMeans
 
 from hydrus import constants
-from hydrus.utility import set_config, winsorize, dump_pickle
+from hydrus.utility import set_config, dump_pickle
+from hydrus.instrument import RunReport
 from hydrus.preprocess import preprocess
 from hydrus.model import oserial, oparallel
+from hydrus.fused import ofused
+from hydrus.multistart import omultistart
+from hydrus.threaded import othreaded
+from hydrus.distributed import odistributed
 from hydrus.rapidclus import rapidclus
-
-
-def merge_on_index(df1, df2):
-    return merge(df1, df2, left_index=True, right_index=True)
-
-
-def save(df, folder, outfile):
-    f = os.path.join(folder, f'{outfile}.csv')
-    df.to_csv(f, float_format='%.5f')
-
-
-def summarize(df, group_weights):
-    """Combine LVM group scores into hospital summary scores."""
-    # Add CMS's predefined group-level weights.
-    w = DataFrame(index=df.index)
-    for k, v in group_weights:
-        w[k] = v
-
+from hydrus.store import ResultsStore, write_csv
+from hydrus.margins import star_margins
+
+
+def group_score_matrix(std_data, final_meas, pdfs, cfg):
+    """
+    Return the group scores in `pdfs` as one nhosp x ngroups array, in the
+    order of `std_data`'s index and `cfg.GROUPS`, with NAN for hospitals that
+    have no data in a group.
+    """
+    index = std_data.index
+    scores = np.full((len(index), len(cfg.GROUPS)), np.nan)
+    for j, (g, pdf) in enumerate(zip(cfg.GROUPS, pdfs)):
+        if not pdf.index.equals(index):
+            pdf = pdf.reindex(index)
+        nums = std_data[final_meas[g][0]].values
+        has_data = (nums == nums).any(axis=1)  # hosps with >=1 meas
+        np.copyto(scores[:, j], pdf.values[:, 0], where=has_data)
+    return scores
+
+
+def summarize_scores(scores, group_weights):
+    """
+    Combine an nhosp x ngroups array of group scores (in the order of
+    `group_weights`) into summary scores.  Return the summary scores and the
+    winsorized summary scores.
+    """
     # Rebalance group weights for hospitals that have missing scores.
     # E.g. if efficiency is missing, change mortality from 22/100 to 22/96.
-    nn = df.notnull()
-    nnw = w[nn]
-    wdf = DataFrame(
-        where(nn, w.values / vstack(nnw.sum(axis=1)), nan),
-        columns=df.columns,
-        index=df.index,
-        )
+    present = ~np.isnan(scores)
+    w = np.where(present, [v for _, v in group_weights], 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w /= w.sum(axis=1, keepdims=True)
 
     # Combine the weighted group scores.
-    weighted = where(wdf.notnull(), wdf * df, 0)
-    df['summary'] = weighted.sum(axis=1)
+    summary = np.where(present, w * scores, 0).sum(axis=1)
+
+    # Winsorize summary scores at 0.5 and 99.5 percentiles (rounding their
+    # ranks down and up respectively).
+    i = int(np.floor(.005 * (len(summary) - 1)))
+    j = int(np.ceil(.995 * (len(summary) - 1)))
+    lo, hi = np.partition(summary, [i, j])[[i, j]]
+    return summary, np.clip(summary, lo, hi)
 
-    # Winsorize summary scores at 0.5 and 99.5 percentiles.
-    lo = df['summary'].quantile(.005, interpolation='lower')
-    hi = df['summary'].quantile(.995, interpolation='higher')
-    df['summary_win'] = df['summary'].map(lambda x: winsorize(x, lo=lo, hi=hi))
 
+def summarize(df, group_weights):
+    """Combine LVM group scores into hospital summary scores."""
+    summary, summary_win = summarize_scores(
+        df[[k for k, _ in group_weights]].values, group_weights)
+    df['summary'] = summary
+    df['summary_win'] = summary_win
     return df
 
 
-def cluster_kmeans(scores, cfg=None):
-    """Calculate star ratings via k-means."""
+def cluster_kmeans(scores, cfg=None, return_centers=False):
+    """
+    Calculate star ratings via k-means.  If `return_centers`, also return the
+    sorted cluster centers.
+    """
     if cfg is None:
         cfg = constants
-    kmeans = KMeans(n_clusters=5, tol=1e-10, n_init=50)
+    kmeans = KMeans(
+        n_clusters=5, tol=1e-10, n_init=50, random_state=cfg.KMEANS_SEED)
     kfit = kmeans.fit(vstack(scores))
     centers = [x[0] for x in kfit.cluster_centers_]
     names = dict(zip(sorted(centers), cfg.CLUSTER_NAMES))
     cid_to_name = {i: names[x] for i, x in enumerate(centers)}
-    return [cid_to_name[x] for x in kfit.labels_]
+    stars = [cid_to_name[x] for x in kfit.labels_]
+    return (stars, sorted(centers)) if return_centers else stars
 
 
-def cluster_scs(scores, cfg=None):
-    """Calculate star ratings via Simple Cluster Seeking."""
+def cluster_scs(scores, cfg=None, return_centers=False):
+    """
+    Calculate star ratings via Simple Cluster Seeking.  If `return_centers`,
+    also return the sorted cluster centers.
+    """
     if cfg is None:
         cfg = constants
     cluster_assignments = rapidclus(scores)
     sorted_centers = sorted(set(cluster_assignments))
     names = dict(zip(sorted_centers, cfg.CLUSTER_NAMES))
-    return [names[x] for x in cluster_assignments]
+    stars = [names[x] for x in cluster_assignments]
+    return (stars, sorted_centers) if return_centers else stars
+
+
+def seeded(cfg):
+    """
+    Return `cfg`, or a copy of it with a `KMEANS_SEED`.  For comparing the
+    star ratings of two runs, which could otherwise differ by where k-means
+    happened to start.
+    """
+    if cfg.KMEANS_SEED is not None or cfg.RAPIDCLUS:
+        return cfg
+    new = SimpleNamespace(**vars(cfg))
+    new.KMEANS_SEED = 0
+    return new
+
+
+def store_results(summ_scores, est_dfs, run, cfg):
+    """Append a run's results to `cfg.RESULTS_STORE`, if PyTables is
+    available."""
+    path = os.path.join(cfg.OUT, cfg.RESULTS_STORE)
+    try:
+        with ResultsStore(path) as store:
+            store.append_run(run, summ_scores, est_dfs, cfg)
+    except ImportError as e:
+        logging.warning(f'results not added to {path}: {e}')
+    else:
+        logging.info(f'results added to {path} as run {run}')
 
 
-def main(outdir=None, cfg=None):
+def make_outfolder(outdir, cfg):
+    """Create and return the folder for a run's output files."""
+    if not os.path.exists(cfg.OUT):
+        os.mkdir(cfg.OUT)
+    folder = os.path.join(cfg.OUT, outdir)
+    os.mkdir(folder)
+    return folder
+
+
+def executor(cfg):
+    """Return the function that calculates the group scores for `cfg`."""
+    if cfg.FUSED:
+        return ofused
+    if cfg.MULTISTART > 1:
+        return omultistart
+    if cfg.NODES:
+        return odistributed
+    if cfg.THREADS:
+        return othreaded
+    return oparallel if cfg.MULTIPROCESSING else oserial
+
+
+def rate(std_data, final_meas, pdfs, cfg, report=None, return_centers=False):
+    """
+    Combine the group scores in `pdfs` into summary scores and star ratings.
+    If `return_centers`, also return the sorted cluster centers.
+    """
+    if report is None:
+        report = RunReport()
+
+    # Work on one array of group scores; make a DataFrame only at the end.
+    with report.stage('summarize'):
+        scores = group_score_matrix(std_data, final_meas, pdfs, cfg)
+        weights = [(g, dict(cfg.GROUP_WEIGHTS)[g]) for g in cfg.GROUPS]
+        summary, summary_win = summarize_scores(scores, weights)
+    cfunc = cluster_scs if cfg.RAPIDCLUS else cluster_kmeans
+    with report.stage('cluster'):
+        stars, centers = cfunc(summary_win, cfg=cfg, return_centers=True)
+
+    summ_scores = DataFrame(scores, index=std_data.index, columns=cfg.GROUPS)
+    summ_scores['summary'] = summary
+    summ_scores['summary_win'] = summary_win
+    summ_scores['cluster_name'] = stars
+    return (summ_scores, centers) if return_centers else summ_scores
+
+
+def main(outdir=None, cfg=None, report=None, data=None):
     STARTTIME = int(time())
     if cfg is None:
         cfg = set_config()
-    std_data, final_meas = preprocess(cfg=cfg)
+    if report is None:
+        report = RunReport()
+    if cfg.CORRECTIONS:
+        from hydrus.corrections import corrections_main
+        return corrections_main(outdir, cfg, report, data)
+    if cfg.STRATUM:
+        from hydrus.strata import stratified_main
+        return stratified_main(outdir, cfg, report, data)
+    if cfg.PIPELINED:
+        from hydrus.dag import pipeline
+        return pipeline(outdir, cfg, report, data)
+    std_data, final_meas = preprocess(cfg=cfg, report=report, data=data)
 
     # Calculate group-level hospital scores.
     # with CfgTempfile(cfg) as tmpcfg:
-    outcf = oparallel if cfg.MULTIPROCESSING else oserial
-    edfs, pdfs = outcf(std_data, final_meas, cfg=cfg)
-
-    # If a hospital has no data in a group, replace their score with NAN.
-    for g, pdf in zip(cfg.GROUPS, pdfs):
-        grp_nums = std_data[final_meas[g][0]]
-        gt0 = grp_nums.notnull().sum(axis=1).map(bool)  # hosps with >=1 meas
-        pdf[g] = where(vstack(~gt0), nan, pdf)
+    with report.stage('lvm'):
+        edfs, pdfs = executor(cfg)(std_data, final_meas, cfg=cfg, report=report)
 
     # Calculate hospital summary scores and star ratings.
-    all_group_scores = reduce(merge_on_index, pdfs)
-    summ_scores = summarize(all_group_scores, cfg.GROUP_WEIGHTS)
-    cfunc = cluster_scs if cfg.RAPIDCLUS else cluster_kmeans
-    summ_scores['cluster_name'] = cfunc(summ_scores['summary_win'], cfg=cfg)
+    summ_scores, centers = rate(
+        std_data, final_meas, pdfs, cfg, report, return_centers=True)
+    with report.stage('margins'):
+        margins = star_margins(summ_scores, centers, cfg)
 
     # Write results to disk.
     if cfg.WRITE_NOTHING:
         return summ_scores
     if outdir is None:
         outdir = str(STARTTIME)
-    if not os.path.exists(cfg.OUT):
-        os.mkdir(cfg.OUT)
-    OUTFOLDER = os.path.join(cfg.OUT, outdir)
-    os.mkdir(OUTFOLDER)
-
-    for name, edf in zip(cfg.GROUPS, edfs):
-        save(edf, OUTFOLDER, cfg.EST_FILE.format(name))
-
-    output = summ_scores.copy()
-    output.columns = [dict(cfg.FRIENDLY_NAMES)[x] for x in output.columns]
-    save(output, OUTFOLDER, cfg.STAR_FILE)
+    OUTFOLDER = make_outfolder(outdir, cfg)
+
+    if cfg.WRITE_CSV:
+        with report.stage('write_csv'):
+            write_csv(summ_scores, edfs, OUTFOLDER, cfg)
+            margins.to_csv(
+                os.path.join(OUTFOLDER, f'{cfg.MARGIN_FILE}.csv'),
+                float_format='%.5f')
+    if cfg.RESULTS_STORE:
+        with report.stage('write_store'):
+            store_results(summ_scores, edfs, outdir, cfg)
     if cfg.SAVE_DEBUG:
         dump_pickle(cfg, os.path.join(OUTFOLDER, 'config.pkl'))
+    report.save(OUTFOLDER, cfg.REPORT_FILE)
 
     full_duration = int(time()) - STARTTIME
     logging.info(f'script completed in {full_duration:,} seconds')
@@ -0,0 +1,192 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Out-of-core LVM fitting.
+
+`ChunkedLvm` keeps the scores and weights in memory-mapped files and walks
+them in blocks of `CHUNK_ROWS` hospitals, accumulating the loglikelihood and
+its gradient block by block.  Predictions are streamed to another memory-
+mapped file.  The LVM's own memory (its copies of the data and the
+likelihood's temporaries) therefore depends on the block size rather than on
+the number of hospitals.
+
+With `CHUNKED`, `outcomes` writes each group's scores and weights straight
+from the standardized data to the files, a block at a time (see
+`group_memmaps`), so no whole group's inputs are ever in memory either.  But
+a run through `main` still reads, cleans and standardizes the whole file in
+memory; to fit data that doesn't fit in memory, pass memory-mapped arrays
+to `ChunkedLvm` directly.
+"""
+import os
+import shutil
+import weakref
+import tempfile
+from time import perf_counter
+
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.optimize import minimize
+
+from hydrus import constants
+from hydrus.model import (
+    Lvm, adaptive_qcount, ll_adaptive, ll_exact, ll_grad_exact, ll_quad)
+
+
+def to_memmap(x, path, chunk_rows):
+    """
+    Copy the 2-D array or DataFrame `x` to a new float64 `.npy` file at `path`
+    one block of rows at a time, and return the file memory-mapped.
+    """
+    out = open_memmap(path, mode='w+', dtype=np.float64, shape=x.shape)
+    x = getattr(x, 'values', x)
+    for i in range(0, x.shape[0], chunk_rows):
+        out[i:i+chunk_rows] = x[i:i+chunk_rows]
+    out.flush()
+    return out
+
+
+def group_memmaps(data, meas_filter, folder, chunk_rows):
+    """
+    Write a measure group's LVM scores and weights (see `group_inputs`) from
+    the standardized `data` to new `.npy` files in `folder`, `chunk_rows`
+    hospitals at a time, and return them memory-mapped.
+    """
+    grp_nums, grp_denoms = meas_filter
+    # The weights' column totals, one column at a time.
+    counts = np.array([data[x].count() for x in grp_nums])
+    totals = np.array([data[x].sum() for x in grp_denoms])
+    shape = len(data), len(grp_nums)
+    z, w = (open_memmap(os.path.join(folder, f'{x}.npy'), mode='w+',
+                        dtype=np.float64, shape=shape) for x in 'zw')
+    for i in range(0, len(data), chunk_rows):
+        block = data.iloc[i:i+chunk_rows]
+        z[i:i+chunk_rows] = block[grp_nums].values
+        w[i:i+chunk_rows] = block[grp_denoms].values / totals * counts
+    z.flush()
+    w.flush()
+    return z, w
+
+
+def is_memmap(x):
+    return isinstance(x, np.memmap) and x.dtype == np.float64
+
+
+class ChunkedLvm(Lvm):
+    """
+    A variant of `Lvm` that never holds more than `CHUNK_ROWS` hospitals' data
+    in memory at once (though its caller may; see above).
+
+    `z` and `w` may be DataFrames, arrays, or (to avoid ever loading them)
+    float64 memory-mapped arrays, e.g. from `numpy.load(..., mmap_mode='r')`.
+    Anything that isn't already memory-mapped is copied to `CHUNK_DIR`.
+    """
+    def __init__(self, z, w, name='', quadrature=None, cfg=None):
+        super().__init__(z, w, name, quadrature, cfg)
+        if self.ests_ll == self.ests_ll_exact:
+            self.ests_jac = True  # `ests_obj` returns the gradient as well
+
+    @classmethod
+    def from_data(cls, data, meas_filter, name='', cfg=None):
+        """Return the LVM for a measure group of the standardized `data`,
+        whose inputs go straight to disk (see `group_memmaps`)."""
+        settings = cfg or constants
+        folder = tempfile.mkdtemp(prefix='hydrus_', dir=settings.CHUNK_DIR)
+        try:
+            z, w = group_memmaps(
+                data, meas_filter, folder, settings.CHUNK_ROWS)
+            lvm = cls(z, w, name, cfg=cfg)
+        except BaseException:
+            shutil.rmtree(folder, True)
+            raise
+        weakref.finalize(lvm, shutil.rmtree, folder, True)
+        return lvm
+
+    def set_data(self, z, w):
+        self.chunk_rows = self.cfg.CHUNK_ROWS
+        self.folder = tempfile.mkdtemp(
+            prefix='hydrus_', dir=self.cfg.CHUNK_DIR)
+        weakref.finalize(self, shutil.rmtree, self.folder, True)
+        self.z = z if is_memmap(z) else to_memmap(
+            z, os.path.join(self.folder, 'z.npy'), self.chunk_rows)
+        self.w = w if is_memmap(w) else to_memmap(
+            w, os.path.join(self.folder, 'w.npy'), self.chunk_rows)
+
+    def blocks(self):
+        """Yield each block of (scores, weights) as in-memory arrays."""
+        for i in range(0, self.n, self.chunk_rows):
+            yield (np.array(self.z[i:i+self.chunk_rows]),
+                   np.array(self.w[i:i+self.chunk_rows]))
+
+    def ests_ll_quad(self, params):
+        return np.concatenate([
+            ll_quad(params, z, w, self.cfg.QCOUNT) for z, w in self.blocks()])
+
+    def ests_ll_adaptive(self, params):
+        if self.qcount is None:  # enough nodes for every block
+            self.qcount = max(
+                adaptive_qcount(
+                    params, z, w, self.cfg.QUAD_TOL, self.cfg.QCOUNT)
+                for z, w in self.blocks())
+        return np.concatenate([
+            ll_adaptive(params, z, w, self.qcount) for z, w in self.blocks()])
+
+    def ests_ll_exact(self, params):
+        return np.concatenate([
+            ll_exact(params, np.nan_to_num(z), np.nan_to_num(w))
+            for z, w in self.blocks()])
+
+    def ests_obj(self, params):
+        """
+        The objective function to minimize for the model parameters.  For the
+        exact integral, also return its gradient so that each optimizer step
+        needs only one pass over the data.
+        """
+        if not self.ests_jac:
+            return super().ests_obj(params)
+        t0 = perf_counter()
+        obj, grad = 0., np.zeros_like(params)
+        for z, w in self.blocks():
+            num2, w2 = np.nan_to_num(z), np.nan_to_num(w)
+            obj -= np.nansum(ll_exact(params, num2, w2))
+            grad -= ll_grad_exact(params, num2, w2)
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return obj, grad
+
+    def predict(self, outfile=None):
+        """
+        Predict the random effects, writing them block by block to the `.npy`
+        file `outfile`.  Return the file memory-mapped.
+        """
+        if outfile is None:
+            outfile = os.path.join(self.folder, 'preds.npy')
+        out = open_memmap(
+            outfile, mode='w+', dtype=np.float64, shape=(self.n,))
+        nfev, i = 0, 0
+        for z, w in self.blocks():
+            for num0, w0 in zip(z, w):
+                res = minimize(
+                    self.preds_obj, [0.],
+                    ([*self.final_ests, num0, w0],), "L-BFGS-B",
+                    )
+                out[i] = res.x[0]
+                nfev += res.nfev
+                i += 1
+            out.flush()
+        self.preds_stats = {'obj_evals': nfev}
+        self.final_preds = out
+        return self.final_preds
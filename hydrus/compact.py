@@ -0,0 +1,161 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Single-precision, compact storage for the LVM.
+
+`Lvm` keeps four float64 copies of a group's data (scores and weights, each
+with and without NANs).  `CompactLvm` keeps one float32 matrix each of scores
+and weights (NANs replaced by zero) plus a bit-packed mask of the cells where
+both are observed, i.e. a little over a quarter of the memory.  The exact
+loglikelihood and its gradient are computed in float32, with the sums over
+measures and hospitals accumulated in float64.
+"""
+from time import perf_counter
+
+import numpy as np
+from scipy.optimize import minimize
+
+from hydrus.model import Lvm, LOG2PI, ll_quad
+
+
+F4, F8 = np.float32, np.float64
+
+
+def terms32(params, vals, wts):
+    """
+    Calculate the intermediate terms of the exact loglikelihood (see
+    `ll_exact`) for float32 scores `vals` and weights `wts`.  The elementwise
+    work is done in float32 and the row sums are accumulated in float64.
+    """
+    mu, gamma, err = (x.astype(F4) for x in np.split(params, 3))
+    d = vals - mu
+    q = wts / err**2
+    r = d * q
+
+    f = (wts * (2 * np.log(abs(err)) + F4(LOG2PI))).sum(axis=1, dtype=F8)
+    a = (q * gamma**2).sum(axis=1, dtype=F8)
+    b = (r * gamma).sum(axis=1, dtype=F8)
+    c = (d * r).sum(axis=1, dtype=F8)
+    ll = .5 * (b * b / (a+1) - c - f - np.log1p(a))
+
+    return ll, d, q, r, a, b
+
+
+def ll_exact32(params, vals, wts):
+    """Single-precision version of `ll_exact`.  Return float64 values."""
+    return terms32(params, vals, wts)[0]
+
+
+def ll_obj_grad32(params, vals, wts):
+    """
+    Return the total exact loglikelihood and its gradient (as in
+    `ll_grad_exact`), computed from float32 data.
+    """
+    ll, d, q, r, a, b = terms32(params, vals, wts)
+    _, gamma, err = np.split(params, 3)
+
+    # Column sums over hospitals, accumulated in float64.
+    def colsum(x, v=None):
+        return (x if v is None else x * v[:, None]).sum(axis=0, dtype=F8)
+
+    s = (1 / (a+1)).astype(F4)
+    bs = (b / (a+1)).astype(F4)
+    rbs, qbs2, qs = colsum(r, bs), colsum(q, bs * bs), colsum(q, s)
+
+    g_mu = colsum(r) - gamma * colsum(q, bs)
+    g_gamma = rbs - gamma * (qbs2 + qs)
+    g_err = (
+        gamma**2 * (qbs2 + qs) - 2 * gamma * rbs
+        + colsum(d * r) - colsum(wts)
+        ) / err
+
+    return np.nansum(ll), np.concatenate([g_mu, g_gamma, g_err])
+
+
+class CompactLvm(Lvm):
+    """
+    A variant of `Lvm` that stores its data in single precision with a
+    bit-packed observation mask.
+
+    With the exact integral, the objective function returns its analytic
+    gradient: float32 rounding makes finite-difference gradients useless.
+    Quadrature (which has no analytic gradient here) is evaluated in float64
+    from the compact data.
+    """
+    def __init__(self, z, w, name='', quadrature=None, cfg=None):
+        super().__init__(z, w, name, quadrature, cfg)
+        if self.ests_ll == self.ests_ll_exact:
+            self.ests_jac = True  # `ests_obj` returns the gradient as well
+
+    def set_data(self, z, w):
+        z = z.values if hasattr(z, 'values') else z
+        w = w.values if hasattr(w, 'values') else w
+        self.nmeas = z.shape[1]
+        self.vals = np.nan_to_num(z).astype(F4)
+        self.wts = np.nan_to_num(w).astype(F4)
+        self.mask = np.packbits(~(np.isnan(z) | np.isnan(w)), axis=1)
+
+    def observed(self, rows=slice(None)):
+        """Return the observation mask for `rows` as booleans."""
+        bits = np.unpackbits(self.mask[rows], axis=-1)
+        return bits[..., :self.nmeas].astype(bool)
+
+    def expand(self, x, rows=slice(None)):
+        """Return `x[rows]` as float64, with NAN where cells are missing."""
+        return np.where(self.observed(rows), x[rows].astype(F8), np.nan)
+
+    @property
+    def z(self):
+        return self.expand(self.vals)
+
+    @property
+    def w(self):
+        return self.expand(self.wts)
+
+    def ests_ll_quad(self, params):
+        return ll_quad(params, self.z, self.w, self.cfg.QCOUNT)
+
+    def ests_ll_exact(self, params):
+        return ll_exact32(params, self.vals, self.wts)
+
+    def ests_obj(self, params):
+        """
+        The objective function to minimize for the model parameters, and (for
+        the exact integral) its gradient.
+        """
+        if not self.ests_jac:
+            return super().ests_obj(params)
+        t0 = perf_counter()
+        ll, grad = ll_obj_grad32(params, self.vals, self.wts)
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return -ll, -grad
+
+    def predict(self):
+        """Predict the random effects, one hospital row at a time."""
+        out, nfev = [], 0
+        for i in range(self.n):
+            num0, w0 = self.expand(self.vals, i), self.expand(self.wts, i)
+            res = minimize(
+                self.preds_obj, [0.],
+                ([*self.final_ests, num0, w0],), "L-BFGS-B",
+                )
+            out.append(res.x[0])
+            nfev += res.nfev
+        self.preds_stats = {'obj_evals': nfev}
+        self.final_preds = np.array(out)
+        return self.final_preds
@@ -25,9 +25,74 @@ JIT = True
 # Set to False to turn off multiprocessing (e.g. for use with cProfile).
 MULTIPROCESSING = True
 
+# Memory the process pool may use, in bytes: each process fits one group at
+# a time, and there are only as many as fit (see `hydrus.memory`).  None for
+# MEMORY_FRACTION of what's available (the cgroup limit or MemAvailable).
+MEMORY_BUDGET = None
+MEMORY_FRACTION = .8
+
+# Set to True to fit the groups on threads in one process, with GIL-free JIT
+# kernels, instead of on a process pool.  Takes precedence over
+# MULTIPROCESSING.
+THREADS = False
+
+# Set to True to fit all groups' LVMs in a single optimizer call (exact
+# integral only).  Takes precedence over MULTIPROCESSING.
+FUSED = False
+
+# Number of starting points per group for multi-start estimation (0 for the
+# usual single start), and the number of iterations each start gets before
+# the worse half of them are dropped.
+MULTISTART = 0
+MULTISTART_BUDGET = 20
+
+# Worker nodes to fit the LVMs on (see `hydrus.distributed`): a list of
+# 'host:port' addresses, or a number of local worker processes to start.
+# None to fit on this machine.  Exact integral only.  Takes precedence over
+# THREADS and MULTIPROCESSING.  NODE_AUTHKEY is the key the nodes share
+# (None to read it from the HYDRUS_AUTHKEY environment variable); local
+# worker processes get a random one.
+NODES = None
+NODE_AUTHKEY = None
+
+# Set to True to run `main` as a graph of tasks (see `hydrus.dag`): each
+# group's LVM is fitted as soon as its measures are standardized, and output
+# is written while later tasks run.  Not with FUSED or MULTISTART.
+PIPELINED = False
+
+# Set to the name of a raw data column to rate hospitals within each of its
+# values (strata) instead of all together (see `hydrus.strata`).
+STRATUM = None
+
+# Set to the path of a CSV file of corrections to the raw data (columns
+# PROVIDER_ID, measure, value, denominator) to apply them to the last run
+# saved in OUT/BASELINE_FILE, refitting only the groups they change (see
+# `hydrus.corrections`).
+CORRECTIONS = None
+
+# Set to True to fit each LVM out-of-core, from memory-mapped files processed
+# CHUNK_ROWS hospitals at a time, written there from the standardized data a
+# block at a time.  This bounds the LVMs' memory only: the data are still
+# preprocessed in memory.  CHUNK_DIR is where the files are kept (None for
+# the system's temporary directory).
+CHUNKED = False
+CHUNK_ROWS = 100000
+CHUNK_DIR = None
+
+# Set to True to store each LVM's data as float32 with a bit-packed mask of
+# observed values, roughly halving memory traffic per likelihood evaluation.
+COMPACT = False
+
 # Number of quadrature points to use in "old" integral:
 QCOUNT = 30
 
+# Set to True to use adaptive quadrature (nodes centered and scaled on each
+# hospital's posterior for alpha) instead of QCOUNT fixed nodes.  The number
+# of nodes is the smallest that changes the total loglikelihood by less than
+# QUAD_TOL.
+ADAPTIVE_QUADRATURE = False
+QUAD_TOL = 1e-8
+
 # Convergence criteria for LVM minimization:
 TOL = 1e-15
 
@@ -39,12 +104,38 @@ INITIAL_LVM_PARAMS = 0.025, 0.500, 0.880
 QUAD_BOUNDS = ((None, None), (None, None), (1e-3, None))
 EXACT_BOUNDS = ((None, None), (None, None), (1e-3, None))
 
+# Preprocessing rules, as CMS specifies them: measures are dropped unless at
+# least MIN_HOSPITALS hospitals have data, z-scores are winsorized at
+# WINSOR_LIMITS, and IMM-3 and OP-27 are combined into one measure.  (See
+# `hydrus.sweep` to compare other choices.)
+MIN_HOSPITALS = 101
+WINSOR_LIMITS = -3., 3.
+COMBINE_IMM3_OP27 = True
+
 # Set to True to skip saving output to disk.
 WRITE_NOTHING = False
 
 # Output file names.
 EST_FILE = 'model_parameters_{}'
 STAR_FILE = 'star_ratings'
+REPORT_FILE = 'run_report'
+INFLUENCE_FILE = 'measure_influence'
+MARGIN_FILE = 'star_margins'
+SWEEP_FILE = 'preprocessing_sweep'
+STRATA_FILE = 'stratified_star_ratings'
+MOVERS_FILE = 'star_movers'
+BASELINE_FILE = 'correction_baseline'
+
+# Each run's results are appended to this HDF5 file in `OUT` (see
+# `hydrus.store`; needs PyTables).  Set to None to skip it.
+RESULTS_STORE = 'results.h5'
+
+# Set to False to skip writing each run's results as CSV files.
+WRITE_CSV = True
+
+# The quarter that results are filed under in `RESULTS_STORE`.  If None, it
+# is taken from the measure settings file name, e.g. '2016_12'.
+QUARTER = None
 
 # Mapping for column names in the SAS file or created within the script:
 FRIENDLY_NAMES = (
@@ -65,8 +156,17 @@ FRIENDLY_NAMES = (
 # CLUSTER_NAMES = ['1*', '2*', '3*', '4*', '5*']
 CLUSTER_NAMES = list(range(1, 6))
 
+# Seed for the random starts of k-means (when not RAPIDCLUS), so the same
+# summary scores always get the same star ratings.  None for new starts on
+# every run.
+KMEANS_SEED = 0
+
 # Save Hydrus' configuration information along with the script results
 SAVE_DEBUG = False
 
+# Default number of hospitals in a synthetic data set (roughly the number in
+# a 2016 CMS release):
+SYNTH_NHOSP = 4500
+
 # Directories for input/output files:
 IN, OUT = 'input', 'output'
@@ -0,0 +1,323 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Rerun Hydrus after a few corrections to the raw data.
+
+A delta file lists the corrected cells, one per row: a hospital's
+PROVIDER_ID, a measure, and its new value and denominator.  Instead of
+rerunning everything, `correct` starts from the last run's `Baseline`:
+
+- the corrected raw data are cleaned again, which is cheap, to find which
+  cleaned cells changed (a denominator can mask a score, the patient
+  experience denominators depend on two raw columns, and so on);
+- each changed measure's count, mean and sum of squared deviations are
+  updated for just the changed cells, and only those measures are
+  standardized again;
+- only the groups with changed scores or denominators are refitted, each
+  starting from its previous parameters;
+- the summary scores and star ratings are recomputed, and the hospitals
+  whose star ratings moved are listed.
+
+If the corrections change which measures or hospitals qualify, every group
+is affected anyway, so everything is rerun.
+
+Set `CORRECTIONS` to the path of a delta file to run `main` this way, or run
+`python -m hydrus.corrections DELTA.csv`.  The baseline is kept in
+`OUT/BASELINE_FILE.pkl`, made by a full run the first time, and again
+whenever `INFILE` or the settings it was made with change (see
+`baseline_key`).
+"""
+import os
+import sys
+import pickle
+import logging
+from time import time
+from hashlib import sha1
+
+import numpy as np
+from pandas import read_csv
+
+from hydrus import constants
+from hydrus.utility import set_config, dump_pickle
+from hydrus.instrument import RunReport
+from hydrus.preprocess import clean, measure_columns, read_input, standardize
+from hydrus.model import outcomes
+from hydrus.margins import star_margins
+from hydrus.store import write_csv
+from hydrus.sweep import FIT_SETTINGS, PARAMS
+from hydrus.__main__ import executor, make_outfolder, rate, seeded
+
+
+DELTA_COLUMNS = ['PROVIDER_ID', 'measure', 'value', 'denominator']
+
+# The settings a baseline is made with, which a correction run must share to
+# start from it: the input file, how it's preprocessed and rated, and how the
+# LVMs are fitted.
+BASELINE_SETTINGS = (
+    'INFILE', 'MEASURE_SETTINGS', 'GROUPS', 'GROUP_WEIGHTS', *PARAMS,
+    'RAPIDCLUS', 'KMEANS_SEED', *FIT_SETTINGS)
+
+
+def baseline_key(cfg):
+    """Return a hash of the `BASELINE_SETTINGS` in `cfg` (seeded, as for a
+    correction run)."""
+    cfg = seeded(cfg)
+    values = [getattr(cfg, x, None) for x in BASELINE_SETTINGS]
+    return sha1(repr(values).encode()).hexdigest()
+
+
+def read_delta(path):
+    """Read a delta file of corrections."""
+    delta = read_csv(path, dtype={'PROVIDER_ID': str, 'measure': str})
+    missing = set(DELTA_COLUMNS) - set(delta.columns)
+    if missing:
+        raise ValueError(f'delta file {path} has no {sorted(missing)} columns')
+    return delta[DELTA_COLUMNS]
+
+
+def apply_delta(raw, delta):
+    """Return a copy of the raw data `raw` with the corrections in `delta`."""
+    unknown = set(delta['PROVIDER_ID']) - set(raw.index)
+    if unknown:
+        raise ValueError(f'corrections for unknown hospitals {sorted(unknown)}')
+    unknown = set(delta['measure']) - set(raw.columns)
+    if unknown:
+        raise ValueError(f'corrections to unknown measures {sorted(unknown)}')
+    raw = raw.copy()
+    for pid, measure, value, den in delta.itertuples(index=False):
+        raw.loc[pid, measure] = value
+        if f'{measure}_DEN' in raw.columns:
+            raw.loc[pid, f'{measure}_DEN'] = den
+        elif not np.isnan(den):
+            raise ValueError(f'{measure} has no denominator')
+    return raw
+
+
+def moments(col):
+    """Return the count, mean and sum of squared deviations of Series `col`,
+    matching its pandas mean and standard deviation."""
+    n = col.count()
+    return n, col.mean(), col.std() ** 2 * (n - 1)
+
+
+def update_moments(stats, old, new):
+    """
+    Return `moments` (n, mean, m2) updated for replacing the values `old` by
+    `new` (NAN for none).  Values are removed and added one at a time, as in
+    Welford's algorithm, so nothing is summed over the whole column again.
+    """
+    n, mean, m2 = stats
+    for x in old[~np.isnan(old)]:
+        if n == 1:
+            n, mean, m2 = 0, 0., 0.
+            continue
+        prev, n = mean, n - 1
+        mean = (prev * (n + 1) - x) / n
+        m2 -= (x - prev) * (x - mean)
+    for x in new[~np.isnan(new)]:
+        n += 1
+        d = x - mean
+        mean += d / n
+        m2 += d * (x - mean)
+    return n, mean, m2
+
+
+def mean_std(stats):
+    """Return each column's (mean, standard deviation) from its moments."""
+    return {x: (mean, np.sqrt(m2 / (n - 1)) if n > 1 else np.nan)
+            for x, (n, mean, m2) in stats.items()}
+
+
+def changed_cells(a, b):
+    """Return a DataFrame of which cells of `a` and `b` differ."""
+    return ~((a == b) | (a.isnull() & b.isnull()))
+
+
+def warm_start(est_df):
+    """Return a group's previous parameters, packed."""
+    return np.concatenate([est_df[x].values for x in ['mu', 'gamma', 'err']])
+
+
+class Baseline:
+    """
+    A run's state, to apply corrections to: the raw, cleaned and
+    standardized data, each measure's moments, the LVM estimates and
+    predictions, the summary scores and star ratings, and the `baseline_key`
+    of the settings it was made with.
+    """
+    def __init__(self, raw, cleaned, final_meas, stats, std_data, edfs, pdfs,
+                 summ_scores, centers, key):
+        self.raw, self.cleaned, self.final_meas = raw, cleaned, final_meas
+        self.stats, self.std_data = stats, std_data
+        self.edfs, self.pdfs = edfs, pdfs
+        self.summ_scores, self.centers = summ_scores, centers
+        self.key = key
+
+    @classmethod
+    def run(cls, raw, cfg, report=None):
+        """Run the whole pipeline on the raw data `raw`."""
+        if report is None:
+            report = RunReport()
+        cfg = seeded(cfg)
+        with report.stage('preprocess'):
+            cleaned, final_meas = clean(raw.copy(), cfg, report)
+            cols = measure_columns(cleaned)
+            stats = {x: moments(cleaned[x]) for x in cols}
+            std_data = standardize(cleaned.copy(), cols, cfg, mean_std(stats))
+        with report.stage('lvm'):
+            edfs, pdfs = executor(cfg)(
+                std_data, final_meas, cfg=cfg, report=report)
+        edfs, pdfs = list(edfs), list(pdfs)
+        summ_scores, centers = rate(
+            std_data, final_meas, pdfs, cfg, report, return_centers=True)
+        return cls(raw, cleaned, final_meas, stats, std_data, edfs, pdfs,
+                   summ_scores, centers, baseline_key(cfg))
+
+    def save(self, path):
+        dump_pickle(self, path)
+
+    @staticmethod
+    def load(path):
+        with open(path, 'rb') as infile:
+            return pickle.load(infile)
+
+
+def star_movers(old, new):
+    """
+    Return the hospitals whose star ratings differ between the summary
+    scores `old` and `new` (or that are in only one of them), with both
+    ratings and summary scores.
+    """
+    both = old[['summary', 'cluster_name']].join(
+        new[['summary', 'cluster_name']], how='outer', lsuffix='_old',
+        rsuffix='_new')
+    return both[both['cluster_name_old'] != both['cluster_name_new']]
+
+
+def correct(base, delta, cfg, report=None):
+    """
+    Apply the corrections in `delta` to the run `base`.  Return the new
+    `Baseline`, the star movers (see `star_movers`), and the groups refitted.
+    """
+    if report is None:
+        report = RunReport()
+    # Stars should move only if the corrections move them, not k-means.
+    cfg = seeded(cfg)
+    with report.stage('corrections/clean'):
+        raw = apply_delta(base.raw, delta)
+        cleaned, final_meas = clean(raw.copy(), cfg)
+
+    if (final_meas != base.final_meas or not cleaned.index.equals(
+            base.cleaned.index) or not cleaned.columns.equals(
+                base.cleaned.columns)):
+        logging.info('corrections change which measures or hospitals qualify;'
+                     ' rerunning everything')
+        new = Baseline.run(raw, cfg, report)
+        groups = list(cfg.GROUPS)
+    else:
+        with report.stage('corrections/standardize'):
+            changed = changed_cells(cleaned, base.cleaned)
+            cols = [x for x in cleaned.columns if changed[x].any()]
+            meas = [x for x in cols if x in base.stats]
+            stats = dict(base.stats)
+            for x in meas:
+                rows = changed[x].values
+                stats[x] = update_moments(
+                    stats[x], base.cleaned[x].values[rows],
+                    cleaned[x].values[rows])
+            std_data = base.std_data.copy()
+            std_data[cols] = standardize(
+                cleaned[cols].copy(), meas, cfg, mean_std(stats))
+
+        groups = [g for g in cfg.GROUPS
+                  if set(cols) & set(sum(final_meas[g], []))]
+        logging.info(f'{len(cols)} columns changed; refitting {groups}')
+        edfs, pdfs = list(base.edfs), list(base.pdfs)
+        with report.stage('corrections/lvm'):
+            for i, g in enumerate(cfg.GROUPS):
+                if g in groups:
+                    edfs[i], pdfs[i] = outcomes(
+                        std_data, final_meas[g], g, cfg, report,
+                        init=warm_start(base.edfs[i]))
+        summ_scores, centers = rate(
+            std_data, final_meas, pdfs, cfg, report, return_centers=True)
+        new = Baseline(raw, cleaned, final_meas, stats, std_data, edfs, pdfs,
+                       summ_scores, centers, baseline_key(cfg))
+
+    movers = star_movers(base.summ_scores, new.summ_scores)
+    logging.info(f'{len(movers)} hospitals changed star rating')
+    report.record_group('corrections', cells=len(delta), refitted=groups,
+                        movers=len(movers))
+    return new, movers, groups
+
+
+def corrections_main(outdir=None, cfg=None, report=None, data=None):
+    """
+    Apply the corrections in `cfg.CORRECTIONS` to the baseline in `OUT`, and
+    write the results as `main` does, plus the star movers.  Return the
+    summary scores.
+
+    Everything is run on the raw data first if there is no baseline yet, if
+    it was made from another `INFILE` or with other settings, or if the raw
+    data are given as `data`.
+    """
+    if cfg is None:
+        cfg = set_config()
+    if report is None:
+        report = RunReport()
+    path = os.path.join(cfg.OUT, f'{cfg.BASELINE_FILE}.pkl')
+    base = None
+    if data is not None:
+        logging.info('raw data given; running everything first')
+    elif not os.path.exists(path):
+        logging.info(f'no baseline at {path}; running everything first')
+    else:
+        base = Baseline.load(path)
+        if getattr(base, 'key', None) != baseline_key(cfg):
+            logging.warning(f'the baseline at {path} was made from another '
+                            'INFILE or with other settings; running '
+                            'everything first')
+            base = None
+    if base is None:
+        if data is None:
+            data = read_input(os.path.join(constants.IN, cfg.INFILE))
+        base = Baseline.run(data, cfg, report)
+    delta = read_delta(cfg.CORRECTIONS)
+    new, movers, _ = correct(base, delta, cfg, report)
+    with report.stage('margins'):
+        margins = star_margins(new.summ_scores, new.centers, cfg)
+    if cfg.WRITE_NOTHING:
+        return new.summ_scores
+
+    folder = make_outfolder(outdir or str(int(time())), cfg)
+    new.save(path)
+    if cfg.WRITE_CSV:
+        write_csv(new.summ_scores, new.edfs, folder, cfg)
+        margins.to_csv(os.path.join(folder, f'{cfg.MARGIN_FILE}.csv'),
+                       float_format='%.5f')
+        movers.to_csv(os.path.join(folder, f'{cfg.MOVERS_FILE}.csv'),
+                      float_format='%.5f')
+    report.save(folder, cfg.REPORT_FILE)
+    return new.summ_scores
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit('usage: python -m hydrus.corrections DELTA.csv')
+    cfg = set_config()
+    cfg.CORRECTIONS = sys.argv[1]
+    corrections_main(cfg=cfg)
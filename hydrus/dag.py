@@ -0,0 +1,256 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Run Hydrus as a graph of tasks instead of a sequence of stages.
+
+`main` finishes each stage before starting the next: all of preprocessing,
+then every LVM, then the summary scores and clusters, then the output files.
+But each group's LVM needs only its own measures, and each measure is
+standardized on its own (see `hydrus.preprocess.standardize`).  So here a
+group's fit starts as soon as its columns are standardized, its parameters
+are written as soon as its fit returns, and the star ratings are written
+while the margins are computed.
+
+The fits run on a process pool (or on threads, with `THREADS`), everything
+else on a thread pool.  Each task's start time and duration go in the run
+report, along with the critical path: the chain of dependent tasks that took
+longest, which is as short as the run could be.
+
+Set `PIPELINED` to run `main` this way.
+"""
+import os
+import logging
+from time import time
+from functools import partial
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait)
+
+from pandas import concat
+
+from hydrus import constants
+from hydrus.utility import set_config, dump_pickle
+from hydrus.instrument import RunReport
+from hydrus.preprocess import clean, read_input, standardize
+from hydrus.model import worker
+from hydrus.margins import star_margins
+from hydrus.store import write_estimates, write_stars
+from hydrus.__main__ import make_outfolder, rate, store_results
+
+
+def timed(func, *args):
+    """Return `func(*args)` and the times it started and ended."""
+    start = time()
+    result = func(*args)
+    return result, start, time()
+
+
+class Dag:
+    """
+    A graph of tasks.  Each task is a function, called with the results of
+    the tasks it depends on as soon as they are all done.
+    """
+    def __init__(self):
+        self.tasks = {}
+        self.times = {}
+
+    def add(self, name, func, deps=(), pool='io'):
+        """
+        Add task `name` to run `func` on the executor `pool` (see `run`).
+        Its dependencies `deps` must already have been added, so the graph
+        can't have cycles.
+        """
+        if name in self.tasks:
+            raise ValueError(f'task {name!r} already added')
+        missing = [x for x in deps if x not in self.tasks]
+        if missing:
+            raise ValueError(f'task {name!r} depends on unknown {missing}')
+        self.tasks[name] = func, tuple(deps), pool
+
+    def run(self, pools):
+        """
+        Run every task on its executor in the dict `pools`.  Return a dict of
+        the tasks' results.  Functions run on a process pool must be
+        picklable.
+        """
+        pending, running, results = dict(self.tasks), {}, {}
+        try:
+            while pending or running:
+                for name, (func, deps, pool) in list(pending.items()):
+                    if all(x in results for x in deps):
+                        del pending[name]
+                        args = [results[x] for x in deps]
+                        future = pools[pool].submit(timed, func, *args)
+                        running[future] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    results[name], start, end = future.result()
+                    self.times[name] = start, end
+        finally:
+            for future in running:
+                future.cancel()
+        return results
+
+    def critical_path(self):
+        """
+        Return the chain of dependent tasks with the longest total duration
+        and that duration, from the last `run`.
+        """
+        longest = {}  # task: (seconds, chain) of the longest chain ending there
+        for name, (_, deps, _) in self.tasks.items():  # (in dependency order)
+            start, end = self.times[name]
+            seconds, chain = max(
+                [longest[x] for x in deps], default=(0, []))
+            longest[name] = seconds + end - start, chain + [name]
+        return max(longest.values(), default=(0, []))
+
+    def record(self, report):
+        """Add the last run's task timings to `report`."""
+        t0 = min(start for start, _ in self.times.values())
+        for name, (_, deps, pool) in self.tasks.items():
+            start, end = self.times[name]
+            report.record_task(
+                name=name, deps=list(deps), pool=pool, start=start - t0,
+                seconds=end - start)
+        seconds, chain = self.critical_path()
+        wall = max(end for _, end in self.times.values()) - t0
+        report.record_group(
+            'pipeline', tasks=len(self.tasks), wall_seconds=wall,
+            critical_path_seconds=seconds, critical_path=chain)
+        logging.info(f'pipeline took {wall:.2f}s; critical path {seconds:.2f}s '
+                     f'({" > ".join(chain)})')
+
+
+def split_groups(df, final_meas, groups):
+    """
+    Return the cleaned data for each group's measures and denominators, and
+    the final measures.
+    """
+    parts = {g: df[final_meas[g][0] + final_meas[g][1]].copy() for g in groups}
+    return parts, final_meas
+
+
+def standardize_group(cleaned, name, cfg):
+    """Return group `name`'s standardized data and its final measures."""
+    parts, final_meas = cleaned
+    return standardize(parts[name], final_meas[name][0], cfg), final_meas[name]
+
+
+def fit_group(std, name, cfg):
+    """Fit group `name`'s LVM.  Return ((est_df, pred_df), report dict)."""
+    data, meas_filter = std
+    return worker((data, meas_filter, name, cfg))
+
+
+def rate_groups(cleaned, *results, cfg=None, report=None):
+    """Return the summary scores and cluster centers from every group's
+    standardized data and fit, in that order."""
+    _, final_meas = cleaned
+    n = len(results) // 2
+    std_data = concat([data for data, _ in results[:n]], axis=1)
+    pdfs = [pdf for (_, pdf), _ in results[n:]]
+    return rate(std_data, final_meas, pdfs, cfg, report, return_centers=True)
+
+
+def pools(cfg):
+    """Return the executors for a pipelined run."""
+    cpus = os.cpu_count() or 1
+    if cfg.THREADS:
+        fit = ThreadPoolExecutor(cpus, thread_name_prefix='fit')
+    elif cfg.MULTIPROCESSING:
+        fit = ProcessPoolExecutor(cpus)
+    else:
+        fit = ThreadPoolExecutor(1, thread_name_prefix='fit')
+    io = ThreadPoolExecutor(len(cfg.GROUPS) + 2, thread_name_prefix='io')
+    return {'io': io, 'fit': fit}
+
+
+def pipeline(outdir=None, cfg=None, report=None, data=None):
+    """
+    Run Hydrus as a graph of tasks, writing the same output as `main`.
+    Return the summary scores.
+    """
+    if cfg is None:
+        cfg = set_config()
+    if report is None:
+        report = RunReport()
+    if cfg.FUSED or cfg.MULTISTART > 1:
+        raise ValueError('PIPELINED fits each group on its own; turn off '
+                         'FUSED and MULTISTART')
+    if outdir is None:
+        outdir = str(int(time()))
+    groups = cfg.GROUPS
+    infile = os.path.join(constants.IN, cfg.INFILE)
+
+    def load():
+        return read_input(infile) if data is None else data.copy()
+
+    dag = Dag()
+    dag.add('load', load)
+    dag.add('clean', lambda df: split_groups(*clean(df, cfg), groups), ['load'])
+    for g in groups:
+        dag.add(f'{g}/standardize', partial(standardize_group, name=g, cfg=cfg),
+                ['clean'])
+        dag.add(f'{g}/fit', partial(fit_group, name=g, cfg=cfg),
+                [f'{g}/standardize'], pool='fit')
+    dag.add('rate', partial(rate_groups, cfg=cfg, report=report),
+            ['clean', *[f'{g}/standardize' for g in groups],
+             *[f'{g}/fit' for g in groups]])
+    dag.add('margins', lambda rated: star_margins(*rated, cfg), ['rate'])
+
+    # Output, written as soon as each part of it is ready.
+    if not cfg.WRITE_NOTHING:
+        dag.add('outfolder', lambda: make_outfolder(outdir, cfg))
+        if cfg.WRITE_CSV:
+            for g in groups:
+                dag.add(f'{g}/write_csv',
+                        lambda folder, fit, g=g: write_estimates(
+                            g, fit[0][0], folder, cfg),
+                        ['outfolder', f'{g}/fit'])
+            dag.add('write_csv',
+                    lambda folder, rated: write_stars(rated[0], folder, cfg),
+                    ['outfolder', 'rate'])
+            dag.add('margins/write_csv',
+                    lambda folder, margins: margins.to_csv(
+                        os.path.join(folder, f'{cfg.MARGIN_FILE}.csv'),
+                        float_format='%.5f'),
+                    ['outfolder', 'margins'])
+        if cfg.RESULTS_STORE:
+            dag.add('write_store',
+                    lambda rated, *fits: store_results(
+                        rated[0], [edf for (edf, _), _ in fits], outdir, cfg),
+                    ['rate', *[f'{g}/fit' for g in groups]])
+
+    executors = pools(cfg)
+    try:
+        with report.stage('pipeline'):
+            results = dag.run(executors)
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+    for g in groups:
+        report.merge(results[f'{g}/fit'][1])
+    dag.record(report)
+
+    summ_scores, _ = results['rate']
+    if cfg.WRITE_NOTHING:
+        return summ_scores
+    folder = results['outfolder']
+    if cfg.SAVE_DEBUG:
+        dump_pickle(cfg, os.path.join(folder, 'config.pkl'))
+    report.save(folder, cfg.REPORT_FILE)
+    return summ_scores
@@ -0,0 +1,334 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+LVM fitting across several machines.
+
+The exact loglikelihood and its gradient are sums over hospitals, so each
+worker node can hold a shard of a group's hospitals and return its part of
+both.  `DistributedLvm` splits the rows among the nodes once, then runs the
+optimizer itself, sending each step's parameters to every node and adding
+up their replies.  Predictions are made on the nodes, each for its own
+hospitals.  The data are sent once per group; each optimizer step then costs
+one small round trip per node.
+
+Nodes speak `multiprocessing.connection`'s protocol (pickled messages over
+TCP, after a handshake with a shared key).  Since a message can run any code
+when it's unpickled, there is no default key: start a node on each machine
+with
+
+    HYDRUS_AUTHKEY=KEY python -m hydrus.distributed HOST:PORT
+
+and list their addresses in `NODES`, with the same key in `NODE_AUTHKEY` or
+the driver's HYDRUS_AUTHKEY.  Or set `NODES` to a number to start that many
+nodes as local processes, which get a random key.  The driver drops each
+group's shards once the group is fitted.
+
+A driver's message is a tuple (command, shard key, ...), and each reply is
+('ok', result) or ('error', traceback):
+
+    ('load', key, z, w)     hold a shard of scores `z` and weights `w`
+    ('ll', key, params)     each hospital's loglikelihood
+    ('obj', key, params)    the negated sums of loglikelihood and gradient
+    ('predict', key, params) each hospital's random effect
+    ('drop', key)           forget a shard
+    ('stats',)              the node's process id, memory, and call counts
+    ('close',)              end this connection (no reply)
+    ('stop',)               end this connection and shut down (no reply)
+"""
+import os
+import sys
+import uuid
+import logging
+import traceback
+import multiprocessing
+from time import perf_counter
+from functools import partial
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from hydrus import constants
+from hydrus.instrument import RunReport, peak_rss
+from hydrus.model import Lvm, ll_exact, ll_grad_exact, outcomes
+
+
+AUTHKEY_VARIABLE = 'HYDRUS_AUTHKEY'
+
+
+def node_authkey(authkey=None):
+    """Return `authkey`, or the key in the environment, as bytes."""
+    authkey = authkey or os.environ.get(AUTHKEY_VARIABLE)
+    if not authkey:
+        raise ValueError('worker nodes need a shared key: set NODE_AUTHKEY or '
+                         f'the {AUTHKEY_VARIABLE} environment variable')
+    return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def parse_address(address):
+    """Return the (host, port) of a 'host:port' string or pair."""
+    if isinstance(address, str):
+        host, port = address.rsplit(':', 1)
+        return host, int(port)
+    host, port = address
+    return host, int(port)
+
+
+class Node:
+    """A worker node's shards and call counts, for one driver at a time."""
+    def __init__(self):
+        self.shards = {}
+        self.calls, self.seconds = 0, 0.
+
+    def load(self, key, z, w):
+        self.shards[key] = Lvm(z, w, key)
+
+    def ll(self, key, params):
+        return self.shards[key].ests_ll_exact(params)
+
+    def obj(self, key, params):
+        lvm = self.shards[key]
+        return (-np.nansum(ll_exact(params, lvm.num2, lvm.w2)),
+                -ll_grad_exact(params, lvm.num2, lvm.w2))
+
+    def predict(self, key, params):
+        lvm = self.shards[key]
+        lvm.final_ests = np.split(params, 3)
+        return lvm.predict()
+
+    def drop(self, key):
+        self.shards.pop(key, None)
+
+    def stats(self):
+        return {'pid': os.getpid(), 'peak_rss_bytes': peak_rss(),
+                'calls': self.calls, 'call_seconds': self.seconds}
+
+    def handle(self, conn):
+        """
+        Answer the driver on `conn` until it closes.  Return True if it asked
+        the node to stop.
+        """
+        while True:
+            try:
+                command, *args = conn.recv()
+            except EOFError:
+                return False
+            if command in ('close', 'stop'):
+                return command == 'stop'
+            t0 = perf_counter()
+            try:
+                reply = 'ok', getattr(self, command)(*args)
+            except Exception:
+                reply = 'error', traceback.format_exc()
+            self.calls += 1
+            self.seconds += perf_counter() - t0
+            conn.send(reply)
+
+
+def serve(listener):
+    """Serve drivers, one after another, until one asks to stop."""
+    while True:
+        with listener.accept() as conn:
+            if Node().handle(conn):
+                return
+
+
+def local_node(conn, authkey):
+    """Serve on a free local port, first sending its address on `conn`."""
+    with Listener(('localhost', 0), authkey=authkey) as listener:
+        conn.send(listener.address)
+        conn.close()
+        serve(listener)
+
+
+def start_local(n, authkey):
+    """Start `n` local worker nodes.  Return their addresses and processes."""
+    addresses, procs = [], []
+    for _ in range(n):
+        recv, send = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(
+            target=local_node, args=(send, authkey), daemon=True)
+        proc.start()
+        addresses.append(recv.recv())
+        procs.append(proc)
+    return addresses, procs
+
+
+class Cluster:
+    """
+    Connections to the worker nodes at `nodes`, a list of addresses, or to
+    `nodes` new local nodes if it's a number.  Nodes elsewhere need the key
+    `authkey` (see `node_authkey`); local nodes get a random one.  Local nodes
+    are stopped on `close`; the others keep running for the next driver.
+    """
+    def __init__(self, nodes, authkey=None):
+        self.procs, self.shards = [], {}
+        if isinstance(nodes, int):
+            authkey = os.urandom(32)
+            nodes, self.procs = start_local(nodes, authkey)
+        if not nodes:
+            raise ValueError('no worker nodes given')
+        authkey = node_authkey(authkey)
+        self.addresses = [parse_address(x) for x in nodes]
+        self.conns = [Client(x, authkey=authkey) for x in self.addresses]
+
+    def __len__(self):
+        return len(self.conns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def request(self, messages):
+        """
+        Send each node its message from `messages`, a dict keyed by node
+        index, then collect and return their results in the same order.
+        Sending them all first lets the nodes work at the same time.
+        """
+        for i, message in messages.items():
+            self.conns[i].send(message)
+        replies = [self.conns[i].recv() for i in messages]
+        for i, (status, result) in zip(messages, replies):
+            if status != 'ok':
+                raise RuntimeError(
+                    f'worker node {self.addresses[i]} failed:\n{result}')
+        return [result for _, result in replies]
+
+    def broadcast(self, message, nodes=None):
+        """Send `message` to every node (or those in `nodes`)."""
+        if nodes is None:
+            nodes = range(len(self))
+        return self.request({i: message for i in nodes})
+
+    def load(self, key, shards):
+        """Send each node its shard from `shards`, a dict of (z, w) keyed by
+        node index, to keep as `key` until it's dropped."""
+        self.request({i: ('load', key, z, w) for i, (z, w) in shards.items()})
+        self.shards[key] = list(shards)
+
+    def drop(self, key=None):
+        """Have the nodes forget the shards loaded as `key` (or all)."""
+        keys = list(self.shards) if key is None else [key]
+        for k in keys:
+            self.broadcast(('drop', k), self.shards.pop(k))
+
+    def stats(self):
+        """Return each node's address, process id, memory, and call counts."""
+        return [{'node': '%s:%s' % address, **stats}
+                for address, stats in zip(self.addresses,
+                                          self.broadcast(('stats',)))]
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop',) if self.procs else ('close',))
+            conn.close()
+        self.conns = []
+        self.shards = {}
+        for proc in self.procs:
+            proc.join()
+
+
+class DistributedLvm(Lvm):
+    """
+    A variant of `Lvm` whose hospitals are split among the worker nodes of
+    `cluster`, which evaluate the loglikelihood and its gradient for them.
+    The driver keeps none of the data.  Exact integral only.  The nodes keep
+    their shards until `drop`, or until the cluster is closed.
+    """
+    def __init__(self, z, w, name='', quadrature=None, cfg=None,
+                 cluster=None):
+        if quadrature or (cfg is not None and cfg.QUADRATURE):
+            raise ValueError('distributed fitting needs the exact integral; '
+                             'turn off QUADRATURE')
+        if cluster is None:
+            raise ValueError('DistributedLvm needs a Cluster of worker nodes')
+        self.cluster = cluster
+        super().__init__(z, w, name, quadrature, cfg)
+        self.ests_jac = True  # `ests_obj` returns the gradient as well
+
+    def set_data(self, z, w):
+        z = z.values if hasattr(z, 'values') else z
+        w = w.values if hasattr(w, 'values') else w
+        self.key = uuid.uuid4().hex
+        rows = np.array_split(np.arange(len(w)), min(len(self.cluster), len(w)))
+        self.nodes = range(len(rows))
+        self.cluster.load(
+            self.key, {i: (z[r], w[r]) for i, r in zip(self.nodes, rows)})
+
+    def drop(self):
+        """Have the nodes forget this model's data."""
+        self.cluster.drop(self.key)
+
+    def ests_ll_exact(self, params):
+        return np.concatenate(
+            self.cluster.broadcast(('ll', self.key, params), self.nodes))
+
+    def ests_obj(self, params):
+        """
+        The objective function to minimize for the model parameters, and its
+        gradient: the sums of the nodes' parts.
+        """
+        t0 = perf_counter()
+        parts = self.cluster.broadcast(('obj', self.key, params), self.nodes)
+        obj = sum(x for x, _ in parts)
+        grad = sum(x for _, x in parts)
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return obj, grad
+
+    def predict(self):
+        """Predict the random effects on the nodes."""
+        params = np.concatenate(self.final_ests)
+        self.final_preds = np.concatenate(self.cluster.broadcast(
+            ('predict', self.key, params), self.nodes))
+        self.preds_stats = {'nodes': len(self.nodes)}
+        return self.final_preds
+
+
+def odistributed(std_data, final_meas, groups=None, cfg=None, report=None):
+    """Calculate the hospital group scores for each LVM on the worker nodes
+    in `NODES`."""
+    if cfg is not None:
+        groups = cfg.GROUPS
+    if report is None:
+        report = RunReport()
+
+    settings = cfg or constants
+    with Cluster(settings.NODES, settings.NODE_AUTHKEY) as cluster:
+        logging.info(f'fitting {len(groups)} groups on {len(cluster)} nodes')
+        make = partial(DistributedLvm, cluster=cluster)
+        results = []
+        for g in groups:
+            results.append(
+                outcomes(std_data, final_meas[g], g, cfg, report, make))
+            cluster.drop()  # (the group's shards)
+        for stats in cluster.stats():
+            report.record_worker(**stats)
+    report.record_worker(pid=os.getpid(), peak_rss_bytes=peak_rss())
+    return zip(*results)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2 or not os.environ.get(AUTHKEY_VARIABLE):
+        sys.exit(f'usage: {AUTHKEY_VARIABLE}=KEY '
+                 'python -m hydrus.distributed HOST:PORT')
+    logging.basicConfig(level=logging.INFO)
+    key = node_authkey()
+    with Listener(parse_address(sys.argv[1]), authkey=key) as listener:
+        logging.info(f'serving on {listener.address}')
+        serve(listener)
@@ -0,0 +1,177 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fit every measure group's LVM in a single optimizer call.
+
+The groups' loglikelihoods are separable (no parameter is shared between
+groups), so maximizing their sum is the same as maximizing each one.  All
+groups' measures are packed side by side into one ragged nhosp x nmeas
+matrix, and per-group sums over measures are taken with `np.add.reduceat`,
+so one vectorized evaluation covers every group.
+"""
+import datetime
+import logging
+from time import perf_counter
+
+import numpy as np
+from pandas import DataFrame
+from scipy.optimize import minimize
+
+from hydrus import constants
+from hydrus.instrument import RunReport
+from hydrus.model import (
+    ESTS_OPTS, LOG2PI, group_inputs, log_result, oserial, pack, post_mode)
+
+
+class FusedLvm:
+    """
+    Estimate the parameters of several groups' LVMs at once.  `inputs` is a
+    list of (scores, weights) pairs, one per group, all with the same
+    hospitals in the same order.
+    """
+    def __init__(self, inputs, names, cfg=None):
+        self.t0 = datetime.datetime.now()
+        self.cfg = cfg or constants
+        self.names = names
+
+        z = [x.values if hasattr(x, 'values') else x for x, _ in inputs]
+        w = [x.values if hasattr(x, 'values') else x for _, x in inputs]
+        self.sizes = [x.shape[1] for x in z]
+        self.starts = np.cumsum([0] + self.sizes[:-1])  # for `reduceat`
+        self.z, self.w = np.hstack(z), np.hstack(w)
+        self.num2, self.w2 = np.nan_to_num(self.z), np.nan_to_num(self.w)
+        self.n, nmeas = self.z.shape
+
+        # The group that each column belongs to.
+        self.cgroup = np.repeat(np.arange(len(names)), self.sizes)
+
+        self.nobj, self.tobj = 0, 0.
+        self.ests_init = np.array(pack(self.cfg.INITIAL_LVM_PARAMS, nmeas))
+        self.ests_bounds = pack(self.cfg.EXACT_BOUNDS, nmeas)
+
+    def gsum(self, x):
+        """Sum the columns of `x` within each group."""
+        return np.add.reduceat(x, self.starts, axis=1)
+
+    def ests_ll(self, params):
+        """Return each hospital's exact loglikelihood in each group."""
+        return self.ests_ll_grad(params)[0]
+
+    def ests_ll_grad(self, params):
+        """
+        Return each hospital's exact loglikelihood in each group (an nhosp x
+        ngroups array) and the gradient of their total.  See `ll_exact` and
+        `ll_grad_exact` for the single-group versions.
+        """
+        mu, gamma, err = np.split(params, 3)
+        d = self.num2 - mu
+        q = self.w2 / err**2
+        r = d * q
+        dr = d * r
+
+        f = self.gsum(self.w2 * (2 * np.log(abs(err)) + LOG2PI))
+        a = self.gsum(q * gamma**2)
+        b = self.gsum(r * gamma)
+        c = self.gsum(dr)
+        ll = .5 * (b * b / (a+1) - c - f - np.log1p(a))
+
+        # Spread each hospital's per-group terms back out to the columns.
+        s = (1 / (a+1))[:, self.cgroup]
+        bs = (b / (a+1))[:, self.cgroup]
+        rbs = (r * bs).sum(axis=0)
+        qbs2s = (q * (bs * bs + s)).sum(axis=0)
+
+        g_mu = r.sum(axis=0) - gamma * (q * bs).sum(axis=0)
+        g_gamma = rbs - gamma * qbs2s
+        g_err = (
+            gamma**2 * qbs2s - 2 * gamma * rbs
+            + dr.sum(axis=0) - self.w2.sum(axis=0)
+            ) / err
+
+        return ll, np.concatenate([g_mu, g_gamma, g_err])
+
+    def ests_obj(self, params):
+        """The objective function to minimize, and its gradient."""
+        t0 = perf_counter()
+        ll, grad = self.ests_ll_grad(params)
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return -np.nansum(ll), -grad
+
+    def split(self, params):
+        """Split packed parameters into each group's (mu, gamma, err)."""
+        ends = np.cumsum(self.sizes)[:-1]
+        return list(zip(*(np.split(x, ends) for x in np.split(params, 3))))
+
+    def estimate(self):
+        """Minimize the objective function to estimate all groups' model
+        parameters."""
+        res = minimize(
+            self.ests_obj, self.ests_init, method='L-BFGS-B', jac=True,
+            tol=self.cfg.TOL, bounds=self.ests_bounds, options=ESTS_OPTS,
+            )
+        self.final_ests = self.split(res.x)
+        self.ests_stats = {
+            'nit': res.get('nit'),
+            'nfev': res.get('nfev'),
+            'obj_evals': self.nobj,
+            'obj_seconds': self.tobj,
+            'mean_obj_seconds': self.tobj / self.nobj if self.nobj else None,
+            'success': bool(res['success']),
+            }
+        log_result('+'.join(self.names), res, self.t0)
+        return self.final_ests
+
+    def predict(self):
+        """Predict every group's random effects (see `post_mode`)."""
+        self.final_preds = []
+        for ests, start, size in zip(self.final_ests, self.starts, self.sizes):
+            cols = slice(start, start + size)
+            params = np.concatenate(ests)
+            self.final_preds.append(
+                post_mode(params, self.z[:, cols], self.w[:, cols]))
+        return self.final_preds
+
+
+def ofused(std_data, final_meas, groups=None, cfg=None, report=None):
+    """Calculate the hospital group scores for all LVMs in one fit."""
+    if cfg is not None:
+        groups = cfg.GROUPS
+    if report is None:
+        report = RunReport()
+    if cfg is not None and cfg.QUADRATURE:
+        logging.warning('fused estimation needs the exact integral; '
+                        'fitting groups one at a time instead')
+        return oserial(std_data, final_meas, groups, cfg, report)
+
+    logging.info(f'creating fused LVM for {len(groups)} groups')
+    inputs = [group_inputs(std_data, final_meas[g]) for g in groups]
+    lvm = FusedLvm(inputs, groups, cfg=cfg)
+    with report.stage('fused/estimate'):
+        estimates = lvm.estimate()
+    with report.stage('fused/predict'):
+        predictions = lvm.predict()
+
+    est_dfs, pred_dfs = [], []
+    for g, (mu, gamma, err), preds in zip(groups, estimates, predictions):
+        grp_nums = final_meas[g][0]
+        est_df = DataFrame({'mu': mu, 'gamma': gamma, 'err': err}, grp_nums)
+        est_dfs.append(est_df[['mu', 'gamma', 'err']])
+        pred_dfs.append(DataFrame({g: preds}, std_data.index))
+        report.record_group(g, nhosp=lvm.n, nmeas=len(grp_nums))
+    report.record_group('fused', estimate=lvm.ests_stats)
+    return est_dfs, pred_dfs
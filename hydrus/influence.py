@@ -0,0 +1,298 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Influence of single measures and single hospitals on the star ratings.
+
+Measures
+--------
+
+Dropping a measure changes only its own group's LVM (measure weights are
+computed column by column, so the other measures' weights don't move).  So
+instead of rerunning the whole pipeline once per measure, each measure's
+group is refitted without it, starting from the full model's parameters,
+which are usually close to the new optimum, and its random effects are
+found in closed form (`post_mode`).  The summary scores and stars are then
+recomputed from the new group scores and the other groups' existing ones.
+The refits run in parallel on a pool whose workers share the group data (see
+`hydrus.multistart`).
+
+Hospitals
+---------
+Refitting every group once per hospital is out of reach, so each hospital's
+influence is approximated by the infinitesimal jackknife: removing hospital
+i moves a group's parameters by about H^-1 g_i, where g_i is the gradient of
+its own exact loglikelihood and H is the Hessian of the group's total.  The
+change in everyone else's group scores follows from the derivatives of the
+predictions with respect to the parameters (`post_mode_jac`), and from those
+the shifts in summary scores, cluster centers, and star boundaries.  All of
+this is done in blocks of hospitals with matrix products.
+
+Run `python -m hydrus.influence` to write the results to `OUT`.
+"""
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+from pandas import DataFrame
+
+from hydrus import constants, multistart
+from hydrus.instrument import RunReport
+from hydrus.model import (
+    group_inputs, ll_grad_exact, ll_grad_rows, make_lvm, post_mode,
+    post_mode_jac)
+from hydrus.multistart import group_arrays, init_worker, share_groups
+from hydrus.margins import boundaries, star_index, summary_weights
+from hydrus.__main__ import rate, seeded
+
+
+def drop_measure(meas_filter, j):
+    """Return a group's (numerators, denominators) without measure `j`."""
+    return tuple([x for i, x in enumerate(cols) if i != j]
+                 for cols in meas_filter)
+
+
+def warm_start(est_df, measure):
+    """Return packed initial parameters: `est_df` without `measure`."""
+    est_df = est_df.drop(measure)
+    return np.concatenate([est_df[x].values for x in ['mu', 'gamma', 'err']])
+
+
+def refit_without(task):
+    """Refit a group's LVM without one measure.  Return its predictions."""
+    group, j, measure, init = task
+    z, w = group_arrays(group)
+    keep = np.arange(z.shape[1]) != j
+    if not keep.any():  # nothing left to fit
+        return group, j, np.full(len(z), np.nan), 0
+    lvm = make_lvm(
+        z[:, keep], w[:, keep], f'{group} without {measure}',
+        cfg=multistart._CFG)
+    lvm.estimate(init)
+
+    # `Lvm.predict` finds the same random effects by numerical optimization,
+    # one hospital at a time, which would cost more than the refit itself.
+    preds = post_mode(np.concatenate(lvm.final_ests), z[:, keep], w[:, keep])
+    return group, j, preds, lvm.ests_stats['nit']
+
+
+def measure_influence(std_data, final_meas, est_dfs, pred_dfs, cfg=None,
+                      pool=None, report=None):
+    """
+    Measure how the ratings change when each measure is left out, given the
+    full model's parameter estimates `est_dfs` and group scores `pred_dfs`
+    for each of `cfg.GROUPS`.
+
+    Return (influence, stars).  `influence` has a row for each measure with
+    the number of hospitals whose star rating goes up or down without it and
+    the shifts in summary and group scores.  `stars` has each hospital's
+    star rating without each measure (one column per measure).
+
+    If `pool` is given, its workers must have been set up with `init_worker`
+    and the output of `share_groups`.
+    """
+    if cfg is None:
+        cfg = constants
+    if report is None:
+        report = RunReport()
+    cfg = seeded(cfg)  # (so only the measure can change the stars)
+    groups = cfg.GROUPS
+    base = rate(std_data, final_meas, pred_dfs, cfg)
+
+    own_pool = pool is None
+    if own_pool:
+        shared = share_groups(std_data, final_meas, groups)
+        pool = multiprocessing.Pool(
+            os.cpu_count() or 1, initializer=init_worker,
+            initargs=(shared, cfg))
+
+    tasks = [
+        (g, j, m, warm_start(edf, m))
+        for g, edf in zip(groups, est_dfs)
+        for j, m in enumerate(final_meas[g][0])
+        ]
+    logging.info(f'refitting {len(tasks)} LVMs, each without one measure')
+    with report.stage('influence/refit'):
+        results = pool.map(refit_without, tasks)
+    if own_pool:
+        pool.close()
+
+    rows, stars = [], {}
+    with report.stage('influence/rate'):
+        for (g, j, measure, _), (_, _, preds, nit) in zip(tasks, results):
+            gi = groups.index(g)
+            meas = dict(final_meas)
+            meas[g] = drop_measure(final_meas[g], j)
+            pdfs = list(pred_dfs)
+            pdfs[gi] = DataFrame({g: preds}, std_data.index)
+            summ = rate(std_data, meas, pdfs, cfg)
+
+            change = summ['cluster_name'] - base['cluster_name']
+            shift = (summ['summary'] - base['summary']).abs()
+            gshift = (summ[g] - base[g]).abs()
+            rows.append({
+                'measure': measure,
+                'group': g,
+                'stars_up': int((change > 0).sum()),
+                'stars_down': int((change < 0).sum()),
+                'mean_summary_shift': shift.mean(),
+                'max_summary_shift': shift.max(),
+                'mean_group_shift': gshift.mean(),
+                'max_group_shift': gshift.max(),
+                'iterations': nit,
+                })
+            stars[measure] = summ['cluster_name']
+
+    influence = DataFrame(rows).set_index('measure')
+    influence['stars_changed'] = influence.stars_up + influence.stars_down
+    report.record_group('influence', refits=len(tasks),
+                        iterations=int(influence.iterations.sum()))
+    return influence, DataFrame(stars, std_data.index)
+
+
+def hessian(params, num2, w2, step=1e-6):
+    """
+    Return the Hessian of the total exact loglikelihood, by central
+    differences of its analytic gradient.
+    """
+    cols = []
+    for k in range(len(params)):
+        h = step * max(1, abs(params[k]))
+        up, down = params.copy(), params.copy()
+        up[k] += h
+        down[k] -= h
+        cols.append(
+            (ll_grad_exact(up, num2, w2) - ll_grad_exact(down, num2, w2))
+            / (2*h))
+    hess = np.column_stack(cols)
+    return (hess + hess.T) / 2
+
+
+def group_influence(params, z, w):
+    """
+    For one group with parameters `params`, return (shifts, jac, hess):
+    `shifts` is the approximate change in the parameters from removing each
+    hospital (nhosp x nparams), `jac` the derivatives of each hospital's
+    prediction (nhosp x nparams), and `hess` the loglikelihood's Hessian.
+    """
+    num2, w2 = np.nan_to_num(z), np.nan_to_num(w)
+    hess = hessian(params, num2, w2)
+    grads = ll_grad_rows(params, num2, w2)
+
+    # Removing hospital i leaves the gradient at -g_i, and a Newton step from
+    # there moves the parameters by H^-1 g_i.
+    shifts = np.linalg.solve(hess, grads.T).T
+    return shifts, post_mode_jac(params, z, w), hess
+
+
+def hospital_influence(std_data, final_meas, est_dfs, summ_scores,
+                       centers=None, cfg=None, flag_ratio=5, block=256):
+    """
+    Approximate each hospital's influence on the model parameters and the
+    star ratings without refitting, given a run's parameter estimates
+    `est_dfs`, its scores and ratings `summ_scores`, and its cluster
+    `centers` (as from `rate`).  Without `centers`, the clusters' means are
+    used.
+
+    Return a DataFrame with a row per hospital: for each group, the size of
+    the change in its parameters from removing the hospital (in the metric of
+    the Hessian, like Cook's distance); the largest resulting shift in a star
+    boundary; and the number of other hospitals whose star rating would
+    change.
+
+    Every removal moves the boundaries a little, so hospitals are flagged
+    when theirs moves a boundary over `flag_ratio` times as far as the median
+    hospital's does.
+
+    This uses the exact loglikelihood, so the estimates should be too.
+    """
+    if cfg is None:
+        cfg = constants
+    if cfg.QUADRATURE:
+        raise ValueError('hospital influence needs the exact integral')
+    n = len(std_data)
+
+    wts = summary_weights(summ_scores, cfg)
+    win = summ_scores['summary_win'].values
+    unclipped = (summ_scores['summary'].values == win)[:, None]
+
+    # Stack every group's parameter shifts, weighting each group's prediction
+    # derivatives by the hospital's summary weight for it.
+    out, shifts, wjac = DataFrame(index=summ_scores.index), [], []
+    for gi, (g, edf) in enumerate(zip(cfg.GROUPS, est_dfs)):
+        params = np.concatenate([edf[x].values for x in ['mu', 'gamma', 'err']])
+        z, w = (x.values for x in group_inputs(std_data, final_meas[g]))
+        shift, jac, hess = group_influence(params, z, w)
+        out[f'{g}_influence'] = -np.einsum('ij,jk,ik->i', shift, hess, shift)
+        shifts.append(shift)
+        wjac.append(jac * wts[:, [gi]] * unclipped)
+    shifts, wjac = np.hstack(shifts), np.hstack(wjac)
+
+    # Each cluster center moves with the mean of its members' scores.
+    names = summ_scores['cluster_name'].values
+    labels = [x for x in cfg.CLUSTER_NAMES if x in set(names)]
+    member = np.array([names == x for x in labels], dtype=float)  # K x n
+    size = member.sum(axis=1)
+    means = member @ win / size
+    centers = means if centers is None else np.sort(centers)
+    bounds = boundaries(centers)
+    stars = star_index(win, bounds)
+
+    bshift, flipped = np.zeros(n), np.zeros(n, dtype=int)
+    for i in range(0, n, block):
+        cols = np.arange(i, min(i + block, n))
+        new = win[:, None] + wjac @ shifts[cols].T  # (n x block)
+
+        # Cluster centers without each removed hospital.
+        own = member[:, cols]
+        sums = member @ new - own * new[cols, np.arange(len(cols))]
+        new_means = sums / np.maximum(size[:, None] - own, 1)
+        new_centers = centers[:, None] + new_means - means[:, None]
+        new_bounds = (new_centers[1:] + new_centers[:-1]) / 2
+        bshift[cols] = abs(new_bounds - bounds[:, None]).max(axis=0)
+
+        new_stars = (new[:, :, None] > new_bounds.T[None]).sum(axis=2)
+        changed = new_stars != stars[:, None]
+        changed[cols, np.arange(len(cols))] = False  # (the removed hospital)
+        flipped[cols] = changed.sum(axis=0)
+
+    out['max_boundary_shift'] = bshift
+    out['stars_flipped'] = flipped
+    out['flag'] = bshift > flag_ratio * np.median(bshift)
+    return out
+
+
+if __name__ == '__main__':
+    from hydrus.utility import set_config
+    from hydrus.preprocess import preprocess
+    from hydrus.__main__ import executor
+
+    cfg = set_config()
+    std_data, final_meas = preprocess(cfg=cfg)
+    edfs, pdfs = executor(cfg)(std_data, final_meas, cfg=cfg)
+    edfs, pdfs = list(edfs), list(pdfs)
+    influence, stars = measure_influence(std_data, final_meas, edfs, pdfs, cfg)
+    summ_scores, centers = rate(
+        std_data, final_meas, pdfs, cfg, return_centers=True)
+    hospitals = hospital_influence(
+        std_data, final_meas, edfs, summ_scores, centers, cfg)
+    if not os.path.exists(cfg.OUT):
+        os.mkdir(cfg.OUT)
+    for df, name in [(influence, cfg.INFLUENCE_FILE),
+                     (stars, f'{cfg.INFLUENCE_FILE}_stars'),
+                     (hospitals, f'{cfg.INFLUENCE_FILE}_hospitals')]:
+        df.to_csv(os.path.join(cfg.OUT, f'{name}.csv'), float_format='%.5f')
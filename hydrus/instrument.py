@@ -0,0 +1,124 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Lightweight instrumentation for Hydrus runs.
+
+A `RunReport` collects wall times for each pipeline stage, optimizer
+statistics for each measure group, and per-worker memory/IPC figures, and
+writes them to a machine-readable JSON file next to the run's other output.
+"""
+import os
+import sys
+import json
+import pickle
+import platform
+from time import time, perf_counter
+from contextlib import contextmanager
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes.
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def pickled_size(x):
+    """Return the number of bytes needed to send `x` to another process."""
+    return len(pickle.dumps(x, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def _jsonable(x):
+    """Convert NumPy scalars and other stragglers for `json.dump()`."""
+    if hasattr(x, 'item'):
+        return x.item()
+    if hasattr(x, 'tolist'):
+        return x.tolist()
+    return str(x)
+
+
+class RunReport:
+    """Collect timings and resource statistics for a single Hydrus run."""
+    def __init__(self):
+        self.started = time()
+        self.stages = []
+        self.groups = {}
+        self.workers = []
+        self.tasks = []
+        self.pool = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block and record it under `name`."""
+        t0 = perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append({'name': name, 'seconds': perf_counter() - t0})
+
+    def record_group(self, name, **stats):
+        """Add (or update) statistics for measure group `name`."""
+        self.groups.setdefault(name, {}).update(stats)
+
+    def record_worker(self, **stats):
+        """Add statistics for one task run by a worker process."""
+        self.workers.append(stats)
+
+    def record_task(self, **stats):
+        """Add timings for one task of a pipelined run (see `hydrus.dag`)."""
+        self.tasks.append(stats)
+
+    def record_pool(self, **stats):
+        """Record how the worker pool was sized (see `hydrus.memory`)."""
+        self.pool.update(stats)
+
+    def merge(self, other):
+        """Fold the contents of report `other` (e.g. from a worker) into this
+        one."""
+        self.stages.extend(other['stages'])
+        for name, stats in other['groups'].items():
+            self.record_group(name, **stats)
+        self.workers.extend(other['workers'])
+        self.tasks.extend(other.get('tasks', []))
+        self.pool.update(other.get('pool', {}))
+
+    def as_dict(self):
+        return {
+            'started': self.started,
+            'total_seconds': time() - self.started,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'peak_rss_bytes': peak_rss(),
+            'stages': self.stages,
+            'groups': self.groups,
+            'workers': self.workers,
+            'tasks': self.tasks,
+            'pool': self.pool,
+            }
+
+    def save(self, folder, outfile):
+        f = os.path.join(folder, f'{outfile}.json')
+        with open(f, 'w') as out:
+            json.dump(self.as_dict(), out, indent=2, default=_jsonable)
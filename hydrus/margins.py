@@ -0,0 +1,87 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+How close each hospital is to another star rating.
+
+Both clustering methods end by assigning each hospital to the nearest of
+five cluster centers, so the boundaries between star ratings are the
+midpoints between adjacent centers.  A hospital's margin is its signed
+distance to the nearest boundary: positive if that boundary is above it (the
+next star up), negative if below.  Since the summary score is a weighted sum
+of group scores, a change of margin / weight in any one group score would
+move the hospital across that boundary.  These hold the cluster centers and
+winsorization limits fixed.
+"""
+import numpy as np
+from pandas import DataFrame
+
+from hydrus import constants
+
+
+def boundaries(centers):
+    """Return the star boundaries for cluster `centers`."""
+    centers = np.sort(centers)
+    return (centers[1:] + centers[:-1]) / 2
+
+
+def star_index(scores, bounds):
+    """Return each score's star as an index (0 for the lowest star)."""
+    return np.searchsorted(bounds, scores)
+
+
+def summary_weights(summ_scores, cfg=None):
+    """
+    Return the group weights used for each hospital's summary score (an
+    nhosp x ngroups array), rebalanced for its missing groups.
+    """
+    if cfg is None:
+        cfg = constants
+    w = np.array([dict(cfg.GROUP_WEIGHTS)[g] for g in cfg.GROUPS])
+    wts = np.where(summ_scores[cfg.GROUPS].notnull().values, w, 0)
+    return wts / wts.sum(axis=1, keepdims=True)
+
+
+def star_margins(summ_scores, centers, cfg=None):
+    """
+    Return each hospital's distance to the star boundaries below and above
+    it, its signed margin to the nearer one, and for each group the change in
+    that group's score alone that would reach it.
+    """
+    if cfg is None:
+        cfg = constants
+    # The winsorization limits are outside the boundaries, so a summary score
+    # is above a boundary if and only if its winsorized score is.
+    summary = summ_scores['summary'].values
+    bounds = boundaries(centers)
+    k = star_index(summary, bounds)
+    lower = np.concatenate([[-np.inf], bounds])[k]
+    upper = np.concatenate([bounds, [np.inf]])[k]
+    up, down = upper - summary, summary - lower
+    margin = np.where(up < down, up, -down)
+
+    out = DataFrame({
+        'margin_down': np.where(np.isinf(down), np.nan, down),
+        'margin_up': np.where(np.isinf(up), np.nan, up),
+        'margin': margin,
+        }, index=summ_scores.index)
+    out = out[['margin_down', 'margin_up', 'margin']]
+    wts = summary_weights(summ_scores, cfg)
+    with np.errstate(divide='ignore'):
+        flip = np.where(wts > 0, margin[:, None] / wts, np.nan)
+    for g, x in zip(cfg.GROUPS, flip.T):
+        out[f'{g}_flip'] = x
+    return out
@@ -0,0 +1,217 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Size worker pools to fit in memory.
+
+Each `oparallel` worker unpickles its own copy of the standardized data and
+then fits one group, which with quadrature means arrays of QCOUNT x nhosp x
+nmeas.  So a pool with a process per CPU can need more memory than a
+container has.  `task_bytes` estimates a group task's peak from its shape,
+the likelihood and the kind of `Lvm`, `memory_budget` finds how much memory
+the pool may use (the smaller of the cgroup's unused limit and the system's
+MemAvailable), and `plan_pool` picks the most processes that fit.
+"""
+import os
+import logging
+
+from hydrus import constants
+
+
+CGROUP = '/sys/fs/cgroup'
+MEMINFO = '/proc/meminfo'
+PROC_CGROUP = '/proc/self/cgroup'
+
+# cgroup v1 reports no limit as a number near 2**63.
+UNLIMITED = 2**60
+
+# A worker process's own footprint (interpreter, NumPy, SciPy, pandas).
+WORKER_BASE_BYTES = 100 * 2**20
+
+# Arrays of nhosp x nmeas float64 alive at once during a fit: the group's
+# scores and weights as DataFrames, and `Lvm`'s copies of them, with and
+# without NANs.  `CompactLvm`'s float32 copies and mask come to about one.
+INPUT_ARRAYS = 2
+LVM_ARRAYS = 4
+COMPACT_ARRAYS = 1
+
+# The exact likelihood's temporaries (half as many bytes in float32).
+EXACT_ARRAYS = 6
+
+# QCOUNT x nhosp x nmeas float64 arrays alive at once in `ll_quad` (just
+# over 9 at its peak, measured with tracemalloc), and in `ll_adaptive`, with
+# at most QCOUNT nodes.
+QUAD_ARRAYS = 10
+ADAPTIVE_ARRAYS = 4
+
+
+def read_int(path):
+    """Return the integer in the file at `path`, or None if it's missing or
+    means no limit."""
+    try:
+        with open(path) as infile:
+            text = infile.read().strip()
+    except OSError:
+        return None
+    if text == 'max':
+        return None
+    value = int(text)
+    return None if value >= UNLIMITED else value
+
+
+def read_stat(path, key):
+    """Return the number after `key` in a file of 'key value' lines, e.g.
+    memory.stat or /proc/meminfo."""
+    try:
+        with open(path) as infile:
+            for line in infile:
+                name, *value = line.split()
+                if name == key:
+                    return int(value[0])
+    except OSError:
+        pass
+    return None
+
+
+def cgroup_dirs(root=CGROUP, proc=PROC_CGROUP):
+    """
+    Return (directory, version) for this process's memory cgroup and each of
+    its ancestors, whose limits apply too, under `root`.  With a cgroup
+    namespace the process's own cgroup is mounted at the root itself.
+    """
+    try:
+        with open(proc) as infile:
+            lines = infile.read().splitlines()
+    except OSError:
+        return []
+    out = []
+    for line in lines:
+        _, controllers, path = line.split(':', 2)
+        if controllers == '':
+            version, base = 2, root
+            if not os.path.exists(os.path.join(base, 'cgroup.controllers')):
+                base = os.path.join(root, 'unified')
+        elif 'memory' in controllers.split(','):
+            version, base = 1, os.path.join(root, 'memory')
+        else:
+            continue
+        parts = [x for x in path.split('/') if x]
+        dirs = [os.path.join(base, *parts[:i])
+                for i in range(len(parts), -1, -1)]
+        out.extend((x, version) for x in dirs if os.path.isdir(x))
+    return out
+
+
+def cgroup_available(root=CGROUP, proc=PROC_CGROUP):
+    """
+    Return the bytes this process's cgroups can still use (the smallest of
+    each limit less its usage, not counting reclaimable page cache), or None
+    if there is no limit.
+    """
+    free = []
+    for folder, version in cgroup_dirs(root, proc):
+        if version == 2:
+            limit = read_int(os.path.join(folder, 'memory.max'))
+            usage = read_int(os.path.join(folder, 'memory.current'))
+            cache = read_stat(os.path.join(folder, 'memory.stat'),
+                              'inactive_file')
+        else:
+            limit = read_int(os.path.join(folder, 'memory.limit_in_bytes'))
+            usage = read_int(os.path.join(folder, 'memory.usage_in_bytes'))
+            cache = read_stat(os.path.join(folder, 'memory.stat'),
+                              'total_inactive_file')
+        if limit is not None:
+            free.append(limit - max((usage or 0) - (cache or 0), 0))
+    return min(free, default=None)
+
+
+def mem_available(path=MEMINFO):
+    """Return the system's MemAvailable in bytes, or None if unknown."""
+    kb = read_stat(path, 'MemAvailable:')
+    return None if kb is None else kb * 1024
+
+
+def memory_budget(cfg=None):
+    """
+    Return the bytes a worker pool may use: `MEMORY_BUDGET` if set, else
+    `MEMORY_FRACTION` of the memory available.  None if it can't be found.
+    """
+    cfg = cfg or constants
+    if cfg.MEMORY_BUDGET:
+        return cfg.MEMORY_BUDGET
+    found = [x for x in [cgroup_available(), mem_available()] if x is not None]
+    if not found:
+        return None
+    return int(min(found) * cfg.MEMORY_FRACTION)
+
+
+def task_bytes(nhosp, nmeas, data_bytes, cfg=None):
+    """
+    Estimate the peak memory of a worker fitting a group of `nmeas` measures
+    for `nhosp` hospitals, sent `data_bytes` of standardized data (held both
+    pickled and unpickled while it's received).  The kernel's share depends
+    on the kind of `Lvm` (see `make_lvm`): `ChunkedLvm` and its inputs take
+    CHUNK_ROWS hospitals at a time, and `CompactLvm` computes the exact
+    likelihood in float32.
+    """
+    cfg = cfg or constants
+    cells = nhosp * nmeas * 8
+    quadrature = getattr(cfg, 'QUADRATURE', False)
+    if cfg.CHUNKED:
+        # The inputs are written to disk a block at a time, and each block
+        # is copied back in, with and without NANs; its temporaries are the
+        # only other arrays of its size.
+        block = min(nhosp, cfg.CHUNK_ROWS) * nmeas * 8
+        inputs, lvm = INPUT_ARRAYS * block, LVM_ARRAYS * block
+    elif cfg.COMPACT:
+        # Quadrature expands the scores and weights to float64 each call.
+        block, inputs = cells, INPUT_ARRAYS * cells
+        lvm = (COMPACT_ARRAYS + 2 * quadrature) * cells
+    else:
+        block, inputs, lvm = cells, INPUT_ARRAYS * cells, LVM_ARRAYS * cells
+    if quadrature and cfg.ADAPTIVE_QUADRATURE:
+        kernel = ADAPTIVE_ARRAYS * cfg.QCOUNT * block
+    elif quadrature:
+        kernel = QUAD_ARRAYS * cfg.QCOUNT * block
+    elif cfg.COMPACT and not cfg.CHUNKED:
+        kernel = EXACT_ARRAYS * block // 2
+    else:
+        kernel = EXACT_ARRAYS * block
+    return WORKER_BASE_BYTES + 2 * data_bytes + inputs + lvm + kernel
+
+
+def plan_pool(sizes, budget, cpus):
+    """
+    Return the number of processes for tasks needing `sizes` bytes each, and
+    the order to run them in: largest first.  Taken one at a time in that
+    order by `nproc` processes, no tasks running together need more than the
+    `nproc` largest, so `nproc` is the most (up to `cpus`) whose largest
+    tasks fit in `budget` bytes.  At least one process, however little fits.
+    """
+    order = sorted(range(len(sizes)), key=lambda i: -sizes[i])
+    nproc = max(min(cpus, len(sizes)), 1)
+    if budget is not None:
+        total = 0
+        for k, i in enumerate(order[:nproc]):
+            total += sizes[i]
+            if total > budget:
+                nproc = max(k, 1)
+                break
+        if sizes and sizes[order[0]] > budget:
+            logging.warning(
+                f'the largest task may need {sizes[order[0]] / 2**20:.0f}MB '
+                f'but only {budget / 2**20:.0f}MB are available')
+    return nproc, order
@@ -20,6 +20,8 @@ import pickle
 import datetime
 import itertools
 import multiprocessing
+from time import perf_counter
+from functools import lru_cache
 
 import numpy as np
 from pandas import DataFrame
@@ -28,6 +30,8 @@ from scipy.misc import logsumexp
 from scipy.stats import norm
 
 from hydrus import constants
+from hydrus.instrument import RunReport, peak_rss, pickled_size
+from hydrus.memory import memory_budget, plan_pool, task_bytes
 if constants.JIT:
     from hydrus.norm import lpdf_1d, lpdf_3d, lpdf_std, nsum, nsum_row
 else:
@@ -68,6 +72,180 @@ def log_result(name, res, t0=None):
         logging.info(f'{name}: {msg}')
 
 
+def ll_quad(params, z, w, qcount):
+    """
+    Calculate each hospital's loglikelihood via Gaussian quadrature, given
+    model parameters `params`, scores `z` and weights `w`.
+    """
+    n = z.shape[0]
+    mu0, gamma0, err0 = np.split(params, 3)
+    x = np.tile(z, (qcount, 1, 1))  # (QCOUNTXnhospXnmeas)
+    loc = mu0 + np.outer(QC1, gamma0)
+    loc = np.tile(loc, (n, 1, 1))
+    loc = np.transpose(loc, (1, 0, 2))
+    scale = np.tile(err0, (qcount, n, 1))
+    zs = lpdf_3d(x=x, loc=loc, scale=scale)
+
+    w2 = np.tile(w, (qcount, 1, 1))
+    wted = np.nansum(w2 * zs, axis=2).T  # (nhosp X QCOUNT)
+    qh = np.tile(QC1, (n, 1))  # (nhosp X QCOUNT)
+    combined = wted + norm.logpdf(qh)  # (nhosp X QCOUNT)
+
+    return logsumexp(np.nan_to_num(combined), b=QC2, axis=1)  # (nhosp)
+
+
+@lru_cache(maxsize=None)
+def hermgauss_table(qcount):
+    """
+    Return Gauss-Hermite nodes and weights for `qcount` points, with the
+    weights multiplied by exp(x**2) so that they integrate f(x) rather than
+    f(x) * exp(-x**2).
+    """
+    x, w = np.polynomial.hermite.hermgauss(qcount)
+    return x, w * np.exp(x**2)
+
+
+def ll_adaptive(params, z, w, qcount):
+    """
+    Calculate each hospital's loglikelihood via adaptive Gauss-Hermite
+    quadrature with `qcount` nodes, given model parameters `params`, scores
+    `z` and weights `w`.
+
+    The nodes are centered on each hospital's posterior mode for alpha and
+    scaled by its posterior standard deviation, i.e. the curvature of the
+    log integrand there.  (In this model the integrand is normal in alpha,
+    so this is exact for any `qcount`, up to rounding.)  As in `ll_quad`,
+    cells where `z` or `w` is NAN are ignored.
+    """
+    mu, gamma, err = np.split(params, 3)
+    obs = ~(np.isnan(z) | np.isnan(w))
+    zz, ww = np.where(obs, z, 0), np.where(obs, w, 0)
+
+    q = ww / err**2
+    prec = q @ gamma**2 + 1
+    mode = ((zz - mu) * q) @ gamma / prec
+    scale = np.sqrt(2 / prec)
+
+    x, qw = hermgauss_table(qcount)
+    alpha = mode[:, None] + scale[:, None] * x  # (nhosp X qcount)
+    resid = (zz[:, None, :] - mu - gamma * alpha[:, :, None]) / err
+    lpdfs = -resid**2 / 2 - np.log(err) - LOG2PI / 2
+    log_integrand = (
+        (ww[:, None, :] * lpdfs).sum(axis=2) - alpha**2 / 2 - LOG2PI / 2)
+    return np.log(scale) + logsumexp(log_integrand, b=qw, axis=1)
+
+
+def adaptive_qcount(params, z, w, tol, max_qcount):
+    """
+    Return the smallest number of adaptive quadrature nodes (up to
+    `max_qcount`) for which adding a node changes the total loglikelihood
+    by less than `tol`.
+    """
+    prev = np.nansum(ll_adaptive(params, z, w, 1))
+    for qcount in range(1, max_qcount):
+        cur = np.nansum(ll_adaptive(params, z, w, qcount + 1))
+        if abs(cur - prev) < tol:
+            return qcount
+        prev = cur
+    return max_qcount
+
+
+def ll_exact(params, num2, w2):
+    """
+    Calculate each hospital's exact loglikelihood given model parameters
+    `params`, NAN-free scores `num2` and NAN-free weights `w2`.
+    """
+    mu, gamma, err = np.split(params, 3)
+    d = num2 - mu
+    q = w2 / err**2
+    r = d * q
+
+    f = w2 @ (2 * np.log(abs(err)) + LOG2PI)
+    a = q @ gamma**2
+    b = r @ gamma
+    c = nsum_row(d * r)
+
+    return .5 * (b * b / (a+1) - c - f - np.log1p(a))
+
+
+def ll_grad_exact(params, num2, w2):
+    """
+    Calculate the gradient of the total exact loglikelihood (i.e. the sum of
+    `ll_exact` over hospitals) with respect to `params`.
+    """
+    mu, gamma, err = np.split(params, 3)
+    d = num2 - mu
+    q = w2 / err**2
+    r = d * q
+
+    s = 1 / (q @ gamma**2 + 1)  # 1 / (a+1)
+    bs = (r @ gamma) * s  # b / (a+1)
+    rbs = r.T @ bs
+    qbs2 = q.T @ bs**2
+
+    g_mu = r.sum(axis=0) - gamma * (q.T @ bs)
+    g_gamma = rbs - gamma * (qbs2 + q.T @ s)
+    g_err = (
+        gamma**2 * (qbs2 + q.T @ s) - 2 * gamma * rbs
+        + (d * r).sum(axis=0) - w2.sum(axis=0)
+        ) / err
+
+    return np.concatenate([g_mu, g_gamma, g_err])
+
+
+def ll_grad_rows(params, num2, w2):
+    """
+    Calculate the gradient of each hospital's exact loglikelihood with
+    respect to `params`, as an nhosp x nparams array.  Its column sums are
+    `ll_grad_exact`.
+    """
+    mu, gamma, err = np.split(params, 3)
+    d = num2 - mu
+    q = w2 / err**2
+    r = d * q
+
+    s = (1 / (q @ gamma**2 + 1))[:, None]
+    bs = (r @ gamma)[:, None] * s
+    qbs2s = q * (bs**2 + s)
+
+    g_mu = r - gamma * q * bs
+    g_gamma = r * bs - gamma * qbs2s
+    g_err = (gamma**2 * qbs2s - 2 * gamma * r * bs + d * r - w2) / err
+
+    return np.hstack([g_mu, g_gamma, g_err])
+
+
+def post_mode(params, z, w):
+    """
+    Return each hospital's random effect alpha, in closed form.
+
+    The prediction loglikelihood (`Lvm.preds_ll`) is quadratic in alpha, so
+    its maximum is where the derivative sum(w*gamma*(z-mu-gamma*alpha)/err**2)
+    - alpha is zero.  Cells where `z` or `w` is NAN are ignored.
+    """
+    mu, gamma, err = np.split(params, 3)
+    q = np.where(np.isnan(z), 0, np.nan_to_num(w)) / err**2
+    r = np.nan_to_num(z - mu) * q
+    return (r @ gamma) / (q @ gamma**2 + 1)
+
+
+def post_mode_jac(params, z, w):
+    """
+    Return the derivatives of each hospital's `post_mode` with respect to
+    `params`, as an nhosp x nparams array.
+    """
+    mu, gamma, err = np.split(params, 3)
+    q = np.where(np.isnan(z), 0, np.nan_to_num(w)) / err**2
+    r = np.nan_to_num(z - mu) * q
+    den = (q @ gamma**2 + 1)[:, None]
+    alpha = (r @ gamma)[:, None] / den
+    return np.hstack([
+        -q * gamma / den,
+        (r - 2 * alpha * q * gamma) / den,
+        -2 * gamma * (r - alpha * q * gamma) / (err * den),
+        ])
+
+
 class Lvm:
     """
     Find values for mu, gamma, err, and alpha that best fit CMS's latent
@@ -83,23 +261,37 @@ class Lvm:
         # Otherwise fall back to whatever is in `constants.py`.
         self.cfg = cfg or constants
 
-        # If w or z are DataFrames, convert them to ndarrays.
-        self.w = w.values if hasattr(w, 'values') else w
-        self.z = z.values if hasattr(z, 'values') else z
-
-        self.w2 = np.nan_to_num(self.w)
-        self.num2 = np.nan_to_num(self.z)
-
+        self.set_data(z, w)
         self.name, self.n = name, w.shape[0]
+
+        # Objective function call counts and cumulative time, for profiling.
+        self.nobj, self.tobj = 0, 0.
         self.ests_init = np.array(pack(self.cfg.INITIAL_LVM_PARAMS, w.shape[1]))
 
+        # Gradients are approximated by finite differences unless a subclass
+        # says otherwise.
+        self.ests_jac = None
+        self.qcount = None
         if quadrature or (cfg is not None and cfg.QUADRATURE):
-            self.ests_ll = self.ests_ll_quad
+            if self.cfg.ADAPTIVE_QUADRATURE:
+                self.ests_ll = self.ests_ll_adaptive
+            else:
+                self.ests_ll = self.ests_ll_quad
+                self.qcount = self.cfg.QCOUNT
             self.ests_bounds = pack(self.cfg.QUAD_BOUNDS, w.shape[1])
         else:
             self.ests_ll = self.ests_ll_exact
             self.ests_bounds = pack(self.cfg.EXACT_BOUNDS, w.shape[1])
 
+    def set_data(self, z, w):
+        """Store the scores `z` and weights `w` for the measure group."""
+        # If w or z are DataFrames, convert them to ndarrays.
+        self.w = w.values if hasattr(w, 'values') else w
+        self.z = z.values if hasattr(z, 'values') else z
+
+        self.w2 = np.nan_to_num(self.w)
+        self.num2 = np.nan_to_num(self.z)
+
     def ests_ll_quad(self, params):
         """
         Calculate the loglikelihood given model parameters `params`.
@@ -107,20 +299,20 @@ class Lvm:
         This method uses Gaussian quadrature, and thus returns an *approximate*
         integral.
         """
-        mu0, gamma0, err0 = np.split(params, 3)
-        x = np.tile(self.z, (self.cfg.QCOUNT, 1, 1))  # (QCOUNTXnhospXnmeas)
-        loc = mu0 + np.outer(QC1, gamma0)
-        loc = np.tile(loc, (self.n, 1, 1))
-        loc = np.transpose(loc, (1, 0, 2))
-        scale = np.tile(err0, (self.cfg.QCOUNT, self.n, 1))
-        zs = lpdf_3d(x=x, loc=loc, scale=scale)
+        return ll_quad(params, self.z, self.w, self.cfg.QCOUNT)
 
-        w2 = np.tile(self.w, (self.cfg.QCOUNT, 1, 1))
-        wted = np.nansum(w2 * zs, axis=2).T  # (nhosp X QCOUNT)
-        qh = np.tile(QC1, (self.n, 1))  # (nhosp X QCOUNT)
-        combined = wted + norm.logpdf(qh)  # (nhosp X QCOUNT)
+    def ests_ll_adaptive(self, params):
+        """
+        Calculate the loglikelihood given model parameters `params`.
 
-        return logsumexp(np.nan_to_num(combined), b=QC2, axis=1)  # (nhosp)
+        This method uses adaptive quadrature.  The number of nodes is chosen
+        at the first call, i.e. at the initial parameters.
+        """
+        if self.qcount is None:
+            self.qcount = adaptive_qcount(
+                params, self.z, self.w, self.cfg.QUAD_TOL, self.cfg.QCOUNT)
+            logging.info(f'{self.name}: {self.qcount} quadrature nodes')
+        return ll_adaptive(params, self.z, self.w, self.qcount)
 
     def ests_ll_exact(self, params):
         """
@@ -129,30 +321,44 @@ class Lvm:
         This method uses an exact integral and returns exact ll values, i.e.
         it does not use quadrature to approximate the integral.
         """
-        mu, gamma, err = np.split(params, 3)
-        d = self.num2 - mu
-        q = self.w2 / err**2
-        r = d * q
-
-        f = self.w2 @ (2 * np.log(abs(err)) + LOG2PI)
-        a = q @ gamma**2
-        b = r @ gamma
-        c = nsum_row(d * r)
-
-        return .5 * (b * b / (a+1) - c - f - np.log1p(a))
+        return ll_exact(params, self.num2, self.w2)
 
     def ests_obj(self, params):
         """The objective function to minimize for the model parameters."""
+        t0 = perf_counter()
         # return -nsum(self.ests_ll(params))
-        return -np.nansum(self.ests_ll(params))
+        obj = -np.nansum(self.ests_ll(params))
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return obj
 
-    def estimate(self):
-        """Minimize the objective function to estimate the model parameters."""
+    def estimate(self, init=None, maxiter=None):
+        """
+        Minimize the objective function to estimate the model parameters.
+        Start from the packed parameters `init` instead of the usual initial
+        values if given, and stop after `maxiter` iterations if given.
+        """
+        opts = dict(ESTS_OPTS)
+        if maxiter is not None:
+            opts['maxiter'] = maxiter
         res = minimize(
-            self.ests_obj, self.ests_init, method='L-BFGS-B',
-            tol=self.cfg.TOL, bounds=self.ests_bounds, options=ESTS_OPTS,
+            self.ests_obj, self.ests_init if init is None else init,
+            method='L-BFGS-B', jac=self.ests_jac, tol=self.cfg.TOL,
+            bounds=self.ests_bounds, options=opts,
             )
         self.final_ests = unpack_res(res)
+        self.final_obj = float(res.fun)
+        self.ests_stats = {
+            'fun': self.final_obj,
+            'nit': res.get('nit'),
+            'nfev': res.get('nfev'),
+            'njev': res.get('njev'),
+            'obj_evals': self.nobj,
+            'obj_seconds': self.tobj,
+            'mean_obj_seconds': self.tobj / self.nobj if self.nobj else None,
+            'success': bool(res['success']),
+            'qcount': self.qcount,
+            }
         log_result(self.name, res, self.t0)
         return self.final_ests
 
@@ -169,20 +375,36 @@ class Lvm:
 
     def predict(self):
         """Predict the random effects."""
-        out = []
+        out, nfev = [], 0
         for num0, w0 in zip(self.z, self.w):
             res = minimize(
                 self.preds_obj, [0.],
                 ([*self.final_ests, num0, w0],), "L-BFGS-B",
                 )
             out.append(res.x[0])
+            nfev += res.nfev
+        self.preds_stats = {'obj_evals': nfev}
         self.final_preds = np.array(out)
         return self.final_preds
 
 
-def outcomes(data, meas_filter, name, cfg=None):
-    logging.info(f'creating LVM for {name}')
+def make_lvm(z, w, name='', cfg=None):
+    """Return the kind of `Lvm` selected by the configuration `cfg`."""
+    # (These modules import this one, hence the late imports.)
+    if (cfg or constants).CHUNKED:
+        from hydrus.chunked import ChunkedLvm
+        return ChunkedLvm(z, w, name, cfg=cfg)
+    if (cfg or constants).COMPACT:
+        from hydrus.compact import CompactLvm
+        return CompactLvm(z, w, name, cfg=cfg)
+    if (cfg or constants).THREADS:
+        from hydrus.threaded import NogilLvm
+        return NogilLvm(z, w, name, cfg=cfg)
+    return Lvm(z, w, name, cfg=cfg)
 
+
+def group_inputs(data, meas_filter):
+    """Return the LVM scores and measure weights for a measure group."""
     # Filter to measures in this group.
     grp_nums, grp_denoms = meas_filter
     num_df = data[grp_nums]
@@ -192,10 +414,38 @@ def outcomes(data, meas_filter, name, cfg=None):
     meas_hosp_counts = num_df.notnull().sum()
     meas_weights = denom_df / denom_df.sum() * meas_hosp_counts.values
 
+    return num_df, meas_weights
+
+
+def outcomes(data, meas_filter, name, cfg=None, report=None, make=make_lvm,
+             init=None):
+    """
+    Fit group `name`'s LVM, made by `make` (with `make_lvm`'s arguments),
+    starting from the packed parameters `init` if given.  Return its
+    parameter estimates and predictions as DataFrames.
+    """
+    logging.info(f'creating LVM for {name}')
+    if report is None:
+        report = RunReport()
+
+    grp_nums = meas_filter[0]
+    if make is make_lvm and (cfg or constants).CHUNKED:
+        # (Straight to disk, without the group's DataFrames.)
+        from hydrus.chunked import ChunkedLvm
+        lvm = ChunkedLvm.from_data(data, meas_filter, name, cfg=cfg)
+    else:
+        num_df, meas_weights = group_inputs(data, meas_filter)
+        lvm = make(num_df, meas_weights, name, cfg=cfg)
+
     # Run the LVM.
-    lvm = Lvm(num_df, meas_weights, name, cfg=cfg)
-    estimates = lvm.estimate()
-    predictions = lvm.predict()
+    with report.stage(f'{name}/estimate'):
+        estimates = lvm.estimate(init)
+    with report.stage(f'{name}/predict'):
+        predictions = lvm.predict()
+    report.record_group(
+        name, nhosp=lvm.n, nmeas=len(grp_nums),
+        estimate=lvm.ests_stats, predict=lvm.preds_stats,
+        )
 
     # Parse the LVM results.
     mu, gamma, err = estimates
@@ -206,37 +456,68 @@ def outcomes(data, meas_filter, name, cfg=None):
     return est_df, pred_df
 
 
-def oserial(std_data, final_meas, groups=None, cfg=None):
+def oserial(std_data, final_meas, groups=None, cfg=None, report=None):
     # Serial run is needed to get anything useful from cProfile.
     if cfg is not None:
         groups = cfg.GROUPS
     est_dfs, pred_dfs = [], []
     for g in groups:
-        est_df, pred_df = outcomes(std_data, final_meas[g], g, cfg)
+        est_df, pred_df = outcomes(std_data, final_meas[g], g, cfg, report)
         est_dfs.append(est_df)
         pred_dfs.append(pred_df)
     return est_dfs, pred_dfs
 
 
 def worker(group_data):
-    return outcomes(*group_data)
+    report = RunReport()
+    result = outcomes(*group_data, report)
+    report.record_worker(
+        pid=os.getpid(), group=group_data[2], peak_rss_bytes=peak_rss(),
+        result_bytes=pickled_size(result),
+        )
+    return result, report.as_dict()
 
 
-def oparallel(std_data, final_meas, groups=None, cfg=None):
+def oparallel(std_data, final_meas, groups=None, cfg=None, report=None):
     """Calculate the hospital group scores for each LVM."""
     if cfg is not None:
         groups = cfg.GROUPS
+    if report is None:
+        report = RunReport()
 
     cpus = os.cpu_count()
     # nproc = 1 if cpus is None else cpus - 1 or 1  # leave one CPU unused
-    nproc = 1 if cpus is None else cpus  # use all CPUs
+    cpus = 1 if cpus is None else cpus  # use all CPUs
+
+    # Use as many of them as there's memory for.
+    data_bytes = int(std_data.memory_usage().sum())
+    sizes = [task_bytes(len(std_data), len(final_meas[g][0]), data_bytes, cfg)
+             for g in groups]
+    budget = memory_budget(cfg)
+    nproc, order = plan_pool(sizes, budget, cpus)
+    logging.info(f'fitting {len(groups)} groups on {nproc} processes')
 
     pool = multiprocessing.Pool(nproc)
-    group_data = zip(
+    group_data = list(zip(
         [std_data for _ in groups],
         [final_meas[g] for g in groups],
         groups,
         [cfg for _ in groups]
-        )
-    r = pool.map(worker, group_data)
-    return zip(*r)
+        ))
+    # One task at a time, largest first (see `plan_pool`).
+    r = pool.map(worker, [group_data[i] for i in order], chunksize=1)
+    pool.close()
+    r = [x for _, x in sorted(zip(order, r), key=lambda x: x[0])]
+
+    # Each task's arguments are pickled separately on their way to a worker:
+    # the whole standardized data (measured once here), and the group's own
+    # small parts.
+    data_pickled = pickled_size(std_data)
+    for task, size, (_, worker_report) in zip(group_data, sizes, r):
+        worker_report['workers'][0]['args_bytes'] = (
+            data_pickled + pickled_size(task[1:]))
+        worker_report['workers'][0]['planned_bytes'] = size
+        report.merge(worker_report)
+    report.record_pool(
+        processes=nproc, cpus=cpus, memory_budget_bytes=budget)
+    return zip(*[result for result, _ in r])
@@ -0,0 +1,250 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Multi-start estimation of the LVMs.
+
+The LVM likelihood can have alternative optima (e.g. through the sign of
+gamma, or flat regions), and a single start from `INITIAL_LVM_PARAMS` gives
+no hint of which optimum it found.  Here each group is fitted from
+`MULTISTART` diverse starting points on a worker pool.  The group data are
+put in shared memory once rather than pickled per task.  Starts are run
+for `MULTISTART_BUDGET` iterations, the worse half of the unfinished ones
+are dropped, and the rest are run to convergence.
+"""
+import os
+import logging
+import multiprocessing
+from math import ceil
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+from pandas import DataFrame
+
+from hydrus import constants
+from hydrus.instrument import RunReport
+from hydrus.model import group_inputs, make_lvm, pack
+
+
+# Per-process state for pool workers, set by `init_worker`.
+_SHARED, _CFG, _LVMS = {}, None, {}
+
+
+def share(x):
+    """Copy `x` into shared memory.  Return the buffer and the shape."""
+    x = np.asarray(x, dtype=np.float64)
+    buf = RawArray('d', max(x.size, 1))
+    np.frombuffer(buf)[:x.size] = x.ravel()
+    return buf, x.shape
+
+
+def unshare(buf, shape):
+    """Return a NumPy view of a buffer created by `share()`."""
+    return np.frombuffer(buf)[:int(np.prod(shape))].reshape(shape)
+
+
+def share_groups(std_data, final_meas, groups):
+    """Put each group's LVM scores and weights in shared memory."""
+    shared = {}
+    for g in groups:
+        z, w = group_inputs(std_data, final_meas[g])
+        shared[g] = share(z.values), share(w.values)
+    return shared
+
+
+def init_worker(shared, cfg):
+    """Pool initializer: keep the shared group data in this process."""
+    global _SHARED, _CFG
+    _SHARED, _CFG = shared, cfg
+    _LVMS.clear()
+
+
+def group_arrays(group):
+    """Return views of `group`'s scores and weights in shared memory."""
+    (zbuf, zshape), (wbuf, wshape) = _SHARED[group]
+    return unshare(zbuf, zshape), unshare(wbuf, wshape)
+
+
+def group_lvm(group):
+    """Return this process's `Lvm` for `group`, built from shared memory."""
+    if group not in _LVMS:
+        _LVMS[group] = make_lvm(*group_arrays(group), group, cfg=_CFG)
+    return _LVMS[group]
+
+
+def fit_start(task):
+    group, i, init, maxiter = task
+    lvm = group_lvm(group)
+    lvm.estimate(init, maxiter)
+    done = maxiter is None or lvm.ests_stats['nit'] < maxiter
+    return group, i, np.concatenate(lvm.final_ests), lvm.final_obj, done
+
+
+def predict_group(task):
+    group, params = task
+    lvm = group_lvm(group)
+    lvm.final_ests = np.split(params, 3)
+    return lvm.predict()
+
+
+def start_points(nmeas, starts, cfg, seed=0):
+    """
+    Return `starts` packed starting points for a group with `nmeas` measures:
+    the usual initial values, the same with the sign of gamma flipped, and
+    random draws for the rest.
+    """
+    rng = np.random.RandomState(seed)
+    mu, gamma, err = cfg.INITIAL_LVM_PARAMS
+    points = [pack((mu, gamma, err), nmeas), pack((mu, -gamma, err), nmeas)]
+    while len(points) < starts:
+        points.append(np.concatenate([
+            rng.normal(0, .25, nmeas),
+            rng.uniform(-1, 1, nmeas),
+            rng.uniform(.3, 1.5, nmeas),
+            ]))
+    return [np.array(x, dtype=float) for x in points[:starts]]
+
+
+def orient(params):
+    """
+    Flip the sign of gamma if needed so that it is mostly positive.  The
+    likelihood is unchanged when every gamma (and so every alpha) in a group
+    changes sign, but the group scores would then rank hospitals backwards.
+    """
+    mu, gamma, err = np.split(params, 3)
+    if gamma.sum() < 0:
+        gamma = -gamma
+    return np.concatenate([mu, gamma, err])
+
+
+def same_optimum(a, b, rtol=1e-6):
+    return abs(a - b) <= rtol * max(1, abs(a), abs(b))
+
+
+def distinct_optima(funs, rtol=1e-6):
+    """Count the distinct values in objective values `funs`."""
+    funs = sorted(funs)
+    pairs = zip(funs, funs[1:])
+    return 1 + sum(not same_optimum(a, b, rtol) for a, b in pairs)
+
+
+def summarize_starts(finals, pruned, default):
+    """Describe the optima found for one group."""
+    funs = [fun for _, fun in finals.values()]
+    best_fun = min(funs)
+
+    # Of the starts that reached the best optimum, prefer the lowest-numbered
+    # one, i.e. the usual single start if it got there.
+    best = min(i for i in finals if same_optimum(finals[i][1], best_fun))
+    return {
+        'best_start': best,
+        'best_params': orient(finals[best][0]),
+        'best_fun': best_fun,
+        'default_fun': finals[default][1] if default in finals else None,
+        'funs': funs,
+        'fun_spread': max(funs) - best_fun,
+        'fun_std': float(np.std(funs)),
+        'n_optima': distinct_optima(funs),
+        'pruned': pruned,
+        }
+
+
+def multistart(std_data, final_meas, groups=None, cfg=None, starts=None,
+               pool=None, seed=0):
+    """
+    Estimate each group's LVM from several starting points.  Return a dict
+    with a summary (see `summarize_starts`) for each group.
+
+    If `pool` is given, its workers must have been set up with
+    `init_worker` and the output of `share_groups`.
+    """
+    if cfg is None:
+        cfg = constants
+    if groups is None:
+        groups = cfg.GROUPS
+    if starts is None:
+        starts = cfg.MULTISTART
+    budget = cfg.MULTISTART_BUDGET
+
+    own_pool = pool is None
+    if own_pool:
+        shared = share_groups(std_data, final_meas, groups)
+        pool = multiprocessing.Pool(
+            os.cpu_count() or 1, initializer=init_worker,
+            initargs=(shared, cfg))
+
+    # Round 1: a short run from every start.
+    tasks = []
+    for g in groups:
+        nmeas = len(final_meas[g][0])
+        for i, x in enumerate(start_points(nmeas, starts, cfg, seed)):
+            tasks.append((g, i, x, budget))
+    finals, partial = {g: {} for g in groups}, {g: {} for g in groups}
+    for g, i, x, fun, done in pool.map(fit_start, tasks):
+        (finals if done else partial)[g][i] = x, fun
+
+    # Round 2: drop the worse half of unfinished starts, finish the rest.
+    tasks, pruned = [], {g: [] for g in groups}
+    for g in groups:
+        ranked = sorted(partial[g], key=lambda i: partial[g][i][1])
+        keep = ceil(len(ranked) / 2)
+        pruned[g] = ranked[keep:]
+        tasks.extend((g, i, partial[g][i][0], None) for i in ranked[:keep])
+        if pruned[g]:
+            logging.info(f'{g}: stopped starts {pruned[g]} early')
+    for g, i, x, fun, _ in pool.map(fit_start, tasks):
+        finals[g][i] = x, fun
+
+    if own_pool:
+        pool.close()
+    return {g: summarize_starts(finals[g], pruned[g], 0) for g in groups}
+
+
+def omultistart(std_data, final_meas, groups=None, cfg=None, report=None):
+    """
+    Calculate the hospital group scores for each LVM, using the best of
+    several starting points for each group's parameters.
+    """
+    if cfg is not None:
+        groups = cfg.GROUPS
+    if report is None:
+        report = RunReport()
+
+    shared = share_groups(std_data, final_meas, groups)
+    pool = multiprocessing.Pool(
+        os.cpu_count() or 1, initializer=init_worker, initargs=(shared, cfg))
+    with report.stage('multistart/estimate'):
+        results = multistart(std_data, final_meas, groups, cfg, pool=pool)
+    with report.stage('multistart/predict'):
+        preds = pool.map(
+            predict_group, [(g, results[g]['best_params']) for g in groups])
+    pool.close()
+
+    est_dfs, pred_dfs = [], []
+    for g, pred in zip(groups, preds):
+        res = results[g]
+        mu, gamma, err = np.split(res['best_params'], 3)
+        est_df = DataFrame(
+            {'mu': mu, 'gamma': gamma, 'err': err}, final_meas[g][0])
+        est_dfs.append(est_df[['mu', 'gamma', 'err']])
+        pred_dfs.append(DataFrame({g: pred}, std_data.index))
+        logging.info(
+            f"{g}: best objective {res['best_fun']:.6f} from start "
+            f"{res['best_start']}; {res['n_optima']} distinct optima, "
+            f"spread {res['fun_spread']:.3g}")
+        report.record_group(g, multistart={
+            k: v for k, v in res.items() if k != 'best_params'})
+    return est_dfs, pred_dfs
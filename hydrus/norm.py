@@ -14,14 +14,16 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import math
 from warnings import filterwarnings
 
-from numpy import log, nansum, pi, sqrt
+from numpy import empty, log, nansum, pi, sqrt, zeros
 from numba import jit, f8
 
 
 # from scipy.stats._continuous_distns import _norm_pdf_logC
 _norm_pdf_logC = log(sqrt(2 * pi))
+_log2pi = log(2 * pi)
 
 
 filterwarnings('ignore', '.*encountered in log', RuntimeWarning)
@@ -62,3 +64,101 @@ def nsum(a):
 @jit(f8[:](f8[:,:]))
 def nsum_row(a):
     return nansum(a, axis=1)
+
+
+# The kernels below are compiled with `nogil=True`, so several threads can
+# run them at once (see `hydrus.threaded`).  They loop explicitly over
+# hospitals and measures instead of building temporary arrays.  Each takes
+# packed parameters (mu, gamma, err) like `hydrus.model.ll_exact`.
+
+@jit(f8[:](f8[:], f8[:,:], f8[:,:]), nopython=True, nogil=True)
+def ll_exact_nogil(params, num2, w2):
+    """Each hospital's exact loglikelihood.  See `hydrus.model.ll_exact`."""
+    n, m = num2.shape
+    mu, gamma, err = params[:m], params[m:2*m], params[2*m:]
+    out = empty(n)
+    for i in range(n):
+        a = b = c = f = 0.
+        for j in range(m):
+            d = num2[i, j] - mu[j]
+            q = w2[i, j] / err[j]**2
+            f += w2[i, j] * (2 * math.log(abs(err[j])) + _log2pi)
+            a += q * gamma[j]**2
+            b += d * q * gamma[j]
+            c += d * d * q
+        out[i] = .5 * (b * b / (a+1) - c - f - math.log1p(a))
+    return out
+
+
+@jit(f8[:](f8[:], f8[:,:], f8[:,:]), nopython=True, nogil=True)
+def ll_grad_nogil(params, num2, w2):
+    """
+    The gradient of the total exact loglikelihood.  See
+    `hydrus.model.ll_grad_exact`.
+    """
+    n, m = num2.shape
+    mu, gamma, err = params[:m], params[m:2*m], params[2*m:]
+    grad = zeros(3 * m)
+    for i in range(n):
+        a = b = 0.
+        for j in range(m):
+            q = w2[i, j] / err[j]**2
+            a += q * gamma[j]**2
+            b += (num2[i, j] - mu[j]) * q * gamma[j]
+        s = 1 / (a+1)
+        bs = b * s
+        for j in range(m):
+            d = num2[i, j] - mu[j]
+            q = w2[i, j] / err[j]**2
+            r = d * q
+            qbs2s = q * (bs * bs + s)
+            grad[j] += r - gamma[j] * q * bs
+            grad[m+j] += r * bs - gamma[j] * qbs2s
+            grad[2*m+j] += (
+                gamma[j]**2 * qbs2s - 2 * gamma[j] * r * bs + d * r - w2[i, j]
+                ) / err[j]
+    return grad
+
+
+@jit(f8[:](f8[:], f8[:,:], f8[:,:], f8[:], f8[:]), nopython=True, nogil=True)
+def ll_quad_nogil(params, z, w, qc1, qc2):
+    """
+    Each hospital's loglikelihood by Gaussian quadrature with nodes `qc1` and
+    weights `qc2`.  See `hydrus.model.ll_quad`.
+    """
+    n, m = z.shape
+    mu, gamma, err = params[:m], params[m:2*m], params[2*m:]
+    out = empty(n)
+    comb = empty(len(qc1))
+    for i in range(n):
+        for k in range(len(qc1)):
+            s = -qc1[k]**2 / 2.0 - _norm_pdf_logC
+            for j in range(m):
+                if not (math.isnan(z[i, j]) or math.isnan(w[i, j])):
+                    x = (z[i, j] - mu[j] - gamma[j] * qc1[k]) / err[j]
+                    s += w[i, j] * (
+                        -x * x / 2.0 - _norm_pdf_logC - math.log(err[j]))
+            comb[k] = s
+        top = comb.max()
+        total = 0.
+        for k in range(len(qc1)):
+            total += qc2[k] * math.exp(comb[k] - top)
+        out[i] = top + math.log(total)
+    return out
+
+
+@jit(f8[:](f8[:], f8[:,:], f8[:,:]), nopython=True, nogil=True)
+def post_mode_nogil(params, z, w):
+    """Each hospital's random effect.  See `hydrus.model.post_mode`."""
+    n, m = z.shape
+    mu, gamma, err = params[:m], params[m:2*m], params[2*m:]
+    out = empty(n)
+    for i in range(n):
+        num = den = 0.
+        for j in range(m):
+            if not (math.isnan(z[i, j]) or math.isnan(w[i, j])):
+                q = w[i, j] / err[j]**2
+                num += (z[i, j] - mu[j]) * q * gamma[j]
+                den += q * gamma[j]**2
+        out[i] = num / (den+1)
+    return out
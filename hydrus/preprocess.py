@@ -18,18 +18,49 @@ import os
 import logging
 
 from numpy import nan, where
-from pandas import read_sas
+from pandas import read_sas, read_csv, read_pickle
 
 from hydrus.utility import set_config, winsorize
+from hydrus.instrument import RunReport
 from hydrus import constants
 
 
-def preprocess(infile=None, settings_file=None, cfg=None):
+# The measures that `COMBINE_IMM3_OP27` combines.
+SEPARATE = {'IMM_3_OP_27': ['IMM_3', 'OP_27']}
+
+
+def read_input(infile):
+    """
+    Load a raw hospital data file.  CMS distributes a SAS file, but CSV and
+    pickle files with the same columns (e.g. synthetic data) work too.
+    """
+    ext = os.path.splitext(infile)[1].lower()
+    if ext == '.csv':
+        df = read_csv(
+            infile, index_col='PROVIDER_ID', dtype={'PROVIDER_ID': str})
+    elif ext in ('.pkl', '.pickle'):
+        df = read_pickle(infile)
+    else:
+        df = read_sas(infile, index='PROVIDER_ID')
+    df.index = df.index.astype(str)
+    return df
+
+
+def measure_columns(df):
+    """Return the measure score columns of `df` (those that aren't
+    denominators)."""
+    return [x for x in df.columns if not x.endswith('_DEN')]
+
+
+def preprocess(infile=None, settings_file=None, cfg=None, report=None,
+               data=None):
     """
     Preprocess CMS's raw data file.  Remove non-qualifying data according to
     CMS's specifications, standardize each measure score, and winsorize the
     scores at three standard deviations.  Return the new DataFrame and a dict
     of the final measures for each measure group.
+
+    If `data` is given, it is used as an already-loaded copy of the raw file.
     """
     if cfg is None:
         if settings_file:
@@ -39,64 +70,128 @@ def preprocess(infile=None, settings_file=None, cfg=None):
             cfg = set_config()
     if infile is None:
         infile = os.path.join(constants.IN, cfg.INFILE)
+    if report is None:
+        report = RunReport()
 
     # Load CMS's SAS data file.
-    df = read_sas(infile, index='PROVIDER_ID')
-    df.index = df.index.astype(str)
+    with report.stage('preprocess/load_sas'):
+        df = read_input(infile) if data is None else data.copy()
+
+    df, final_meas = clean(df, cfg, report)
+    with report.stage('preprocess/standardize'):
+        standardize(df, measure_columns(df), cfg)
+
+    return df, final_meas
+
+
+def clean(df, cfg, report=None):
+    """
+    Remove non-qualifying data from the raw DataFrame `df` according to CMS's
+    specifications (modifying `df`).  Return the remaining data, not yet
+    standardized, and a dict of the final measures for each measure group.
+    """
+    if report is None:
+        report = RunReport()
 
     # Combine measures IMM-3 and OP-27.
-    mask = df['IMM_3'].notnull()
-    df['IMM_3_OP_27'] = where(mask, df['IMM_3'], df['OP_27'])
-    df['IMM_3_OP_27_DEN'] = where(mask, df['IMM_3_DEN'], df['OP_27_DEN'])
-    for x in ['IMM_3', 'OP_27', 'IMM_3_DEN', 'OP_27_DEN']:
-        df.drop(x, axis=1, inplace=True)
-
-    # Remove columns where <= 100 hospitals have data.
-    incl_meas, incl_den = [], []
-    counts = df.count()  # nonnull hospitals per measure
-    for k, v in counts.items():
-        if k.endswith('_DEN'):
-            continue
-        if v <= 100:
-            df.drop(k, axis=1, inplace=True)
-            df.drop(k+'_DEN', axis=1, inplace=True)
-            logging.info(f'dropped {k} (<=100 hospitals have data)')
-        else:
-            incl_meas.append(k)
-            incl_den.append(k+'_DEN')
+    if cfg.COMBINE_IMM3_OP27:
+        with report.stage('preprocess/combine_imm3_op27'):
+            mask = df['IMM_3'].notnull()
+            df['IMM_3_OP_27'] = where(mask, df['IMM_3'], df['OP_27'])
+            df['IMM_3_OP_27_DEN'] = where(
+                mask, df['IMM_3_DEN'], df['OP_27_DEN'])
+            for x in ['IMM_3', 'OP_27', 'IMM_3_DEN', 'OP_27_DEN']:
+                df.drop(x, axis=1, inplace=True)
+
+    # Remove columns where fewer than MIN_HOSPITALS hospitals have data.
+    with report.stage('preprocess/drop_sparse_measures'):
+        incl_meas, incl_den = [], []
+        counts = df.count()  # nonnull hospitals per measure
+        for k, v in counts.items():
+            if k.endswith('_DEN'):
+                continue
+            if v < cfg.MIN_HOSPITALS:
+                # (Patient experience denominators are only added below.)
+                df.drop([k, k+'_DEN'], axis=1, inplace=True, errors='ignore')
+                logging.info(f'dropped {k} (<{cfg.MIN_HOSPITALS} hospitals '
+                             'have data)')
+            else:
+                incl_meas.append(k)
+                incl_den.append(k+'_DEN')
 
     # Create special denominators for patient experience group.
-    patientexp_denom = df['H_NUMB_COMP'] * df['H_RESP_RATE_P'] / 100
-    for col_name in cfg.PATIENTEXP_DENOM_COLS:
-        df[col_name] = patientexp_denom
+    with report.stage('preprocess/patientexp_denominators'):
+        if {'H_NUMB_COMP', 'H_RESP_RATE_P'} <= set(df.columns):
+            patientexp_denom = df['H_NUMB_COMP'] * df['H_RESP_RATE_P'] / 100
+            for col_name in cfg.PATIENTEXP_DENOM_COLS:
+                df[col_name] = patientexp_denom
+        else:
+            # Too few hospitals (e.g. in a small stratum) report the survey
+            # sizes, so the survey measures can't be weighted.
+            for col_name in cfg.PATIENTEXP_DENOM_COLS:
+                if col_name in incl_den:
+                    k = incl_meas.pop(incl_den.index(col_name))
+                    incl_den.remove(col_name)
+                    df.drop(k, axis=1, inplace=True)
+                    logging.info(f'dropped {k} (<{cfg.MIN_HOSPITALS} '
+                                 'hospitals have survey sizes)')
 
     # For each measure, if the denominator is NAN, make the numerator NAN too.
-    for x, y in zip(incl_meas, incl_den):
-        if y in df.columns:  # skips H_RESP_RATE_P and H_NUMB_COMP
-            df.loc[df[y].isnull(), x] = nan
+    with report.stage('preprocess/mask_missing_denominators'):
+        for x, y in zip(incl_meas, incl_den):
+            if y in df.columns:  # skips H_RESP_RATE_P and H_NUMB_COMP
+                df.loc[df[y].isnull(), x] = nan
 
     # Create final list of measures for each measure group.
     final_meas = {}
+    meas_groups = measure_groups(cfg)
     for g in cfg.GROUPS:
         final_meas[g] = (
-            [x for x in incl_meas if x in cfg.MEAS_GROUPS[g]],
-            [y for x, y in zip(incl_meas, incl_den) if x in cfg.MEAS_GROUPS[g]]
+            [x for x in incl_meas if x in meas_groups[g]],
+            [y for x, y in zip(incl_meas, incl_den) if x in meas_groups[g]]
             )
 
     # Remove hospitals with no final measures.
-    df = df.dropna(thresh=1)
+    with report.stage('preprocess/drop_empty_hospitals'):
+        df = df.dropna(thresh=1)
 
-    # Convert to z-scores.
-    for col_name in incl_meas:
-        col = df[col_name]
-        df[col_name] = (col - col.mean()) / col.std()
+    return df, final_meas
 
-    # Switch sign of measures for which a lower score is good.
-    for col_name in cfg.FLIPPED_MEASURES:
-        df[col_name] = -1 * df[col_name]
 
-    # Winsorize z-scores at +/-3.
-    for col_name in incl_meas:
-        df[col_name] = df[col_name].map(winsorize)
+def measure_groups(cfg):
+    """
+    Return the measures in each group.  Without `COMBINE_IMM3_OP27`, IMM-3
+    and OP-27 replace their combination as separate measures.
+    """
+    if cfg.COMBINE_IMM3_OP27:
+        return cfg.MEAS_GROUPS
+    return {g: [y for x in meas for y in SEPARATE.get(x, [x])]
+            for g, meas in cfg.MEAS_GROUPS.items()}
 
-    return df, final_meas
+
+def column_stats(df, cols):
+    """Return the mean and standard deviation of each of columns `cols`."""
+    return {x: (df[x].mean(), df[x].std()) for x in cols}
+
+
+def standardize(df, cols, cfg, stats=None):
+    """
+    Convert columns `cols` of `df` to z-scores (in place), switch the sign of
+    those where a lower score is good, and winsorize them at `WINSOR_LIMITS`.
+    Each column is independent of the others, so groups of columns can be
+    standardized separately.  `stats` can give each column's precomputed
+    (mean, standard deviation).
+    """
+    if stats is None:
+        stats = column_stats(df, cols)
+    flipped = set(cfg.FLIPPED_MEASURES)
+    if not cfg.COMBINE_IMM3_OP27 and 'IMM_3_OP_27' in flipped:
+        flipped.update(SEPARATE['IMM_3_OP_27'])
+    lo, hi = cfg.WINSOR_LIMITS
+    for col_name in cols:
+        mean, std = stats[col_name]
+        col = (df[col_name] - mean) / std
+        if col_name in flipped:
+            col = -1 * col
+        df[col_name] = col.map(lambda x: winsorize(x, lo, hi))
+    return df
@@ -0,0 +1,204 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+A columnar store of results across runs and quarters.
+
+Each run of `main` otherwise leaves a folder of CSV files behind.  The
+`ResultsStore` appends every run to one HDF5 file (via `pandas.HDFStore`,
+which needs PyTables) in three tables:
+
+    scores  one row per (run, quarter, PROVIDER_ID): the group scores,
+            summary scores, and star rating
+    params  one row per (run, quarter, group, measure): mu, gamma, and err
+    runs    one row per run: its quarter, time, and main settings
+
+The run, quarter, PROVIDER_ID, and group columns are indexed, so queries
+such as one hospital's scores over every quarter read only matching rows.
+Runs are never overwritten.
+"""
+import os
+import re
+from datetime import datetime
+
+from pandas import DataFrame, concat
+
+from hydrus import constants
+
+
+TABLES = ('scores', 'params', 'runs')
+
+# Indexed, queryable columns of each table.
+KEYS = {
+    'scores': ['run', 'quarter', 'PROVIDER_ID'],
+    'params': ['run', 'quarter', 'group', 'measure'],
+    'runs': ['run', 'quarter'],
+    }
+
+# Room reserved for the string columns.  (A table's string widths are fixed
+# by its first append.)
+ITEMSIZE = {'run': 40, 'quarter': 16, 'PROVIDER_ID': 10, 'group': 20,
+            'measure': 40}
+
+
+def quarter_of(cfg):
+    """
+    Return the quarter that a run's results belong to: `cfg.QUARTER` if set,
+    otherwise the year and month in the name of the measure settings file
+    (e.g. '2016_12' for 'measure_settings_2016_12.yml').
+    """
+    if getattr(cfg, 'QUARTER', None):
+        return str(cfg.QUARTER)
+    found = re.search(r'(\d{4})_(\d{2})', getattr(cfg, 'MEASURE_SETTINGS', ''))
+    return '_'.join(found.groups()) if found else 'unknown'
+
+
+def score_columns(cfg):
+    return [*cfg.GROUPS, 'summary', 'summary_win', 'cluster_name']
+
+
+def write_estimates(name, est_df, folder, cfg=None):
+    """Write group `name`'s model parameters as a CSV file in `folder`."""
+    if cfg is None:
+        cfg = constants
+    f = os.path.join(folder, f'{cfg.EST_FILE.format(name)}.csv')
+    est_df.to_csv(f, float_format='%.5f')
+
+
+def write_stars(summ_scores, folder, cfg=None):
+    """Write the summary scores and star ratings as a CSV file in `folder`."""
+    if cfg is None:
+        cfg = constants
+    output = summ_scores.copy()
+    output.columns = [dict(cfg.FRIENDLY_NAMES)[x] for x in output.columns]
+    f = os.path.join(folder, f'{cfg.STAR_FILE}.csv')
+    output.to_csv(f, float_format='%.5f')
+
+
+def write_csv(summ_scores, est_dfs, folder, cfg=None):
+    """Write one run's results as CSV files in `folder`."""
+    if cfg is None:
+        cfg = constants
+    for name, edf in zip(cfg.GROUPS, est_dfs):
+        write_estimates(name, edf, folder, cfg)
+    write_stars(summ_scores, folder, cfg)
+
+
+class ResultsStore:
+    """
+    An append-only HDF5 store of Hydrus results.  Use it as a context
+    manager, or call `close()` when done.
+    """
+    def __init__(self, path, mode='a'):
+        from pandas import HDFStore  # (PyTables is imported here)
+        self.path = path
+        self.hdf = HDFStore(path, mode=mode, complevel=5, complib='zlib')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.hdf.close()
+
+    def has_run(self, run):
+        return 'runs' in self.hdf and len(self.select('runs', run=run)) > 0
+
+    def append_run(self, run, summ_scores, est_dfs, cfg=None, quarter=None):
+        """
+        Add one run's results: `summ_scores` as returned by `main` and
+        `est_dfs`, the model parameter DataFrames for each of `cfg.GROUPS`.
+        """
+        if cfg is None:
+            cfg = constants
+        run = str(run)
+        if quarter is None:
+            quarter = quarter_of(cfg)
+        if self.has_run(run):
+            raise ValueError(f'run {run!r} is already in {self.path}')
+
+        scores = summ_scores.reindex(columns=score_columns(cfg))
+        scores[cfg.GROUPS] = scores[cfg.GROUPS].astype(float)
+        scores = scores.rename_axis('PROVIDER_ID').reset_index()
+        scores['PROVIDER_ID'] = scores['PROVIDER_ID'].astype(str)
+
+        params = concat([
+            edf.rename_axis('measure').reset_index().assign(group=g)
+            for g, edf in zip(cfg.GROUPS, est_dfs)
+            ], ignore_index=True)
+
+        runs = DataFrame({
+            'time': [datetime.now().isoformat(timespec='seconds')],
+            'nhosp': [len(scores)],
+            'quadrature': [bool(cfg.QUADRATURE)],
+            'rapidclus': [bool(cfg.RAPIDCLUS)],
+            })
+
+        for name, df in zip(TABLES, [scores, params, runs]):
+            df = df.assign(run=run, quarter=quarter)
+            df = df[KEYS[name] + [x for x in df if x not in KEYS[name]]]
+            self.hdf.append(
+                name, df, format='table', data_columns=KEYS[name],
+                min_itemsize={k: ITEMSIZE[k] for k in KEYS[name]},
+                index=False,
+                )
+            self.hdf.create_table_index(name, columns=KEYS[name], kind='full')
+
+    def select(self, table, **where):
+        """
+        Return the rows of `table` matching each `column=value` keyword, e.g.
+        `select('scores', PROVIDER_ID='010001')`.  A list value matches any of
+        its elements.
+        """
+        terms = [f'{k} in {list(map(str, v))!r}'
+                 if isinstance(v, (list, tuple)) else f'{k} == {str(v)!r}'
+                 for k, v in where.items()]
+        df = self.hdf.select(table, where=terms or None)
+        return df.reset_index(drop=True)
+
+    def runs(self):
+        return self.select('runs')
+
+    def provider(self, provider_id):
+        """Return one hospital's scores from every run, oldest first."""
+        df = self.select('scores', PROVIDER_ID=provider_id)
+        return df.sort_values(['quarter', 'run']).reset_index(drop=True)
+
+    def quarter(self, quarter, table='scores'):
+        """Return every run's rows of `table` for one quarter."""
+        return self.select(table, quarter=quarter)
+
+    def load_run(self, run, cfg=None):
+        """Return one run's (summary scores, model parameter DataFrames)."""
+        if cfg is None:
+            cfg = constants
+        scores = self.select('scores', run=run).set_index('PROVIDER_ID')
+        scores = scores[score_columns(cfg)]
+        params = self.select('params', run=run)
+        est_dfs = [
+            params[params['group'] == g].set_index('measure')[
+                ['mu', 'gamma', 'err']].rename_axis(None)
+            for g in cfg.GROUPS
+            ]
+        return scores, est_dfs
+
+    def to_csv(self, run, folder, cfg=None):
+        """Export one run as the usual CSV files in `folder`."""
+        scores, est_dfs = self.load_run(run, cfg)
+        os.makedirs(folder, exist_ok=True)
+        write_csv(scores, est_dfs, folder, cfg)
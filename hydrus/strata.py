@@ -0,0 +1,218 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Star ratings within peer groups of hospitals (strata).
+
+Each stratum is rated as if its hospitals were the whole data file: it is
+preprocessed on its own (so measures are dropped, standardized, and
+winsorized within the stratum), its groups get their own LVMs, and its
+summary scores are clustered into its own five star ratings.  But instead of
+a run of `main` per stratum, each with its own pool, every stratum's group
+data go into shared memory once (see `hydrus.multistart`), and all of the
+LVMs, then all of the strata's ratings, run as one batch on one pool.
+
+`STRATUM` names a column of the raw data to stratify by (or set it to
+`GROUPS_REPORTED` to stratify by how many measure groups each hospital
+reports).  `main` then writes one combined file of ratings,
+`{STRATA_FILE}.csv`, and one of model parameters.
+
+A stratum of fewer than `MIN_HOSPITALS` hospitals (or with fewer than that
+reporting any one measure) is too small to rate on its own, e.g. the few
+hospitals reporting only two groups.  Its hospitals, like those with no
+stratum, are listed with no scores or rating.
+"""
+import os
+import logging
+import multiprocessing
+from time import time
+
+import numpy as np
+from pandas import DataFrame, Series, concat
+
+from hydrus import constants
+from hydrus.utility import set_config
+from hydrus.instrument import RunReport
+from hydrus.preprocess import clean, preprocess, read_input
+from hydrus.model import group_inputs
+from hydrus.multistart import group_lvm, init_worker, share
+from hydrus.__main__ import make_outfolder, rate
+
+
+# A `STRATUM` setting: stratify by the number of groups hospitals report.
+GROUPS_REPORTED = 'GROUPS_REPORTED'
+
+
+def groups_reported(data, cfg):
+    """Return the number of measure groups each hospital in the raw `data`
+    has at least one measure in."""
+    df, final_meas = clean(data.copy(), cfg)
+    counts = sum(df[final_meas[g][0]].notnull().any(axis=1).astype(int)
+                 for g in cfg.GROUPS)
+    return counts.reindex(data.index, fill_value=0).rename(GROUPS_REPORTED)
+
+
+def fit_group(key):
+    """Fit and predict one stratum's group LVM from shared memory."""
+    lvm = group_lvm(key)
+    lvm.estimate()
+    preds = lvm.predict()
+    return key, lvm.final_ests, preds, lvm.ests_stats
+
+
+def rate_stratum(task):
+    nums, final_meas, pdfs, cfg = task
+    return rate(nums, final_meas, pdfs, cfg)
+
+
+def stratified(stratum, cfg=None, data=None, report=None):
+    """
+    Rate the hospitals within each stratum.  `stratum` is the name of a
+    column of the raw data (or `GROUPS_REPORTED`), or a Series giving each
+    hospital's stratum.
+
+    Return (summ_scores, est_df): every hospital's group scores, summary
+    scores, and star rating within its stratum, with a 'stratum' column; and
+    each stratum's model parameters, indexed by stratum, group and measure.
+    Hospitals with no stratum, or in one too small to rate, are left unrated
+    (NAN).
+    """
+    if cfg is None:
+        cfg = constants
+    if report is None:
+        report = RunReport()
+    groups = cfg.GROUPS
+
+    with report.stage('strata/load'):
+        if data is None:
+            data = read_input(os.path.join(constants.IN, cfg.INFILE))
+        if isinstance(stratum, Series):
+            strata = stratum.reindex(data.index)
+        elif stratum == GROUPS_REPORTED:
+            strata = groups_reported(data, cfg)
+        else:
+            strata, data = data[stratum], data.drop(stratum, axis=1)
+        sizes = strata.value_counts()
+        names = sorted(sizes.index[sizes >= cfg.MIN_HOSPITALS])
+        small = sorted(sizes.index[sizes < cfg.MIN_HOSPITALS])
+
+    # Each stratum is preprocessed as if it were the whole file.
+    prepped, shared, owner = {}, {}, {}
+    with report.stage('strata/preprocess'):
+        for s in names:
+            part = data[strata == s]
+            std_data, final_meas = preprocess(cfg=cfg, data=part)
+            if std_data.empty:  # (no measure has MIN_HOSPITALS hospitals)
+                small.append(s)
+                continue
+            prepped[s] = std_data, final_meas
+            for g in groups:
+                if final_meas[g][0]:  # (else no group score in this stratum)
+                    key = f'{s}/{g}'
+                    z, w = group_inputs(std_data, final_meas[g])
+                    shared[key] = share(z.values), share(w.values)
+                    owner[key] = s, g
+
+    names = [s for s in names if s in prepped]
+    unrated = ~strata.isin(names)
+    if unrated.any():
+        logging.warning(
+            f'leaving {unrated.sum()} hospitals unrated: '
+            f'{strata.isnull().sum()} with no stratum, and the rest in strata '
+            f'{small}, too small to rate (fewer than MIN_HOSPITALS '
+            f'({cfg.MIN_HOSPITALS}) hospitals, or with any measure)')
+
+    logging.info(f'fitting {len(shared)} LVMs for {len(names)} strata')
+    pool = None
+    if cfg.MULTIPROCESSING:
+        pool = multiprocessing.Pool(
+            os.cpu_count() or 1, initializer=init_worker,
+            initargs=(shared, cfg))
+    else:
+        init_worker(shared, cfg)
+    pmap = pool.map if pool else lambda f, x: list(map(f, x))
+    try:
+        with report.stage('strata/lvm'):
+            fits = {key: rest for key, *rest in pmap(fit_group, list(shared))}
+        tasks = []
+        for s in names:
+            std_data, final_meas = prepped[s]
+            pdfs = [
+                DataFrame({g: fits[f'{s}/{g}'][1] if f'{s}/{g}' in fits
+                           else np.nan}, std_data.index)
+                for g in groups]
+            nums = std_data[[x for g in groups for x in final_meas[g][0]]]
+            tasks.append((nums, final_meas, pdfs, cfg))
+        with report.stage('strata/rate'):
+            scores = pmap(rate_stratum, tasks)
+    except BaseException:
+        if pool:
+            pool.terminate()
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+        else:
+            init_worker({}, None)
+
+    est_dfs = []
+    for key, (ests, _, stats) in fits.items():
+        s, g = owner[key]
+        mu, gamma, err = ests
+        nums = prepped[s][1][g][0]
+        est_dfs.append(DataFrame(
+            {'stratum': s, 'group': g, 'measure': nums,
+             'mu': mu, 'gamma': gamma, 'err': err}))
+        report.record_group(key, nhosp=len(prepped[s][0]), nmeas=len(nums),
+                            estimate=stats)
+    est_df = concat(est_dfs).set_index(['stratum', 'group', 'measure'])
+
+    summ_scores = concat(
+        [x.assign(stratum=s) for s, x in zip(names, scores)])
+    if unrated.any():
+        rest = DataFrame(index=strata.index[unrated],
+                         columns=summ_scores.columns, dtype=float)
+        rest['stratum'] = strata[unrated]
+        summ_scores = concat([summ_scores, rest])
+    return summ_scores, est_df
+
+
+def write_strata(summ_scores, est_df, folder, cfg=None):
+    """Write the combined stratified ratings and parameters to `folder`."""
+    if cfg is None:
+        cfg = constants
+    output = summ_scores.rename(columns=dict(cfg.FRIENDLY_NAMES))
+    output = output.rename(columns={'stratum': 'Stratum'})
+    output.to_csv(os.path.join(folder, f'{cfg.STRATA_FILE}.csv'),
+                  float_format='%.5f')
+    est_df.to_csv(os.path.join(folder, f'{cfg.STRATA_FILE}_parameters.csv'),
+                  float_format='%.5f')
+
+
+def stratified_main(outdir=None, cfg=None, report=None, data=None):
+    """Run `main` within each of the strata in `cfg.STRATUM`."""
+    if cfg is None:
+        cfg = set_config()
+    if report is None:
+        report = RunReport()
+    summ_scores, est_df = stratified(cfg.STRATUM, cfg, data, report)
+    if cfg.WRITE_NOTHING:
+        return summ_scores
+    folder = make_outfolder(outdir or str(int(time())), cfg)
+    write_strata(summ_scores, est_df, folder, cfg)
+    report.save(folder, cfg.REPORT_FILE)
+    return summ_scores
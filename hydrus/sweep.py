@@ -0,0 +1,218 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Star ratings under other preprocessing rules.
+
+`sweep` takes a grid of preprocessing settings (`PARAMS`) and rates every
+combination of them.  The raw data are read once.  Variants that clean the
+data alike (the same `MIN_HOSPITALS` and `COMBINE_IMM3_OP27`) share the
+cleaned data and its column means and standard deviations, and differ only
+in how it is winsorized.
+
+Most settings leave most groups' LVM inputs untouched (e.g. IMM-3 and OP-27
+are in only one group), so each group's inputs are hashed, with the settings
+that change its fit, and each distinct input is fitted once, however many
+variants share it.  The fits, and then
+the variants' summary scores and clusters, run in parallel on one pool.
+
+Run `python -m hydrus.sweep` to write a summary of `GRID` to `OUT`.
+"""
+import os
+import logging
+import multiprocessing
+from hashlib import sha1
+from itertools import product
+from types import SimpleNamespace
+
+import numpy as np
+from pandas import DataFrame, concat
+
+from hydrus import constants
+from hydrus.instrument import RunReport
+from hydrus.model import group_inputs, worker
+from hydrus.preprocess import (
+    clean, column_stats, measure_columns, read_input, standardize)
+from hydrus.__main__ import rate
+
+
+# The settings a sweep can vary.
+PARAMS = ('MIN_HOSPITALS', 'WINSOR_LIMITS', 'COMBINE_IMM3_OP27')
+
+# The settings that change a group's fit from the same inputs, and so are
+# hashed along with them: the likelihood, the optimizer's start, bounds and
+# tolerance, and the kind of `Lvm` (see `make_lvm`).
+FIT_SETTINGS = (
+    'QUADRATURE', 'QCOUNT', 'ADAPTIVE_QUADRATURE', 'QUAD_TOL', 'TOL',
+    'INITIAL_LVM_PARAMS', 'EXACT_BOUNDS', 'QUAD_BOUNDS', 'COMPACT', 'CHUNKED',
+    'CHUNK_ROWS', 'THREADS')
+
+# The grid swept by `python -m hydrus.sweep`.
+GRID = {
+    'MIN_HOSPITALS': [101, 501],
+    'WINSOR_LIMITS': [(-3., 3.), (-2.5, 2.5), (-4., 4.)],
+    'COMBINE_IMM3_OP27': [True, False],
+    }
+
+
+def variants(grid):
+    """
+    Return every combination of the settings in `grid`, a dict of each
+    setting's values, as a list of dicts.
+    """
+    unknown = set(grid) - set(PARAMS)
+    if unknown:
+        raise ValueError(f'can only sweep over {PARAMS}, not {unknown}')
+    return [dict(zip(grid, values)) for values in product(*grid.values())]
+
+
+def variant_config(cfg, settings):
+    """Return a copy of `cfg` with `settings` applied."""
+    new = SimpleNamespace(**vars(cfg))
+    for k, v in settings.items():
+        setattr(new, k, v)
+    return new
+
+
+def inputs_key(data, meas_filter, cfg=None):
+    """Return a hash of a group's LVM inputs from its standardized data,
+    and of the `FIT_SETTINGS` in `cfg` it would be fitted with."""
+    cfg = cfg or constants
+    z, w = group_inputs(data, meas_filter)
+    h = sha1()
+    h.update(repr([getattr(cfg, x, None) for x in FIT_SETTINGS]).encode())
+    for x in [z.values, w.values]:
+        h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    for labels in [z.index, z.columns]:
+        h.update('\0'.join(map(str, labels)).encode())
+        h.update(b'\1')
+    return h.hexdigest()
+
+
+def rate_variant(task):
+    """Rate one variant from its group data and fits."""
+    parts, final_meas, pdfs, cfg = task
+    return rate(concat(parts, axis=1), final_meas, pdfs, cfg)
+
+
+def sweep(grid, cfg=None, data=None, fits=None, report=None):
+    """
+    Rate every combination of the preprocessing settings in `grid` (see
+    `variants`), with the rest of the settings taken from `cfg`.  `data` is
+    the raw data, if already loaded.  `fits` is a dict of earlier fits from
+    `sweep`, keyed by a hash of their inputs and fit settings (see
+    `inputs_key`), to reuse; it is updated with the new ones.
+
+    Return (summary, scores).  `summary` has a row for each variant with its
+    settings, how many groups had to be fitted for it, and how its star
+    ratings differ from the first variant's.  `scores` is a list of each
+    variant's summary scores and star ratings.
+    """
+    if cfg is None:
+        cfg = constants
+    if fits is None:
+        fits = {}
+    if report is None:
+        report = RunReport()
+    settings = variants(grid)
+    groups = cfg.GROUPS
+
+    with report.stage('sweep/load'):
+        if data is None:
+            data = read_input(os.path.join(constants.IN, cfg.INFILE))
+
+    # Standardize each variant's data, sharing the cleaned data and column
+    # stats between variants that clean alike, and hash each group's inputs.
+    cleaned, tasks, inputs = {}, {}, []
+    with report.stage('sweep/preprocess'):
+        for s in settings:
+            vcfg = variant_config(cfg, s)
+            ckey = vcfg.MIN_HOSPITALS, vcfg.COMBINE_IMM3_OP27
+            if ckey not in cleaned:
+                df, final_meas = clean(data.copy(), vcfg)
+                stats = column_stats(df, measure_columns(df))
+                cleaned[ckey] = df, final_meas, stats
+            df, final_meas, stats = cleaned[ckey]
+
+            parts, keys = [], []
+            for g in groups:
+                nums, dens = final_meas[g]
+                part = standardize(df[nums + dens].copy(), nums, vcfg, stats)
+                key = inputs_key(part, final_meas[g], vcfg)
+                if key not in fits:
+                    tasks.setdefault(key, (part, final_meas[g], g, vcfg))
+                parts.append(part[nums])
+                keys.append(key)
+            inputs.append((parts, final_meas, keys, vcfg))
+
+    nfits = len(settings) * len(groups)
+    logging.info(f'{len(settings)} variants: fitting {len(tasks)} of '
+                 f'{nfits} group LVMs')
+    pool = None
+    if cfg.MULTIPROCESSING:
+        pool = multiprocessing.Pool(os.cpu_count() or 1)
+    pmap = pool.map if pool else lambda f, x: list(map(f, x))
+    try:
+        with report.stage('sweep/lvm'):
+            for key, (result, worker_report) in zip(
+                    tasks, pmap(worker, tasks.values())):
+                fits[key] = result
+                report.merge(worker_report)
+        with report.stage('sweep/rate'):
+            scores = pmap(rate_variant, [
+                (parts, final_meas, [fits[k][1] for k in keys], vcfg)
+                for parts, final_meas, keys, vcfg in inputs
+                ])
+    finally:
+        if pool:
+            pool.close()
+
+    # Groups count as fitted for the first variant that needed them.
+    rows, seen = [], set()
+    base = scores[0]
+    for s, summ, (_, _, keys, _) in zip(settings, scores, inputs):
+        new = [k for k in keys if k in tasks and k not in seen]
+        seen.update(new)
+        common = base.index.intersection(summ.index)
+        change = (summ.loc[common, 'cluster_name']
+                  - base.loc[common, 'cluster_name'])
+        shift = (summ.loc[common, 'summary']
+                 - base.loc[common, 'summary']).abs()
+        rows.append({
+            **{k: repr(v) if isinstance(v, tuple) else v
+               for k, v in s.items()},
+            'nhosp': len(summ),
+            'fitted': len(new),
+            'reused': len(keys) - len(new),
+            'stars_up': int((change > 0).sum()),
+            'stars_down': int((change < 0).sum()),
+            'mean_summary_shift': shift.mean(),
+            'max_summary_shift': shift.max(),
+            })
+    report.record_group(
+        'sweep', variants=len(settings), fitted=len(tasks), groups=nfits)
+    return DataFrame(rows), scores
+
+
+if __name__ == '__main__':
+    from hydrus.utility import set_config
+
+    cfg = set_config()
+    summary, _ = sweep(GRID, cfg)
+    if not os.path.exists(cfg.OUT):
+        os.mkdir(cfg.OUT)
+    summary.to_csv(os.path.join(cfg.OUT, f'{cfg.SWEEP_FILE}.csv'),
+                   float_format='%.5f', index=False)
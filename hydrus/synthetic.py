@@ -0,0 +1,111 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Generate synthetic CMS-like hospital data by drawing from the LVM itself.
+
+The result has the same columns as CMS's SAS input file (measure scores,
+`_DEN` denominators, IMM-3 and OP-27 as separate measures, and the patient
+experience survey counts), so it can be fed straight to `preprocess`.
+"""
+import os
+
+import numpy as np
+from pandas import DataFrame
+
+from hydrus import constants
+from hydrus.utility import set_config
+
+
+def raw_measures(cfg, group):
+    """Return the measure columns CMS's raw file has for a measure group."""
+    meas = []
+    for m in cfg.MEAS_GROUPS[group]:
+        meas.extend(['IMM_3', 'OP_27'] if m == 'IMM_3_OP_27' else [m])
+    return meas
+
+
+def synthetic_data(nhosp=None, cfg=None, groups=None, missing=0.2,
+                   group_missing=0.1, denominators=(25, 2500), seed=None):
+    """
+    Draw a raw hospital data set of `nhosp` hospitals from the LVM.
+
+    Each hospital gets a latent quality score for each measure group, and
+    each measure score is drawn as mu + gamma * alpha + err * noise.  A
+    hospital reports a whole group with probability 1 - `group_missing`, and
+    then each measure in the group with probability 1 - `missing`.
+    Denominators are drawn log-uniformly between the `denominators` bounds.
+    """
+    if cfg is None:
+        cfg = set_config()
+    if nhosp is None:
+        nhosp = cfg.SYNTH_NHOSP
+    if groups is None:
+        groups = cfg.GROUPS
+    rng = np.random.RandomState(seed)
+    lo, hi = np.log(denominators)
+    flipped = set(cfg.FLIPPED_MEASURES)
+
+    # Patient experience weights come from the survey counts.
+    surveyed = rng.uniform(size=nhosp) >= group_missing
+    cols = {
+        'H_NUMB_COMP': np.where(
+            surveyed, np.floor(np.exp(rng.uniform(lo, hi, nhosp))), np.nan),
+        'H_RESP_RATE_P': np.where(
+            surveyed, rng.uniform(10, 50, nhosp).round(), np.nan),
+        }
+
+    for g in groups:
+        alpha = rng.standard_normal(nhosp)
+        reports = rng.uniform(size=nhosp) >= group_missing
+        for m in raw_measures(cfg, g):
+            gamma = rng.uniform(.3, .9)
+            err = np.sqrt(1 - gamma**2)
+            score = gamma * alpha + err * rng.standard_normal(nhosp)
+            if m in flipped:
+                score = -score
+
+            # Put each measure on its own arbitrary scale, like CMS's data.
+            score = rng.uniform(-50, 50) + rng.uniform(1, 20) * score
+
+            observed = reports & (rng.uniform(size=nhosp) >= missing)
+            cols[m] = np.where(observed, score, np.nan)
+            if m.startswith('H_'):
+                # Survey measures use `PATIENTEXP_DENOM_COLS` instead.
+                cols[m] = np.where(surveyed, cols[m], np.nan)
+            else:
+                den = np.floor(np.exp(rng.uniform(lo, hi, nhosp)))
+                cols[m + '_DEN'] = np.where(observed, den, np.nan)
+
+    df = DataFrame(cols, index=[f'{i:06d}' for i in range(nhosp)])
+    df.index.name = 'PROVIDER_ID'
+    return df
+
+
+def write_synthetic(path, **kwargs):
+    """Write a synthetic data set to a CSV or pickle file at `path`."""
+    df = synthetic_data(**kwargs)
+    if os.path.splitext(path)[1].lower() == '.csv':
+        df.to_csv(path)
+    else:
+        df.to_pickle(path)
+    return df
+
+
+if __name__ == '__main__':
+    f = os.path.join(constants.IN, 'synthetic.pkl')
+    write_synthetic(f, seed=0)
+    print('Synthetic data written to', os.path.abspath(f))
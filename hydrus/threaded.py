@@ -0,0 +1,117 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Fit the LVMs on a thread pool.
+
+`oparallel` sends a pickled copy of the data to each worker process, and
+each process compiles the JIT functions again.  Here the groups are fitted
+by threads in one process, sharing the data.  The loglikelihood, gradient,
+and prediction kernels in `hydrus.norm` release the GIL, so the threads
+spend most of their time running in parallel.
+
+Without `JIT`, the NumPy versions in `hydrus.model` are used instead.  (Much
+of NumPy's work releases the GIL too, but less of it.)
+"""
+import os
+import logging
+import threading
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from hydrus import constants
+from hydrus.instrument import RunReport, peak_rss
+from hydrus.model import Lvm, QC1, QC2, outcomes
+if constants.JIT:
+    from hydrus.norm import (
+        ll_exact_nogil as ll_exact, ll_grad_nogil as ll_grad_exact,
+        ll_quad_nogil, post_mode_nogil as post_mode)
+else:
+    from hydrus.model import ll_exact, ll_grad_exact, ll_quad, post_mode
+
+    def ll_quad_nogil(params, z, w, qc1, qc2):
+        return ll_quad(params, z, w, len(qc1))
+
+
+class NogilLvm(Lvm):
+    """
+    A variant of `Lvm` that evaluates its objective function, gradient, and
+    predictions with the GIL-free kernels.
+
+    With the exact integral, the objective function returns its analytic
+    gradient.  Predictions are the closed-form posterior modes, the same
+    values `Lvm.predict` finds by numerical optimization.
+    """
+    def __init__(self, z, w, name='', quadrature=None, cfg=None):
+        super().__init__(z, w, name, quadrature, cfg)
+        if self.ests_ll == self.ests_ll_exact:
+            self.ests_jac = True  # `ests_obj` returns the gradient as well
+
+    def set_data(self, z, w):
+        super().set_data(z, w)
+        self.z, self.w = (
+            np.ascontiguousarray(x, dtype=np.float64) for x in (self.z, self.w))
+
+    def ests_ll_quad(self, params):
+        return ll_quad_nogil(params, self.z, self.w, QC1, QC2)
+
+    def ests_ll_exact(self, params):
+        return ll_exact(params, self.num2, self.w2)
+
+    def ests_obj(self, params):
+        """
+        The objective function to minimize for the model parameters, and (for
+        the exact integral) its gradient.
+        """
+        if not self.ests_jac:
+            return super().ests_obj(params)
+        t0 = perf_counter()
+        obj = -np.nansum(ll_exact(params, self.num2, self.w2))
+        grad = -ll_grad_exact(params, self.num2, self.w2)
+        self.tobj += perf_counter() - t0
+        self.nobj += 1
+        return obj, grad
+
+    def predict(self):
+        """Predict the random effects."""
+        params = np.concatenate(self.final_ests)
+        self.final_preds = post_mode(params, self.z, self.w)
+        self.preds_stats = {'obj_evals': 0}
+        return self.final_preds
+
+
+def othreaded(std_data, final_meas, groups=None, cfg=None, report=None):
+    """Calculate the hospital group scores for each LVM on a thread pool."""
+    if cfg is not None:
+        groups = cfg.GROUPS
+    if report is None:
+        report = RunReport()
+
+    def fit(g):
+        result = outcomes(std_data, final_meas[g], g, cfg, report)
+        report.record_worker(
+            thread=threading.current_thread().name, group=g)
+        return result
+
+    nthreads = min(len(groups), os.cpu_count() or 1)
+    logging.info(f'fitting {len(groups)} groups on {nthreads} threads')
+    with ThreadPoolExecutor(nthreads) as pool:
+        results = list(pool.map(fit, groups))
+    report.record_worker(
+        pid=os.getpid(), threads=nthreads, peak_rss_bytes=peak_rss())
+    return zip(*results)
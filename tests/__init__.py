@@ -20,6 +20,11 @@ import numpy as np
 from numpy.testing import assert_almost_equal, assert_approx_equal
 from scipy import stats
 
+try:
+    from pandas.util.testing import assert_frame_equal
+except ImportError:  # (pandas 2 keeps it only in pandas.testing)
+    from pandas.testing import assert_frame_equal
+
 from hypothesis.strategies import floats
 from hypothesis.extra.numpy import arrays
 
@@ -16,7 +16,15 @@ sas_stars = [
 #     >>> from hydrus.utility import set_config
 #     >>> print(repr(set_config()))
 cfg = namespace(
+    ADAPTIVE_QUADRATURE=False,
+    BASELINE_FILE='correction_baseline',
+    CHUNKED=False,
+    CHUNK_DIR=None,
+    CHUNK_ROWS=100000,
     CLUSTER_NAMES=[1, 2, 3, 4, 5],
+    COMBINE_IMM3_OP27=True,
+    COMPACT=False,
+    CORRECTIONS=None,
     EST_FILE='model_parameters_{}',
     EXACT_BOUNDS=((None, None), (None, None), (None, None)),
     FLIPPED_MEASURES=[
@@ -38,14 +46,18 @@ cfg = namespace(
         ('summary', 'Summary Score'),
         ('summary_win', 'Winsorized Summary Score'),
         ('cluster_name', 'Star Rating')),
+    FUSED=False,
     GROUPS=['mortality', 'safety', 'read', 'patientexp', 'efficiency', 'timeliness', 'effectiveness'],
     GROUP_WEIGHTS=[
         ['mortality', 0.22], ['safety', 0.22], ['read', 0.22], ['patientexp', 0.22],
         ['efficiency', 0.04], ['timeliness', 0.04], ['effectiveness', 0.04]],
     IN='input',
     INFILE='SAS_Data-Input_Oct2016.sas7bdat',
+    INFLUENCE_FILE='measure_influence',
     INITIAL_LVM_PARAMS=(0.025, 0.5, 0.88),
     JIT=True,
+    KMEANS_SEED=0,
+    MARGIN_FILE='star_margins',
     MEASURE_SETTINGS='measure_settings_2016_10.yml',
     MEAS_GROUPS={
         'mortality': ['MORT_30_AMI', 'MORT_30_CABG', 'MORT_30_COPD', 'MORT_30_HF', 'MORT_30_PN', 'MORT_30_STK', 'PSI_4_SURG_COMP'],
@@ -55,19 +67,39 @@ cfg = namespace(
         'efficiency': ['OP_8', 'OP_10', 'OP_11', 'OP_13', 'OP_14'],
         'timeliness': ['ED_1B', 'ED_2B', 'OP_1', 'OP_2', 'OP_3B', 'OP_5', 'OP_18B', 'OP_20', 'OP_21'],
         'effectiveness': ['AMI_7A', 'CAC_3', 'IMM_2', 'IMM_3_OP_27', 'OP_4', 'OP_22', 'OP_23', 'OP_29', 'OP_30', 'PC_01', 'STK_1', 'STK_4', 'STK_6', 'STK_8', 'VTE_1', 'VTE_2', 'VTE_3', 'VTE_5', 'VTE_6']},
+    MEMORY_BUDGET=None,
+    MEMORY_FRACTION=0.8,
+    MIN_HOSPITALS=101,
+    MOVERS_FILE='star_movers',
     MULTIPROCESSING=True,
+    MULTISTART=0,
+    MULTISTART_BUDGET=20,
+    NODES=None,
+    NODE_AUTHKEY=None,
     OUT='output',
     PATIENTEXP_DENOM_COLS=[
         'H_CLEAN_HSP_LINEAR_DEN', 'H_COMP_1_LINEAR_DEN', 'H_COMP_2_LINEAR_DEN', 'H_COMP_3_LINEAR_DEN',
         'H_COMP_4_LINEAR_DEN', 'H_COMP_5_LINEAR_DEN', 'H_COMP_6_LINEAR_DEN', 'H_COMP_7_LINEAR_DEN',
         'H_HSP_RATING_LINEAR_DEN', 'H_QUIET_HSP_LINEAR_DEN', 'H_RECMND_LINEAR_DEN'],
+    PIPELINED=False,
     QCOUNT=30,
     QUADRATURE=True,
+    QUARTER=None,
     QUAD_BOUNDS=((None, None), (None, None), (0.0001, None)),
+    QUAD_TOL=1e-08,
     RAPIDCLUS=True,
+    REPORT_FILE='run_report',
+    RESULTS_STORE='results.h5',
     SAVE_DEBUG=False,
     STAR_FILE='star_ratings',
+    STRATA_FILE='stratified_star_ratings',
+    STRATUM=None,
+    SWEEP_FILE='preprocessing_sweep',
+    SYNTH_NHOSP=4500,
+    THREADS=False,
     TOL=1e-15,
+    WINSOR_LIMITS=(-3.0, 3.0),
+    WRITE_CSV=True,
     WRITE_NOTHING=True
     )
 
@@ -0,0 +1,147 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+import numpy as np
+import pytest
+from numpy.testing import assert_allclose
+from pandas import DataFrame, Series
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.__main__ import main
+from hydrus.corrections import (
+    Baseline, apply_delta, baseline_key, correct, moments, star_movers,
+    update_moments)
+from tests import assert_frame_equal
+
+
+def test_update_moments():
+    rng = np.random.RandomState(0)
+    col = Series(rng.standard_normal(50))
+    col[[3, 7]] = np.nan
+    new = col.copy()
+    new[[1, 3, 9]] = [5., 2., np.nan]  # changed, added, removed
+    rows = [1, 3, 9]
+    assert_allclose(
+        update_moments(moments(col), col[rows].values, new[rows].values),
+        moments(new))
+
+
+def test_correct():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.QUADRATURE, cfg.RAPIDCLUS = False, False, True
+    raw = synthetic_data(300, cfg=cfg, seed=0)
+    base = Baseline.run(raw, cfg)
+
+    col = 'MORT_30_AMI'
+    pids = raw.index[raw[col].notnull()][:5]
+    delta = DataFrame({
+        'PROVIDER_ID': pids, 'measure': col,
+        'value': raw.loc[pids, col] + raw[col].std() * 3,
+        'denominator': raw.loc[pids, f'{col}_DEN']})
+    new, movers, groups = correct(base, delta, cfg)
+    assert groups == ['mortality']
+
+    # The same as rerunning everything, but for where the warm start stops.
+    full = Baseline.run(apply_delta(raw, delta), cfg)
+    assert_allclose(new.std_data.values, full.std_data.values, atol=1e-12)
+    for a, b in zip(new.edfs + new.pdfs, full.edfs + full.pdfs):
+        assert_allclose(a.values, b.values, atol=1e-5)
+    assert (new.summ_scores['cluster_name']
+            == full.summ_scores['cluster_name']).all()
+    assert_frame_equal(movers, star_movers(base.summ_scores, full.summ_scores))
+    for g, a, b in zip(cfg.GROUPS, new.edfs, base.edfs):
+        if g != 'mortality':
+            assert a is b
+
+    with pytest.raises(ValueError):
+        apply_delta(raw, delta.assign(PROVIDER_ID='missing'))
+    with pytest.raises(ValueError):
+        apply_delta(raw, delta.assign(measure='missing'))
+
+
+def test_corrections_main(tmpdir):
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.QUADRATURE, cfg.RAPIDCLUS = False, False, True
+    cfg.OUT, cfg.RESULTS_STORE = str(tmpdir), None
+    raw = synthetic_data(300, cfg=cfg, seed=0)
+    pid = raw.index[raw['READM_30_HF'].notnull()][0]
+    cfg.CORRECTIONS = str(tmpdir.join('delta.csv'))
+    DataFrame({'PROVIDER_ID': [pid], 'measure': ['READM_30_HF'],
+               'value': [.5], 'denominator': [100.]}).to_csv(
+                   cfg.CORRECTIONS, index=False)
+
+    # The first run makes the baseline; the second starts from it.
+    first = main('first', cfg=cfg, data=raw)
+    assert os.path.exists(tmpdir.join(f'{cfg.BASELINE_FILE}.pkl'))
+    assert os.path.exists(tmpdir.join('first', f'{cfg.MOVERS_FILE}.csv'))
+    second = main('second', cfg=cfg)
+    assert (first['cluster_name'] == second['cluster_name']).all()
+
+
+def test_corrections_main_stale(tmpdir, monkeypatch):
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.QUADRATURE, cfg.RAPIDCLUS = False, False, True
+    cfg.OUT, cfg.RESULTS_STORE = str(tmpdir), None
+    raw = synthetic_data(300, cfg=cfg, seed=0)
+    pid = raw.index[raw['READM_30_HF'].notnull()][0]
+    cfg.CORRECTIONS = str(tmpdir.join('delta.csv'))
+    DataFrame({'PROVIDER_ID': [pid], 'measure': ['READM_30_HF'],
+               'value': [.5], 'denominator': [100.]}).to_csv(
+                   cfg.CORRECTIONS, index=False)
+    path = str(tmpdir.join(f'{cfg.BASELINE_FILE}.pkl'))
+    main('first', cfg=cfg, data=raw)
+    key = Baseline.load(path).key
+    assert key == baseline_key(cfg)
+
+    # A baseline from another input file is run again from that file.
+    read = []
+    monkeypatch.setattr('hydrus.corrections.read_input',
+                        lambda path: read.append(path) or raw)
+    cfg.INFILE = 'next_quarter.sas7bdat'
+    main('second', cfg=cfg)
+    assert read and read[0].endswith(cfg.INFILE)
+    assert Baseline.load(path).key == baseline_key(cfg) != key
+
+    # So is one made with other settings, and given raw data always are.
+    cfg.TOL = 1e-8
+    assert baseline_key(cfg) != Baseline.load(path).key
+    main('third', cfg=cfg)
+    assert len(read) == 2
+    fewer = raw.iloc[:-1]
+    main('fourth', cfg=cfg, data=fewer)
+    assert len(read) == 2
+    assert Baseline.load(path).raw.index.equals(fewer.index)
+
+
+def test_correct_kmeans():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.QUADRATURE, cfg.RAPIDCLUS = False, False, False
+    cfg.KMEANS_SEED = None
+    raw = synthetic_data(300, cfg=cfg, seed=2)  # (unseeded k-means varies)
+    base = Baseline.run(raw, cfg)
+
+    # A correction to the values already there moves no one.
+    col = 'MORT_30_AMI'
+    pids = raw.index[raw[col].notnull()][:3]
+    delta = DataFrame({
+        'PROVIDER_ID': pids, 'measure': col, 'value': raw.loc[pids, col],
+        'denominator': raw.loc[pids, f'{col}_DEN']})
+    for _ in range(5):
+        _, movers, groups = correct(base, delta, cfg)
+        assert groups == [] and movers.empty
@@ -0,0 +1,77 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import os
+import json
+from time import sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.__main__ import main
+from hydrus.dag import Dag
+from tests import assert_frame_equal
+
+
+def test_dag():
+    dag = Dag()
+    dag.add('a', lambda: sleep(.05) or 1)
+    dag.add('b', lambda: 2)
+    dag.add('c', lambda a, b: sleep(.05) or a + b, ['a', 'b'])
+    dag.add('d', lambda b: b * 10, ['b'])
+    with pytest.raises(ValueError):
+        dag.add('e', lambda x: x, ['missing'])
+    with ThreadPoolExecutor(2) as pool:
+        results = dag.run({'io': pool})
+    assert results == {'a': 1, 'b': 2, 'c': 3, 'd': 20}
+    assert dag.times['c'][0] >= dag.times['a'][1]
+    seconds, chain = dag.critical_path()
+    assert chain == ['a', 'c'] and seconds >= .1
+
+    dag.add('fail', lambda c: 1 / 0, ['c'])
+    with ThreadPoolExecutor(2) as pool:
+        with pytest.raises(ZeroDivisionError):
+            dag.run({'io': pool})
+
+
+def test_pipelined_main(tmpdir):
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS, cfg.RESULTS_STORE = False, True, None
+    cfg.OUT = str(tmpdir)
+    data = synthetic_data(300, cfg=cfg, seed=0)
+    expected = main('staged', cfg=cfg, data=data)
+    cfg.PIPELINED = True
+    summ_scores = main('pipelined', cfg=cfg, data=data)
+    assert_frame_equal(summ_scores, expected)
+
+    staged, pipelined = (tmpdir.join(x) for x in ['staged', 'pipelined'])
+    assert sorted(os.listdir(pipelined)) == sorted(os.listdir(staged))
+    for f in os.listdir(staged):
+        if f.endswith('.csv'):
+            assert pipelined.join(f).read() == staged.join(f).read()
+
+    with open(pipelined.join(f'{cfg.REPORT_FILE}.json')) as infile:
+        report = json.load(infile)
+    tasks = {x['name']: x for x in report['tasks']}
+    for g in cfg.GROUPS:
+        assert tasks[f'{g}/fit']['start'] >= (
+            tasks[f'{g}/standardize']['start']
+            + tasks[f'{g}/standardize']['seconds'])
+    pipeline = report['groups']['pipeline']
+    assert pipeline['critical_path'][0] == 'load'
+    assert pipeline['critical_path_seconds'] <= pipeline['wall_seconds'] + 1e-6
@@ -0,0 +1,78 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+from types import SimpleNamespace
+
+import pytest
+from numpy.testing import assert_allclose
+
+from hydrus import constants
+from hydrus.model import Lvm, oserial
+from hydrus.chunked import ChunkedLvm
+from hydrus.distributed import Cluster, DistributedLvm, odistributed
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+from tests.test_model import lvm_data
+
+
+def test_distributed_lvm():
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.QUADRATURE = False
+    z, w = lvm_data()
+    dense, chunked = Lvm(z, w, cfg=cfg), ChunkedLvm(z, w, cfg=cfg)
+    with Cluster(3) as cluster:
+        lvm = DistributedLvm(z, w, cfg=cfg, cluster=cluster)
+        params = dense.ests_init + .1
+        assert_allclose(lvm.ests_ll(params), dense.ests_ll(params))
+
+        # Same optimizer, same analytic gradient: the same path as
+        # `ChunkedLvm`, up to the order of the sums.
+        assert_allclose(lvm.estimate(), chunked.estimate(), atol=1e-6)
+        assert_allclose(lvm.predict(), chunked.predict(), atol=1e-6)
+        assert all(x['calls'] > 0 for x in cluster.stats())
+
+        with pytest.raises(RuntimeError, match='KeyError'):
+            cluster.broadcast(('obj', 'missing', params))
+        assert_allclose(lvm.ests_ll(params), dense.ests_ll(params))
+
+        lvm.drop()
+        assert cluster.shards == {}
+        with pytest.raises(RuntimeError, match='KeyError'):
+            lvm.ests_ll(params)
+
+    with pytest.raises(ValueError):
+        cfg.QUADRATURE = True
+        DistributedLvm(z, w, cfg=cfg, cluster=cluster)
+
+
+def test_odistributed():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.QUADRATURE, cfg.NODES = False, False, 2
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(300, cfg=cfg, seed=0))
+    edfs, pdfs = odistributed(std_data, final_meas, cfg=cfg)
+    expected_edfs, expected_pdfs = oserial(std_data, final_meas, cfg=cfg)
+    for a, b in zip(edfs, expected_edfs):
+        assert_allclose(a.values, b.values, atol=1e-3)
+    for a, b in zip(pdfs, expected_pdfs):
+        assert_allclose(a.values, b.values, atol=1e-3)
+
+
+def test_cluster_authkey(monkeypatch):
+    monkeypatch.delenv('HYDRUS_AUTHKEY', raising=False)
+    with pytest.raises(ValueError, match='HYDRUS_AUTHKEY'):
+        Cluster(['localhost:6000'])
@@ -0,0 +1,116 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+# pytest tests/test_download.py
+import io
+import os
+import threading
+from hashlib import sha1
+from zipfile import ZipFile
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+import pytest
+
+import download_cms_data as dl
+
+
+def make_zip(name, size):
+    bio = io.BytesIO()
+    with ZipFile(bio, 'w') as z:
+        z.writestr(name, os.urandom(size))  # (incompressible)
+    return bio.getvalue()
+
+
+FILES = {
+    '/a.zip': make_zip('a.sas7bdat', 300000),
+    '/b.zip': make_zip('b.sas7bdat', 200000),
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serve `FILES`, honoring ranges and dropping the first connection for
+    each file partway through."""
+    dropped, requests = set(), []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        data = FILES[path]
+        rng = self.headers.get('Range')
+        self.requests.append((path, rng))
+        start = int(rng.split('=')[1].rstrip('-')) if rng else 0
+        if start >= len(data):
+            self.send_response(416)
+            self.end_headers()
+            return
+        self.send_response(206 if rng else 200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        if path not in self.dropped:
+            self.dropped.add(path)
+            self.wfile.write(data[start:start + len(data) // 3])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(data[start:])
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def server():
+    srv = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    Handler.dropped.clear()
+    del Handler.requests[:]
+    yield 'http://127.0.0.1:{}/{{filename}}?blob={{blob}}'.format(
+        srv.server_address[1])
+    srv.shutdown()
+    srv.server_close()
+
+
+def files():
+    return [(0, k.lstrip('/'), sha1(v).hexdigest()) for k, v in FILES.items()]
+
+
+def test_download_resume(server, tmpdir):
+    dest = str(tmpdir)
+    assert dl.download_all(files(), url=server, dest=dest) == [True, True]
+    for name in ['a.sas7bdat', 'b.sas7bdat']:
+        assert os.path.isfile(os.path.join(dest, name))
+
+    # Each file was resumed with a range request after being cut off.
+    for path in FILES:
+        reqs = [r for p, r in Handler.requests if p == path]
+        assert reqs[0] is None and reqs[1].startswith('bytes=')
+
+    # A second run finds the files already present and downloads nothing.
+    del Handler.requests[:]
+    assert dl.download_all(files(), url=server, dest=dest) == [True, True]
+    assert Handler.requests == []
+
+
+def test_download_bad_hash(server, tmpdir):
+    path = str(tmpdir.join('a.zip'))
+    with pytest.raises(dl.WrongSha1Error):
+        dl.fetch(server.format(filename='a.zip', blob=0), path, '0' * 40)
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + '.part')
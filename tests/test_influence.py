@@ -0,0 +1,88 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+from hydrus.model import Lvm, group_inputs, oserial
+from hydrus.influence import (
+    drop_measure, group_influence, hospital_influence, measure_influence)
+from hydrus.__main__ import rate
+
+
+def test_measure_influence():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS, cfg.QUADRATURE = False, True, False
+    data = synthetic_data(400, cfg=cfg, seed=2)
+    std_data, final_meas = preprocess(cfg=cfg, data=data)
+    edfs, pdfs = oserial(std_data, final_meas, cfg=cfg)
+
+    influence, stars = measure_influence(
+        std_data, final_meas, edfs, pdfs, cfg)
+    nmeas = sum(len(final_meas[g][0]) for g in cfg.GROUPS)
+    assert len(influence) == nmeas and stars.shape == (len(std_data), nmeas)
+    assert (influence.stars_changed >= 0).all()
+
+    # The warm-started refit matches a cold run without the measure.
+    g = 'mortality'
+    measure = final_meas[g][0][1]
+    meas = dict(final_meas)
+    meas[g] = drop_measure(final_meas[g], 1)
+    _, cold = oserial(std_data, meas, cfg=cfg)
+    cold = rate(std_data, meas, cold, cfg)
+    assert (stars[measure] == cold['cluster_name']).mean() > .99
+
+    base = rate(std_data, final_meas, [p.copy() for p in pdfs], cfg)
+    shift = (cold['summary'] - base['summary']).abs()
+    assert np.isclose(
+        influence.loc[measure, 'mean_summary_shift'], shift.mean(),
+        rtol=1e-2)
+
+
+def test_hospital_influence():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS, cfg.QUADRATURE = False, True, False
+    data = synthetic_data(300, cfg=cfg, seed=4)
+    std_data, final_meas = preprocess(cfg=cfg, data=data)
+    edfs, pdfs = oserial(std_data, final_meas, cfg=cfg)
+
+    # The approximate parameter shifts match refits without the hospital:
+    # closely for typical hospitals, and roughly for the most influential.
+    g = 'safety'
+    z, w = group_inputs(std_data, final_meas[g])
+    full = Lvm(z, w, cfg=cfg)
+    full.estimate()
+    params = np.concatenate(full.final_ests)
+    shifts, _, _ = group_influence(params, z.values, w.values)
+    ranked = np.argsort(-abs(shifts).sum(axis=1))
+    for i in [*ranked[:2], *ranked[100:103]]:
+        keep = np.arange(len(z)) != i
+        lvm = Lvm(z[keep], w[keep], cfg=cfg)
+        lvm.estimate(params)
+        actual = np.concatenate(lvm.final_ests) - params
+        assert np.corrcoef(shifts[i], actual)[0, 1] > .85
+        if i in ranked[100:]:
+            assert np.abs(shifts[i] - actual).max() < .05 * abs(actual).max()
+
+    summ_scores, centers = rate(
+        std_data, final_meas, pdfs, cfg, return_centers=True)
+    out = hospital_influence(
+        std_data, final_meas, edfs, summ_scores, centers, cfg)
+    assert len(out) == len(std_data)
+    assert (out[[f'{g}_influence' for g in cfg.GROUPS]] >= 0).all().all()
+    assert 0 < out['flag'].sum() < .1 * len(out)
@@ -0,0 +1,47 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import json
+
+import numpy as np
+
+from hydrus.instrument import RunReport, pickled_size
+
+
+def test_run_report(tmpdir):
+    report = RunReport()
+    with report.stage('outer'):
+        with report.stage('inner'):
+            pass
+    assert [x['name'] for x in report.stages] == ['inner', 'outer']
+
+    worker = RunReport()
+    worker.record_group('mortality', nhosp=10, estimate={'nfev': np.int64(3)})
+    worker.record_worker(pid=1, peak_rss_bytes=None)
+    report.merge(worker.as_dict())
+    report.record_group('mortality', nmeas=2)
+
+    report.save(str(tmpdir), 'run_report')
+    with open(tmpdir.join('run_report.json')) as infile:
+        saved = json.load(infile)
+    assert saved['groups']['mortality'] == {
+        'nhosp': 10, 'nmeas': 2, 'estimate': {'nfev': 3}}
+    assert saved['workers'] == [{'pid': 1, 'peak_rss_bytes': None}]
+    assert len(saved['stages']) == 2
+
+
+def test_pickled_size():
+    assert pickled_size(np.zeros(1000)) > 8000
@@ -0,0 +1,63 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+from numpy.testing import assert_allclose
+from pandas import DataFrame
+
+from hydrus.__main__ import (
+    cluster_kmeans, group_score_matrix, rate, seeded, summarize_scores)
+from hydrus.utility import set_config
+
+
+def test_summarize_scores():
+    weights = [('a', .5), ('b', .25), ('c', .25)]
+    scores = np.array([[1., 2., 3.], [1., np.nan, 3.], [np.nan, 2., np.nan]])
+    summary, _ = summarize_scores(scores, weights)
+    # Missing groups' weights are spread over the others.
+    assert_allclose(summary, [1.75, (.5 + .75) / .75, 2.])
+
+
+def test_rate_aligns_scores():
+    cfg = set_config()
+    cfg.RAPIDCLUS = True
+    rng = np.random.RandomState(0)
+    index = [f'{i:06}' for i in range(50)]
+    nums = [x for g in cfg.GROUPS for x in cfg.MEAS_GROUPS[g][:1]]
+    std_data = DataFrame(rng.normal(size=(50, len(nums))), index, nums)
+    std_data.iloc[:5, 0] = np.nan  # (no data in the first group)
+    final_meas = {g: ([x], []) for g, x in zip(cfg.GROUPS, nums)}
+    pdfs = [DataFrame({g: rng.normal(size=50)}, index) for g in cfg.GROUPS]
+
+    scores = group_score_matrix(std_data, final_meas, pdfs, cfg)
+    assert np.isnan(scores[:5, 0]).all() and not np.isnan(scores[5:]).any()
+
+    # Group scores in another order are matched up by hospital.
+    shuffled = [pdf.iloc[rng.permutation(50)] for pdf in pdfs]
+    summ = rate(std_data, final_meas, shuffled, cfg)
+    assert summ.equals(rate(std_data, final_meas, pdfs, cfg))
+    assert_allclose(summ[cfg.GROUPS].values, scores)
+
+
+def test_cluster_kmeans_seeded():
+    cfg = set_config()
+    cfg.RAPIDCLUS = False
+    scores = np.random.RandomState(0).standard_normal(300)
+    first = cluster_kmeans(scores, cfg)
+    assert all(cluster_kmeans(scores, cfg) == first for _ in range(5))
+
+    cfg.KMEANS_SEED = None
+    assert seeded(cfg).KMEANS_SEED is not None and cfg.KMEANS_SEED is None
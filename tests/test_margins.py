@@ -0,0 +1,63 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+from hydrus.fused import ofused
+from hydrus.margins import boundaries, star_index, star_margins
+from hydrus.__main__ import rate, summarize
+
+
+def test_star_margins():
+    cfg = set_config()
+    cfg.QUADRATURE = False
+    data = synthetic_data(400, cfg=cfg, seed=5)
+    std_data, final_meas = preprocess(cfg=cfg, data=data)
+    _, pdfs = ofused(std_data, final_meas, cfg=cfg)
+
+    for rapidclus in [True, False]:
+        cfg.RAPIDCLUS = rapidclus
+        summ, centers = rate(
+            std_data, final_meas, [p.copy() for p in pdfs], cfg,
+            return_centers=True)
+
+        # The boundaries reproduce the clustering.
+        bounds = boundaries(centers)
+        stars = np.array(cfg.CLUSTER_NAMES)[
+            star_index(summ['summary_win'].values, bounds)]
+        assert (stars == summ['cluster_name'].values).all()
+
+        margins = star_margins(summ, centers, cfg)
+        nearest = margins[['margin_down', 'margin_up']].min(axis=1)
+        assert np.allclose(abs(margins['margin']), nearest)
+        assert (margins['margin'] > 0).any() and (margins['margin'] < 0).any()
+
+        # Changing one group score by its flip amount just crosses over.
+        groups = summ[cfg.GROUPS].copy()
+        for i in range(0, len(summ), 40):
+            g = cfg.GROUPS[i % 3]
+            flip = margins[f'{g}_flip'].iloc[i]
+            if np.isnan(flip):  # (no score in this group)
+                continue
+            for scale, moves in [(.99, False), (1.01, True)]:
+                scores = groups.copy()
+                scores.iloc[i, cfg.GROUPS.index(g)] += scale * flip
+                new = summarize(scores, cfg.GROUP_WEIGHTS)['summary'].iloc[i]
+                before = star_index(summ['summary'].iloc[i], bounds)
+                assert (star_index(new, bounds) != before) == moves
@@ -0,0 +1,111 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import os
+from types import SimpleNamespace
+
+from hydrus import constants
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+from hydrus.instrument import RunReport
+from hydrus.model import oparallel, oserial
+from hydrus.memory import (
+    cgroup_available, mem_available, memory_budget, plan_pool, task_bytes)
+from tests import assert_frame_equal
+
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as out:
+        out.write(text)
+
+
+def test_plan_pool():
+    sizes = [10, 40, 20, 30]
+    assert plan_pool(sizes, None, 8) == (4, [1, 3, 2, 0])
+    assert plan_pool(sizes, 100, 8) == (4, [1, 3, 2, 0])
+    assert plan_pool(sizes, 89, 8)[0] == 2  # 40 + 30 + 20 > 89
+    assert plan_pool(sizes, 90, 2)[0] == 2
+    assert plan_pool(sizes, 10, 8)[0] == 1  # at least one, even if too big
+    assert plan_pool([], 10, 8) == (1, [])
+
+
+def test_cgroup_available(tmpdir):
+    root, proc = str(tmpdir.join('cgroup')), str(tmpdir.join('proc'))
+
+    # v2, with a tighter limit on the parent cgroup than on this one
+    write(proc, '0::/a/b\n')
+    write(os.path.join(root, 'cgroup.controllers'), 'memory\n')
+    write(os.path.join(root, 'a', 'memory.max'), '1000\n')
+    write(os.path.join(root, 'a', 'memory.current'), '600\n')
+    write(os.path.join(root, 'a', 'memory.stat'), 'inactive_file 100\n')
+    write(os.path.join(root, 'a', 'b', 'memory.max'), 'max\n')
+    assert cgroup_available(root, proc) == 500
+
+    # v1, with no limit
+    write(proc, '4:memory:/\n3:cpu:/x\n')
+    write(os.path.join(root, 'memory', 'memory.limit_in_bytes'),
+          '9223372036854771712\n')
+    assert cgroup_available(root, proc) is None
+    write(os.path.join(root, 'memory', 'memory.limit_in_bytes'), '2000\n')
+    write(os.path.join(root, 'memory', 'memory.usage_in_bytes'), '500\n')
+    assert cgroup_available(root, proc) == 1500
+
+    assert cgroup_available(root, str(tmpdir.join('missing'))) is None
+
+
+def test_memory_budget(tmpdir):
+    meminfo = tmpdir.join('meminfo')
+    meminfo.write('MemTotal:  8000 kB\nMemAvailable:  4000 kB\n')
+    assert mem_available(str(meminfo)) == 4000 * 1024
+    assert mem_available(str(tmpdir.join('missing'))) is None
+
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.MEMORY_BUDGET = 12345
+    assert memory_budget(cfg) == 12345
+    cfg.MEMORY_BUDGET = None
+    assert memory_budget(cfg) is None or memory_budget(cfg) > 0
+
+
+def test_task_bytes():
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.QUADRATURE = False
+    exact = task_bytes(1000, 5, 10**6, cfg)
+    assert task_bytes(2000, 5, 10**6, cfg) > exact
+    cfg.COMPACT = True
+    assert task_bytes(1000, 5, 10**6, cfg) < exact
+    cfg.COMPACT, cfg.CHUNKED, cfg.CHUNK_ROWS = False, True, 100
+    assert task_bytes(2000, 5, 10**6, cfg) < exact
+    cfg.CHUNKED, cfg.QUADRATURE = False, True
+    quad = task_bytes(1000, 5, 10**6, cfg)
+    assert quad > exact
+    cfg.ADAPTIVE_QUADRATURE = True
+    assert exact < task_bytes(1000, 5, 10**6, cfg) < quad
+
+
+def test_oparallel_budget():
+    cfg = set_config()
+    cfg.QUADRATURE, cfg.MEMORY_BUDGET = False, 1
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(300, cfg=cfg, seed=0))
+    report = RunReport()
+    edfs, pdfs = oparallel(std_data, final_meas, cfg=cfg, report=report)
+    assert report.pool['processes'] == 1
+    assert [x['group'] for x in report.workers] == cfg.GROUPS
+    expected_edfs, expected_pdfs = oserial(std_data, final_meas, cfg=cfg)
+    for a, b in zip([*edfs, *pdfs], [*expected_edfs, *expected_pdfs]):
+        assert_frame_equal(a, b)
@@ -14,13 +14,27 @@
 # 
 # You should have received a copy of the GNU General Public License
 # along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+from types import SimpleNamespace
+
 import numpy as np
-from numpy.testing import assert_approx_equal
+from numpy.testing import assert_approx_equal, assert_allclose
+from scipy.optimize import approx_fprime
 from scipy.stats import norm
 
 from hypothesis import given
 
-from hydrus.model import Lvm
+from hydrus import constants
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.__main__ import main
+from hydrus.model import (
+    Lvm, adaptive_qcount, group_inputs, ll_adaptive, ll_exact, ll_grad_exact,
+    ll_grad_rows, ll_quad, oserial, pack, post_mode, post_mode_jac)
+from hydrus.fused import ofused
+from hydrus.threaded import othreaded
+from hydrus.preprocess import preprocess
+from hydrus.chunked import ChunkedLvm, group_memmaps
+from hydrus.compact import CompactLvm, ll_obj_grad32
 from tests import strat_1d, strat_pos_1d
 
 
@@ -30,3 +44,164 @@ def test_preds_ll(alpha, mu, gamma, err, num, w):
     simple_impl = np.nansum(w * norm.logpdf(num, mu+gamma*alpha, err))
     simple_impl += np.sum(norm.logpdf(alpha))
     assert_approx_equal(current_impl, simple_impl)
+
+
+def lvm_data(n=300, m=4, seed=0):
+    """Draw scores and weights from the LVM."""
+    rng = np.random.RandomState(seed)
+    alpha = rng.standard_normal((n, 1))
+    z = .7 * alpha + .7 * rng.standard_normal((n, m))
+    w = rng.uniform(.1, 2, (n, m))
+    z[rng.uniform(size=(n, m)) < .3] = np.nan
+    w[np.isnan(z)] = np.nan
+    return z, w
+
+
+def test_ll_grad_exact():
+    z, w = lvm_data()
+    lvm = Lvm(z, w)
+    params = lvm.ests_init + .1
+    grad = ll_grad_exact(params, lvm.num2, lvm.w2)
+    approx = approx_fprime(params, lambda x: lvm.ests_ll(x).sum(), 1e-7)
+    assert_allclose(grad, approx, rtol=1e-4, atol=1e-3)
+
+
+def test_ll_grad_rows():
+    z, w = lvm_data()
+    lvm = Lvm(z, w)
+    params = lvm.ests_init + .1
+    rows = ll_grad_rows(params, lvm.num2, lvm.w2)
+    assert rows.shape == (len(z), len(params))
+    assert_allclose(
+        rows.sum(axis=0), ll_grad_exact(params, lvm.num2, lvm.w2))
+    i = 7
+    approx = approx_fprime(
+        params, lambda x: ll_exact(x, lvm.num2[[i]], lvm.w2[[i]])[0], 1e-7)
+    assert_allclose(rows[i], approx, rtol=1e-4, atol=1e-5)
+
+
+def test_post_mode_jac():
+    z, w = lvm_data(n=20)
+    params = np.array(pack(constants.INITIAL_LVM_PARAMS, 4)) + .1
+    jac = post_mode_jac(params, z, w)
+    for i in range(len(z)):
+        approx = approx_fprime(
+            params, lambda x: post_mode(x, z[[i]], w[[i]])[0], 1e-7)
+        assert_allclose(jac[i], approx, rtol=1e-4, atol=1e-6)
+
+
+def test_chunked_lvm():
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.CHUNK_ROWS, cfg.QUADRATURE = 64, False
+    z, w = lvm_data()
+    dense, chunked = Lvm(z, w, cfg=cfg), ChunkedLvm(z, w, cfg=cfg)
+    params = dense.ests_init + .1
+    assert_allclose(chunked.ests_ll(params), dense.ests_ll(params))
+
+    dense_ests, chunked_ests = dense.estimate(), chunked.estimate()
+    assert_allclose(chunked_ests, dense_ests, atol=1e-3)
+    assert_allclose(chunked.predict(), dense.predict(), atol=1e-3)
+
+
+def test_chunked_inputs(tmpdir):
+    cfg = set_config()
+    cfg.QUADRATURE, cfg.CHUNK_ROWS = False, 64
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(300, cfg=cfg, seed=0))
+    for g in cfg.GROUPS:
+        z, w = group_memmaps(std_data, final_meas[g], str(tmpdir), 64)
+        num_df, meas_weights = group_inputs(std_data, final_meas[g])
+        assert_allclose(z, num_df.values, rtol=1e-15)
+        assert_allclose(w, meas_weights.values, rtol=1e-15)
+
+    # `outcomes` writes the inputs straight to disk, with the same results.
+    edfs, pdfs = oserial(std_data, final_meas, cfg=cfg)
+    cfg.CHUNKED = True
+    chunked_edfs, chunked_pdfs = oserial(std_data, final_meas, cfg=cfg)
+    for a, b in zip(edfs + pdfs, chunked_edfs + chunked_pdfs):
+        assert_allclose(a.values, b.values, atol=1e-3)
+
+
+def test_compact_lvm():
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.QUADRATURE = False
+    z, w = lvm_data()
+    dense, compact = Lvm(z, w, cfg=cfg), CompactLvm(z, w, cfg=cfg)
+    dense_mats = [dense.z, dense.w, dense.num2, dense.w2]
+    compact_mats = [compact.vals, compact.wts, compact.mask]
+    assert sum(x.nbytes for x in compact_mats) < .3 * sum(
+        x.nbytes for x in dense_mats)
+    assert_allclose(compact.z, z, rtol=1e-6)
+    assert_allclose(compact.w, w, rtol=1e-6)
+
+    params = dense.ests_init + .1
+    assert_allclose(compact.ests_ll(params), dense.ests_ll(params), rtol=1e-5)
+    ll, grad = ll_obj_grad32(params, compact.vals, compact.wts)
+    assert_allclose(grad, ll_grad_exact(params, dense.num2, dense.w2),
+                    rtol=1e-4, atol=1e-3)
+
+    dense_ests, compact_ests = dense.estimate(), compact.estimate()
+    assert_allclose(compact_ests, dense_ests, atol=1e-3)
+    assert_allclose(compact.predict(), dense.predict(), atol=1e-3)
+
+
+def test_compact_stars():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.WRITE_NOTHING, cfg.RAPIDCLUS = False, True, True
+    data = synthetic_data(500, cfg=cfg, seed=0)
+    dense = main(cfg=cfg, data=data)
+    cfg.COMPACT = True
+    compact = main(cfg=cfg, data=data)
+    for col in cfg.GROUPS + ['summary']:
+        assert_allclose(compact[col], dense[col], atol=1e-3)
+    assert (compact['cluster_name'] == dense['cluster_name']).mean() > .99
+
+
+def test_fused_lvm():
+    cfg = set_config()
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(400, cfg=cfg, seed=1))
+    groups = ['mortality', 'efficiency', 'effectiveness']
+    ests, preds = oserial(std_data, final_meas, groups)
+    fused_ests, fused_preds = ofused(std_data, final_meas, groups)
+    for x, y in zip(ests + preds, fused_ests + fused_preds):
+        assert_allclose(x.values, y.values, atol=1e-3)
+
+
+def test_threaded():
+    cfg = set_config()
+    cfg.QUADRATURE = False
+    data = synthetic_data(400, cfg=cfg, seed=2)
+    std_data, final_meas = preprocess(cfg=cfg, data=data)
+    serial_ests, serial_preds = oserial(std_data, final_meas, cfg=cfg)
+    cfg.THREADS = True
+    ests, preds = othreaded(std_data, final_meas, cfg=cfg)
+    for x, y in zip(serial_ests + serial_preds, ests + preds):
+        assert_allclose(x.values, y.values, atol=1e-3)
+
+
+def test_adaptive_quadrature():
+    z, w = lvm_data()
+    params = np.array(pack(constants.INITIAL_LVM_PARAMS, 4)) + .1
+    obs = ~(np.isnan(z) | np.isnan(w))
+    exact = ll_exact(params, np.where(obs, z, 0), np.where(obs, w, 0))
+
+    # A few adaptive nodes beat the usual 30 fixed ones.
+    qcount = adaptive_qcount(params, z, w, 1e-8, 30)
+    assert qcount < 5
+    adaptive = ll_adaptive(params, z, w, qcount)
+    assert_allclose(adaptive, exact, rtol=1e-10)
+    fixed = ll_quad(params, z, w, 30)
+    assert abs(fixed - exact).max() > 100 * abs(adaptive - exact).max()
+
+    cfg = SimpleNamespace(**vars(constants))
+    cfg.QUADRATURE, cfg.ADAPTIVE_QUADRATURE = True, True
+    lvm = Lvm(z, w, cfg=cfg)
+    lvm.estimate()
+    assert lvm.ests_stats['qcount'] == qcount
+    cfg.QUADRATURE = False
+    ref = Lvm(np.where(obs, z, np.nan), np.where(obs, w, np.nan), cfg=cfg)
+    ref.estimate()
+    assert_allclose(
+        np.concatenate(lvm.final_ests), np.concatenate(ref.final_ests),
+        atol=1e-4)
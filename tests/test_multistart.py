@@ -0,0 +1,70 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+from numpy.testing import assert_allclose
+
+from hydrus import constants
+from hydrus.multistart import share, unshare, start_points, distinct_optima
+from hydrus.multistart import orient
+from hydrus.multistart import multistart
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+from hydrus.model import oserial
+
+
+def test_share():
+    x = np.arange(12.).reshape(3, 4)
+    assert_allclose(unshare(*share(x)), x)
+
+
+def test_start_points():
+    points = start_points(3, 5, constants, seed=1)
+    assert len(points) == 5
+    assert_allclose(points[0], [.025] * 3 + [.5] * 3 + [.88] * 3)
+    assert_allclose(points[1][3:6], -points[0][3:6])
+    assert all((x[6:] > 0).all() for x in points)
+
+
+def test_orient():
+    params = np.array([.1, .2, -.5, .1, 1., 1.])
+    assert_allclose(orient(params), [.1, .2, .5, -.1, 1., 1.])
+    assert_allclose(orient(orient(params)), orient(params))
+
+
+def test_distinct_optima():
+    assert distinct_optima([10., 10. + 1e-9, 12.]) == 2
+    assert distinct_optima([-5.]) == 1
+
+
+def test_multistart():
+    cfg = set_config()
+    cfg.QUADRATURE = False
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(300, cfg=cfg, seed=2))
+    groups = ['efficiency']
+    results = multistart(std_data, final_meas, groups, cfg, starts=4)
+    res = results['efficiency']
+    assert len(res['funs']) + len(res['pruned']) == 4
+    assert res['best_fun'] == min(res['funs'])
+
+    # The best optimum is at least as good as the usual single start.
+    default = res['default_fun']
+    assert default is None or res['best_fun'] <= default + 1e-8
+    single = oserial(std_data, final_meas, groups)[0][0]
+    best = np.split(res['best_params'], 3)
+    assert_allclose(best, single.values.T, atol=1e-3)
@@ -20,6 +20,9 @@ from scipy.stats import norm
 from hypothesis import given, assume
 
 from hydrus.norm import lpdf, lpdf_1d, lpdf_3d, lpdf_std, nsum, nsum_row
+from hydrus.norm import (
+    ll_exact_nogil, ll_grad_nogil, ll_quad_nogil, post_mode_nogil)
+from hydrus.model import QC1, QC2, ll_exact, ll_grad_exact, ll_quad, post_mode
 from tests import strat_1d, strat_3d
 from tests import strat_pos_1d, strat_pos_3d
 from tests import strat_nan_1d, strat_nan_2d
@@ -57,3 +60,24 @@ def test_nsum_row(x):
     assume(np.max(x[np.isfinite(x)]) < 1e4)
     assume(np.min(x[np.isfinite(x)]) > -1e4)
     aae(nsum_row(x), np.nansum(x, axis=1))
+
+
+def lvm_inputs(n=200, m=5, seed=0):
+    rng = np.random.RandomState(seed)
+    z = rng.standard_normal((n, m))
+    w = rng.uniform(.1, 2, (n, m))
+    z[rng.uniform(size=(n, m)) < .3] = np.nan
+    w[rng.uniform(size=(n, m)) < .1] = np.nan
+    params = np.concatenate([
+        rng.normal(0, .1, m), rng.uniform(.3, 1, m), rng.uniform(.5, 1, m)])
+    return params, z, w
+
+
+def test_nogil_kernels():
+    params, z, w = lvm_inputs()
+    num2, w2 = np.nan_to_num(z), np.nan_to_num(w)
+    aae(ll_exact_nogil(params, num2, w2), ll_exact(params, num2, w2))
+    aae(ll_grad_nogil(params, num2, w2), ll_grad_exact(params, num2, w2))
+    aae(post_mode_nogil(params, z, w), post_mode(params, z, w))
+    aae(ll_quad_nogil(params, z, w, QC1, QC2),
+        ll_quad(params, z, w, len(QC1)))
@@ -0,0 +1,70 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+import pytest
+from pandas import read_csv
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.__main__ import main
+
+pytest.importorskip('tables')
+from hydrus.store import ResultsStore, quarter_of  # noqa: E402
+
+
+def test_results_store(tmpdir):
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS, cfg.FUSED = False, True, True
+    cfg.OUT = str(tmpdir)
+    assert quarter_of(cfg) == cfg.MEASURE_SETTINGS[-11:-4]
+
+    runs = {}
+    for seed, quarter in enumerate(['2016_10', '2016_12']):
+        cfg.QUARTER = quarter
+        data = synthetic_data(300, cfg=cfg, seed=seed)
+        runs[quarter] = main(f'run{seed}', cfg=cfg, data=data)
+
+    with ResultsStore(os.path.join(cfg.OUT, cfg.RESULTS_STORE)) as store:
+        assert store.runs()['run'].tolist() == ['run0', 'run1']
+
+        # One hospital's history across both quarters.
+        pid = runs['2016_10'].index[5]
+        hist = store.provider(pid)
+        assert hist['quarter'].tolist() == ['2016_10', '2016_12']
+        for _, row in hist.iterrows():
+            expected = runs[row['quarter']].loc[pid]
+            assert row['summary'] == pytest.approx(expected['summary'])
+            assert row['cluster_name'] == expected['cluster_name']
+
+        q = store.quarter('2016_12')
+        assert len(q) == len(runs['2016_12'])
+        params = store.quarter('2016_12', 'params')
+        assert set(params['group']) == set(cfg.GROUPS)
+
+        # The CSV export matches the files written by `main`.
+        store.to_csv('run1', str(tmpdir.join('export')), cfg)
+        exports = os.listdir(str(tmpdir.join('export')))
+        assert len(exports) == len(cfg.GROUPS) + 1
+        for f in exports:
+            written = read_csv(os.path.join(cfg.OUT, 'run1', f))
+            exported = read_csv(str(tmpdir.join('export', f)))
+            assert exported.equals(written)
+
+        # Runs are never overwritten.
+        with pytest.raises(ValueError):
+            store.append_run('run1', runs['2016_12'], [], cfg)
@@ -0,0 +1,95 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import os
+
+import numpy as np
+from numpy.testing import assert_allclose
+from pandas import read_csv
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.__main__ import main
+from hydrus.strata import GROUPS_REPORTED, groups_reported, stratified
+
+
+def test_stratified(tmpdir):
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS = False, True
+    cfg.OUT = str(tmpdir)
+    data = synthetic_data(800, cfg=cfg, seed=0)
+    data['SIZE'] = np.where(np.arange(len(data)) % 2, 'large', 'small')
+    data.loc[data.index[:10], 'SIZE'] = None
+
+    cfg.STRATUM = 'SIZE'
+    combined = main('strata', cfg=cfg, data=data)
+    assert sorted(combined['stratum'].dropna().unique()) == ['large', 'small']
+
+    # Hospitals with no stratum are listed, unrated.
+    assert len(combined) == len(data)
+    unrated = combined.loc[data.index[:10]]
+    assert unrated['summary'].isnull().all()
+    assert unrated['cluster_name'].isnull().all()
+    data = data.iloc[10:]
+    combined = combined.loc[data.index]
+
+    # Each stratum is rated as if it were the whole file.  (The LVM inputs are
+    # laid out differently in shared memory, so sums are taken in a different
+    # order.)
+    cfg.STRATUM, cfg.WRITE_NOTHING = None, True
+    for s, part in data.groupby('SIZE'):
+        alone = main(cfg=cfg, data=part.drop('SIZE', axis=1))
+        ours = combined[combined['stratum'] == s].drop('stratum', axis=1)
+        ours = ours.loc[alone.index, alone.columns]
+        numeric = alone.columns.drop('cluster_name')
+        assert_allclose(ours[numeric].values.astype(float),
+                        alone[numeric].values.astype(float), atol=1e-5)
+        assert (ours['cluster_name'] == alone['cluster_name']).all()
+
+    # One combined file each for the ratings and the parameters.
+    written = read_csv(tmpdir.join('strata', f'{cfg.STRATA_FILE}.csv'))
+    assert len(written) == len(data) + 10
+    params = read_csv(
+        tmpdir.join('strata', f'{cfg.STRATA_FILE}_parameters.csv'))
+    assert set(params['stratum']) == {'large', 'small'}
+    assert set(params['group']) == set(cfg.GROUPS)
+    assert os.path.exists(tmpdir.join('strata', f'{cfg.REPORT_FILE}.json'))
+
+
+def test_groups_reported():
+    cfg = set_config()
+    data = synthetic_data(300, cfg=cfg, seed=1)
+    counts = groups_reported(data, cfg)
+    assert counts.between(0, len(cfg.GROUPS)).all()
+    assert counts.name == GROUPS_REPORTED
+
+
+def test_stratified_groups_reported():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS = False, True
+    data = synthetic_data(800, cfg=cfg, seed=0)
+    counts = groups_reported(data, cfg)
+    sizes = counts.value_counts()
+    small = sizes.index[sizes < cfg.MIN_HOSPITALS]
+    assert len(small)  # (else there is nothing to leave out)
+
+    summ_scores, est_df = stratified(GROUPS_REPORTED, cfg, data)
+    assert len(summ_scores) == len(data)
+    rated = summ_scores['cluster_name'].notnull()
+    assert set(summ_scores['stratum'][rated]) <= set(sizes.index) - set(small)
+    assert rated.any()
+    assert not rated[counts.isin(small)].any()
+    assert set(est_df.index.get_level_values('stratum')).isdisjoint(small)
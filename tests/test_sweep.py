@@ -0,0 +1,76 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import pytest
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.instrument import RunReport
+from hydrus.preprocess import preprocess
+from hydrus.__main__ import main
+from hydrus.sweep import inputs_key, sweep, variants
+from tests import assert_frame_equal
+
+
+def test_sweep():
+    cfg = set_config()
+    cfg.MULTIPROCESSING, cfg.RAPIDCLUS, cfg.WRITE_NOTHING = False, True, True
+    data = synthetic_data(300, cfg=cfg, seed=0)
+    grid = {
+        'WINSOR_LIMITS': [(-3., 3.), (-2., 2.)],
+        'COMBINE_IMM3_OP27': [True, False],
+        }
+    assert len(variants(grid)) == 4
+    with pytest.raises(ValueError):
+        variants({'QUADRATURE': [True]})
+
+    fits = {}
+    summary, scores = sweep(grid, cfg, data, fits)
+    assert_frame_equal(scores[0], main(cfg=cfg, data=data))
+
+    # Separating IMM-3 and OP-27 changes one group's inputs only.
+    ngroups = len(cfg.GROUPS)
+    assert summary['fitted'].tolist()[:2] == [ngroups, 1]
+    assert summary['reused'][1] == ngroups - 1
+    assert len(fits) == summary['fitted'].sum()
+    assert summary['stars_up'][0] == summary['stars_down'][0] == 0
+    assert (summary['stars_up'] + summary['stars_down'])[2:].gt(0).all()
+
+    # Fits carry over from one sweep to the next.
+    report = RunReport()
+    _, again = sweep({'WINSOR_LIMITS': [(-2., 2.)]}, cfg, data, fits, report)
+    assert report.groups['sweep']['fitted'] == 0
+    assert_frame_equal(again[0], scores[2])
+
+    # But not to a sweep fitted differently.
+    cfg.TOL = 1e-6
+    report = RunReport()
+    sweep({'WINSOR_LIMITS': [(-2., 2.)]}, cfg, data, fits, report)
+    assert report.groups['sweep']['fitted'] == ngroups
+
+
+def test_inputs_key():
+    cfg = set_config()
+    std_data, final_meas = preprocess(
+        cfg=cfg, data=synthetic_data(300, cfg=cfg, seed=0))
+    g = cfg.GROUPS[0]
+    key = inputs_key(std_data, final_meas[g], cfg)
+    assert inputs_key(std_data, final_meas[g], cfg) == key
+    for name, value in [('EXACT_BOUNDS', None), ('THREADS', True),
+                        ('CHUNK_ROWS', 10)]:
+        new = set_config()
+        setattr(new, name, value)
+        assert inputs_key(std_data, final_meas[g], new) != key, name
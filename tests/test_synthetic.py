@@ -0,0 +1,47 @@
+# Mark Gatheman <markrg@protonmail.com>
+#
+# This file is part of Hydrus.
+#
+# Hydrus is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+# 
+# Hydrus is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+# 
+# You should have received a copy of the GNU General Public License
+# along with Hydrus.  If not, see <http://www.gnu.org/licenses/>.
+import numpy as np
+
+from hydrus.utility import set_config
+from hydrus.synthetic import synthetic_data
+from hydrus.preprocess import preprocess
+
+
+def test_synthetic_layout():
+    cfg = set_config()
+    df = synthetic_data(300, cfg=cfg, seed=0)
+    assert df.index.name == 'PROVIDER_ID'
+    assert {'IMM_3', 'OP_27', 'IMM_3_DEN', 'OP_27_DEN'} <= set(df.columns)
+    assert 'IMM_3_OP_27' not in df.columns
+
+    # Scores are missing exactly where their denominators are.
+    for col in df.columns:
+        if col + '_DEN' in df.columns:
+            assert (df[col].isnull() == df[col + '_DEN'].isnull()).all()
+
+    std_data, final_meas = preprocess(cfg=cfg, data=df)
+    for g in cfg.GROUPS:
+        nums, dens = final_meas[g]
+        assert nums and len(nums) == len(dens)
+        assert np.allclose(std_data[nums].mean(), 0, atol=.2)
+
+
+def test_synthetic_seed():
+    cfg = set_config()
+    df1 = synthetic_data(50, cfg=cfg, seed=3)
+    df2 = synthetic_data(50, cfg=cfg, seed=3)
+    assert df1.equals(df2)